@@ -38,9 +38,25 @@ def get_secret(setting, secrets=secrets):
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = get_secret('SECRET_KEY')
 
-MAINTENANCE_MODE = False
+# Letto all'avvio: per attivare o disattivare la manutenzione vanno riavviati i worker
+MAINTENANCE_MODE = os.environ.get('MAINTENANCE_MODE') == '1'
 MAINTENANCE_BYPASS_QUERY = get_secret('MAINTENANCE_BYPASS_QUERY')
 
+# PerformanceMiddleware: frazione di richieste loggate e soglia (ms) oltre la quale si logga sempre
+PERFORMANCE_LOG_SAMPLE_RATE = 0.01
+PERFORMANCE_SLOW_MS = 2000
+# /metrics risponde solo con "Authorization: Bearer <METRICS_TOKEN>"; senza token in secrets.json è disattivato.
+# Dietro al proxy REMOTE_ADDR è sempre quello del proxy, quindi l'indirizzo da solo non protegge nulla.
+# Ogni worker espone solo le proprie metriche (etichetta pid): la somma tra i worker la fa chi le raccoglie.
+METRICS_TOKEN = secrets.get('METRICS_TOKEN', '')
+# Servizi esterni; benchmark e prove di carico li sostituiscono con servizi_locali.py
+TASSI_CAMBIO_URL = os.environ.get(
+    'TASSI_CAMBIO_URL', 'https://tassidicambio.bancaditalia.it/terzevalute-wf-web/rest/v1.0/dailyTimeSeries')
+PREZZI_CARBURANTE_URL = os.environ.get(
+    'PREZZI_CARBURANTE_URL', 'https://sisen.mase.gov.it/dgsaie/api/v1/weekly-prices/report/export?format=JSON&lang=it')
+# Cartella dei dump cProfile di genera_pdf (?profila=1, solo staff)
+PDF_PROFILE_DIR = os.path.join(BASE_DIR, 'profili')
+
 # SECURITY WARNING: don't run with debug turned on in production!
 runserver = 'runserver' in sys.argv
 if runserver:
@@ -79,16 +95,22 @@ INSTALLED_APPS = [
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 MIDDLEWARE = [
+    'RimborsiApp.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
+    'shibboleth.middleware.AttributiDaHeaderMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'RimborsiApp.middleware.GruppiUtenteMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'RimborsiApp.middleware.MaintenanceModeMiddleware',
 ]
 
+# Login Shibboleth con gli attributi passati come header HTTP, solo per le prove di carico in locale
+SHIBBOLETH_ATTRIBUTI_DA_HEADER = os.environ.get('SHIBBOLETH_ATTRIBUTI_DA_HEADER') == '1'
+
 ROOT_URLCONF = 'Rimborsi.urls'
 
 TEMPLATES = [
@@ -132,12 +154,20 @@ DATABASES = {
     }
 }
 
-# CACHES = {
-#     'default': {
-#         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-#         'LOCATION': 'my_cache_table',
-#     }
-# }
+# Cache condivisa tra i worker: contiene solo le versioni con cui si invalidano i gruppi salvati in sessione
+# (gruppi.py) e le tabelle di riferimento in memoria (riferimenti.py). Con la LocMem di default ogni processo
+# vedrebbe solo le proprie invalidazioni. Ogni worker rilegge una versione al più ogni 5 secondi, quindi la
+# DatabaseCache costa una query ogni tanto e non una per richiesta; con memcached o redis disponibili basta
+# cambiare BACKEND. La tabella si crea una volta con `manage.py createcachetable` (`migrate` segnala se manca).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'rimborsi_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -158,12 +188,18 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 # gmail settings
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.gmail.com'
-EMAIL_USE_TLS = True
-EMAIL_PORT = 587
+# Per le prove senza SMTP: EMAIL_BACKEND=django.core.mail.backends.filebased.EmailBackend (o .console.EmailBackend)
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = os.environ.get('EMAIL_FILE_PATH', os.path.join(BASE_DIR, 'email_inviate'))
+# Sovrascrivibili dall'environment per puntare a un SMTP locale (manage.py servizi_locali)
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', '1') == '1'
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
 EMAIL_HOST_USER = get_secret('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = get_secret('EMAIL_HOST_PASSWORD')
+EMAIL_TIMEOUT = 30
+# Invio della coda EmailInUscita da un thread del processo web; con '0' serve `manage.py invia_email --continuo`
+EMAIL_CODA_THREAD = os.environ.get('EMAIL_CODA_THREAD', '1') == '1'
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.2/topics/i18n/
@@ -193,4 +229,26 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-FORM_RENDERER = 'django.forms.renderers.TemplatesSetting'
\ No newline at end of file
+FORM_RENDERER = 'django.forms.renderers.TemplatesSetting'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'RimborsiApp.performance': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'RimborsiApp.posta': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
\ No newline at end of file
@@ -31,6 +31,19 @@ class StatoAdmin(admin.ModelAdmin):
     list_display = [f.name for f in Stato._meta.fields]
 
 
+class StrutturaFondiAdmin(admin.ModelAdmin):
+    list_display = [f.name for f in StrutturaFondi._meta.fields]
+
+
+class StatisticaMissioniAdmin(admin.ModelAdmin):
+    list_display = [f.name for f in StatisticaMissioni._meta.fields]
+
+
+class TassoCambioAdmin(admin.ModelAdmin):
+    list_display = [f.name for f in TassoCambio._meta.fields]
+    list_filter = ['valuta']
+
+
 class TrasportoAdmin(admin.ModelAdmin):
     list_display = [f.name for f in Trasporto._meta.fields]
 
@@ -48,7 +61,11 @@ class SpesaMissioneAdmin(admin.ModelAdmin):
 
 
 class PastiAdmin(admin.ModelAdmin):
-    list_display = [f.name for f in Pasti._meta.fields]
+    list_display = ['id', 'missione', 'data']
+
+
+class PastoAdmin(admin.ModelAdmin):
+    list_display = [f.name for f in Pasto._meta.fields]
 
 class FirmaAdmin(admin.ModelAdmin):
     list_display = [f.name for f in Firma._meta.fields]
@@ -56,6 +73,15 @@ class FirmaAdmin(admin.ModelAdmin):
 class FirmaSharedAdmin(admin.ModelAdmin):
     list_display = [f.name for f in FirmaShared._meta.fields]
 
+
+class EmailInUscitaAdmin(admin.ModelAdmin):
+    list_display = [f.name for f in EmailInUscita._meta.fields if f.name != 'testo']
+    list_filter = ['stato']
+
+
+class AllegatoEmailAdmin(admin.ModelAdmin):
+    list_display = [f.name for f in AllegatoEmail._meta.fields]
+
 admin_site = admin.site
 
 admin_site.register(FirmaShared, FirmaSharedAdmin)
@@ -66,8 +92,14 @@ admin_site.register(Missione, MissioneAdmin)
 admin_site.register(Indirizzo, IndirizzoAdmin)
 admin_site.register(Categoria, CategoriaAdmin)
 admin_site.register(Stato, StatoAdmin)
+admin_site.register(StrutturaFondi, StrutturaFondiAdmin)
+admin_site.register(StatisticaMissioni, StatisticaMissioniAdmin)
+admin_site.register(TassoCambio, TassoCambioAdmin)
 admin_site.register(Trasporto, TrasportoAdmin)
 admin_site.register(ModuliMissione, DateRichiestaAdmin)
 admin.site.register(Spesa, SpesaAdmin)
 admin.site.register(SpesaMissione, SpesaMissioneAdmin)
-admin_site.register(Pasti, PastiAdmin)
\ No newline at end of file
+admin_site.register(Pasti, PastiAdmin)
+admin_site.register(Pasto, PastoAdmin)
+admin_site.register(EmailInUscita, EmailInUscitaAdmin)
+admin_site.register(AllegatoEmail, AllegatoEmailAdmin)
@@ -1,5 +1,39 @@
 from django.apps import AppConfig
+from django.core.checks import Tags, Warning, register
 
 
 class RimborsiappConfig(AppConfig):
     name = 'RimborsiApp'
+
+    def ready(self):
+        # Registra i receiver che invalidano la cache delle tabelle di riferimento e aggiornano l'indice di ricerca
+        from RimborsiApp import riferimenti, ricerca  # noqa: F401
+
+
+@register(Tags.database)
+def controlla_tabelle_cache(app_configs, **kwargs):
+    """
+    Le cache DatabaseCache (CACHES in settings) richiedono `manage.py createcachetable`: senza la tabella ogni
+    richiesta autenticata fallisce. Segnalato da `migrate` e da `manage.py check --tag database`; è un avviso e
+    non un errore perché `migrate` su un db nuovo deve poter girare prima di createcachetable.
+    """
+    from django.conf import settings
+    from django.core.cache import caches
+    from django.db import DatabaseError, connections, router
+
+    avvisi = []
+    for alias, config in settings.CACHES.items():
+        if config['BACKEND'] != 'django.core.cache.backends.db.DatabaseCache':
+            continue
+        db = router.db_for_write(caches[alias].cache_model_class)
+        try:
+            tabelle = connections[db].introspection.table_names()
+        except DatabaseError:
+            continue  # db non raggiungibile: lo segnalano già gli altri controlli
+        if config['LOCATION'] not in tabelle:
+            avvisi.append(Warning(
+                f"Manca la tabella '{config['LOCATION']}' della cache '{alias}'.",
+                hint='Eseguire `manage.py createcachetable`.',
+                id='RimborsiApp.W001',
+            ))
+    return avvisi
@@ -0,0 +1,56 @@
+"""
+Tempi e memoria di avvio di un worker (`manage.py tempi_avvio`).
+
+Eseguito come `python -m RimborsiApp.avvio` in un processo nuovo: misura django.setup(), il caricamento
+dell'URLconf e dei middleware come farebbe un worker WSGI, elenca le librerie pesanti già importate a quel
+punto e poi il costo del loro primo uso. Stampa il risultato in JSON.
+"""
+import json
+import os
+import resource
+import sys
+import time
+
+
+def _rss_kib():
+    # ru_maxrss è in KiB su Linux, in byte su macOS
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return picco // 1024 if sys.platform == 'darwin' else picco
+
+
+def misura_avvio():
+    inizio = time.perf_counter()
+    fasi = {}
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Rimborsi.settings')
+    import django
+    django.setup()
+    fasi['setup_ms'] = (time.perf_counter() - inizio) * 1000
+
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.urls import get_resolver
+    parziale = time.perf_counter()
+    WSGIHandler()
+    get_resolver().url_patterns
+    fasi['url_middleware_ms'] = (time.perf_counter() - parziale) * 1000
+    fasi['totale_ms'] = (time.perf_counter() - inizio) * 1000
+
+    from RimborsiApp import librerie
+    risultato = {
+        'ms': {nome: round(ms, 1) for nome, ms in fasi.items()},
+        'memoria_kib': _rss_kib(),
+        'moduli': len(sys.modules),
+        'pesanti_caricate': [nome for nome in librerie.PESANTI if nome in sys.modules],
+    }
+
+    # Primo uso delle librerie rinviate, come alla prima generazione dei moduli
+    for proxy in (librerie.PyPDF2, librerie.pdf_generic, librerie.docx, librerie.docx_shared, librerie.canvas,
+                  librerie.pagesizes, librerie.Image, librerie.requests):
+        librerie.carica(proxy._nome)
+    risultato['primo_uso_ms'] = {nome: round(ms, 1) for nome, ms in librerie.tempi_import.items()}
+    risultato['memoria_dopo_primo_uso_kib'] = _rss_kib()
+    return risultato
+
+
+if __name__ == '__main__':
+    print(json.dumps(misura_avvio()))
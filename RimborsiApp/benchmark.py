@@ -0,0 +1,184 @@
+"""
+Benchmark delle viste e dei generatori più usati (`manage.py benchmark`), da eseguire sui dati sintetici
+con i servizi esterni sostituiti da servizi_locali. Per ogni caso misura la latenza su più ripetizioni,
+le query eseguite e il picco di memoria allocata (tracemalloc, in un'esecuzione separata perché lo rallenta).
+"""
+import datetime
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.urls import reverse
+
+from RimborsiApp import compila_pdf
+from RimborsiApp.models import Pasti, SpesaMissione, Trasporto
+
+
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, int(round(p / 100 * (len(ordinati) - 1))))]
+
+
+def misura(funzione, ripetizioni=10, riscaldamento=1):
+    """Esegue funzione e restituisce latenza (ms), numero di query e picco di memoria (KiB)."""
+    for _ in range(riscaldamento):
+        funzione()
+
+    tempi, query = [], []
+    for _ in range(ripetizioni):
+        contatore = [0]
+
+        def conta(execute, sql, params, many, context):
+            contatore[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(conta):
+            inizio = time.perf_counter()
+            funzione()
+            tempi.append((time.perf_counter() - inizio) * 1000)
+        query.append(contatore[0])
+
+    tracemalloc.start()
+    try:
+        funzione()
+        _, picco = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'ms': {
+            'min': round(min(tempi), 2),
+            'mediana': round(statistics.median(tempi), 2),
+            'p95': round(percentile(tempi, 95), 2),
+            'media': round(statistics.mean(tempi), 2),
+        },
+        'query': max(query),
+        'memoria_picco_kib': round(picco / 1024, 1),
+    }
+
+
+class Benchmark:
+    """Casi di benchmark per un utente e una sua missione."""
+
+    def __init__(self, user, missione):
+        self.user = user
+        self.missione = missione
+        # HTTP_HOST: senza test runner 'testserver' non è in ALLOWED_HOSTS
+        self.client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0])
+        self.client.force_login(user)
+        self.factory = RequestFactory()
+
+    def _get(self, nome, *args):
+        url = reverse(f'RimborsiApp:{nome}', args=args)
+
+        def chiama():
+            response = self.client.get(url)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{url}: HTTP {response.status_code}')
+        return chiama
+
+    def _post(self, nome, dati, *args):
+        url = reverse(f'RimborsiApp:{nome}', args=args)
+
+        def chiama():
+            response = self.client.post(url, dati)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{url}: HTTP {response.status_code} {response.content[:200]!r}')
+        return chiama
+
+    def _compila(self, funzione, *args):
+        def chiama():
+            request = self.factory.post('/')
+            request.user = self.user
+            funzione(request, self.missione.id, *args)
+        return chiama
+
+    def casi(self):
+        """Nome -> funzione senza argomenti; i casi senza dati nella missione scelta vengono saltati."""
+        m = self.missione
+        casi = {
+            'lista_missioni': self._get('lista_missioni'),
+            'missione': self._get('missione', m.id),
+            'resoconto': self._get('resoconto', m.id),
+            'compila_anticipo': self._compila(compila_pdf.compila_anticipo, None, None),
+            'compila_parte_1': self._compila(compila_pdf.compila_parte_1, None, None),
+            'compila_parte_2': self._compila(compila_pdf.compila_parte_2, None, None),
+            'compila_atto_notorio': self._compila(compila_pdf.compila_atto_notorio, None, True, False),
+            'genera_report_scontrini': self._compila(compila_pdf.genera_report_scontrini),
+        }
+        if m.modulimissione.dottorandi:
+            casi['compila_autorizz_dottorandi'] = self._compila(compila_pdf.compila_autorizz_dottorandi)
+
+        # Salvataggio delle card: aggiornamenti con gli stessi valori, così le ripetizioni non fanno crescere i dati
+        giorno = Pasti.objects.filter(missione=m).prefetch_related('voci').first()
+        if giorno:
+            dati = {'mission_id': m.id, 'data': giorno.data.isoformat()}
+            for voce in giorno.voci.all():
+                dati.update({f'importo{voce.tipo}': voce.importo or '', f'valuta{voce.tipo}': voce.valuta,
+                             f'descrizione{voce.tipo}': voce.descrizione or ''})
+            casi['save_pasto'] = self._post('save_pasto_update', dati, giorno.id)
+        trasporto = Trasporto.objects.filter(missione=m).first()
+        if trasporto:
+            casi['save_trasporto'] = self._post('save_trasporto_update', {
+                'mission_id': m.id, 'data': trasporto.data.isoformat(), 'costo': trasporto.costo,
+                'mezzo': trasporto.mezzo, 'valuta': trasporto.valuta, 'da': trasporto.da or '',
+                'a': trasporto.a or '', 'tipo_costo': trasporto.tipo_costo or '', 'km': trasporto.km or '',
+            }, trasporto.id)
+        for tipo, nome in (('PERNOTTAMENTO', 'save_pernottamento_update'), ('CONVEGNO', 'save_convegno_update'),
+                           ('ALTRO', 'save_altrespesa_update')):
+            sm = SpesaMissione.objects.filter(missione=m, tipo=tipo).select_related('spesa').first()
+            if sm:
+                casi[nome.replace('_update', '')] = self._post(nome, {
+                    'mission_id': m.id, 'data': sm.spesa.data.isoformat(), 'importo': sm.spesa.importo,
+                    'valuta': sm.spesa.valuta, 'descrizione': sm.spesa.descrizione or '',
+                }, sm.spesa.id)
+        return casi
+
+    def esegui(self, ripetizioni=10, solo=None, avanzamento=None):
+        risultati = {}
+        for nome, funzione in self.casi().items():
+            if solo and nome not in solo:
+                continue
+            risultati[nome] = misura(funzione, ripetizioni)
+            if avanzamento:
+                avanzamento(nome, risultati[nome])
+        return risultati
+
+
+def versione_codice():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rapporto(risultati, ripetizioni, missione):
+    return {
+        'versione': versione_codice(),
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'db': connection.vendor,
+        'ripetizioni': ripetizioni,
+        'missione': missione.id,
+        'casi': risultati,
+    }
+
+
+def confronta(precedente, attuale, soglia=0.1):
+    """Righe (caso, mediana prima, mediana ora, variazione, regressione) tra due rapporti JSON."""
+    righe = []
+    for nome, dati in attuale['casi'].items():
+        prima = precedente['casi'].get(nome)
+        if prima is None:
+            continue
+        a, b = prima['ms']['mediana'], dati['ms']['mediana']
+        variazione = (b - a) / a if a else 0.
+        regressione = variazione > soglia or dati['query'] > prima['query']
+        righe.append((nome, a, b, variazione, regressione))
+    return righe
@@ -3,28 +3,21 @@ from itertools import zip_longest
 import io
 import os
 import re
-from PyPDF2 import PdfFileReader, PdfFileWriter
-from PyPDF2.generic import BooleanObject, IndirectObject, NameObject
 from django.contrib.auth.decorators import login_required
 from django.db.models import Sum
 from django.http import HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, redirect, render
-from docx import Document
-from docx.shared import Cm, Inches
-from reportlab.pdfgen import canvas
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from reportlab.lib.pagesizes import A4
 
 from .forms import *
-from .views import money_exchange, resoconto_data, firma
-from PIL import Image
+from .librerie import Image, PyPDF2, canvas, docx, docx_shared, pagesizes, pdf_generic
+from .metrics import IMMAGINI_SECONDI
+from .profilazione import fase, file_cprofile, modulo, profila_generazione
+from .riferimenti import precarica_riferimenti
+from .views import resoconto_data, firma
 
 from django.http import Http404
 
-from reportlab.pdfgen import canvas
-from PyPDF2 import PdfFileWriter, PdfFileReader
-import io
-
 from django.core.exceptions import ValidationError
 
 @login_required
@@ -57,24 +50,39 @@ def genera_pdf(request, id):
         firma_richiedente = moduli_missione.firma_richiedente
         firma_titolare = moduli_missione.firma_titolare
 
-        compila_anticipo(request, id, firma_richiedente, firma_titolare)
-        compila_parte_1(request, id, firma_richiedente, firma_titolare)
-        compila_parte_2(request, id, firma_richiedente, firma_titolare)
-        if request.user.profile.qualifica == 'DOTTORANDO':
-            compila_autorizz_dottorandi(request, id)
-        compila_atto_notorio(request, id, firma_richiedente, dichiarazione_check_std, dichiarazione_check_pers)
-
-        # BRUNA
-        # try:
-        #     genera_resoconto_ricevute(request, id)
-        # except Exception as e:
-        #     print(e)
-
-        # BOLELLI
-        try:
-            genera_report_scontrini(request, id)
-        except Exception as e:
-            print(e)
+        # Con ?profila=1 lo staff ottiene anche il dump cProfile della generazione
+        percorso_cprofile = None
+        if request.GET.get('profila') and request.user.is_staff:
+            percorso_cprofile = file_cprofile(id)
+
+        with profila_generazione(percorso_cprofile) as profilo:
+            with modulo('anticipo'):
+                compila_anticipo(request, id, firma_richiedente, firma_titolare)
+            with modulo('parte_1'):
+                compila_parte_1(request, id, firma_richiedente, firma_titolare)
+            with modulo('parte_2'):
+                compila_parte_2(request, id, firma_richiedente, firma_titolare)
+            if request.user.profile.qualifica == 'DOTTORANDO':
+                with modulo('autorizz_dottorandi'):
+                    compila_autorizz_dottorandi(request, id)
+            with modulo('atto_notorio'):
+                compila_atto_notorio(request, id, firma_richiedente, dichiarazione_check_std, dichiarazione_check_pers)
+
+            # BRUNA
+            # try:
+            #     genera_resoconto_ricevute(request, id)
+            # except Exception as e:
+            #     print(e)
+
+            # BOLELLI
+            try:
+                with modulo('report_scontrini'):
+                    genera_report_scontrini(request, id)
+            except Exception as e:
+                print(e)
+
+        # update() e non save(): non tocca i file appena salvati
+        ModuliMissione.objects.filter(missione_id=id).update(profilo_generazione=profilo.json())
 
         return redirect('RimborsiApp:resoconto', id)
     else:
@@ -83,19 +91,13 @@ def genera_pdf(request, id):
 # BRUNA
 def genera_resoconto_ricevute(request, id):
     missione = Missione.objects.get(user=request.user, id=id)
-    pasti = Pasti.objects.filter(missione=missione).order_by('data')
+    pasti = Pasti.objects.filter(missione=missione).order_by('data').prefetch_related('voci')
     trasporti = Trasporto.objects.filter(missione=missione).order_by('data')
     pernottamenti = Spesa.objects.filter(spesamissione__missione=missione,
                                          spesamissione__tipo='PERNOTTAMENTO').order_by('data')
     convegni = Spesa.objects.filter(spesamissione__missione=missione, spesamissione__tipo='CONVEGNO').order_by('data')
     altro = Spesa.objects.filter(spesamissione__missione=missione, spesamissione__tipo='ALTRO').order_by('data')
 
-    # creo una lista delle etichette con le relative immagini e descrizioni in modo da iterare sulla lista
-    etichetta_con_immagine = [
-        ('Colazione', 'img_scontrino1', 'descrizione1'),
-        ('Pranzo', 'img_scontrino2', 'descrizione2'),
-        ('Cena', 'img_scontrino3', 'descrizione3')
-    ]
     # utilizzo una lista di categorie cosi da comprimere tutto in un unico for iterando sulle categorie
     categorie = [
         ('Ricevute dei Trasporti:', trasporti),
@@ -115,7 +117,7 @@ def genera_resoconto_ricevute(request, id):
     y = altezza_pag - margine_sup
 
     buffer = io.BytesIO()
-    can = canvas.Canvas(buffer, pagesize=A4)
+    can = canvas.Canvas(buffer, pagesize=pagesizes.A4)
     can.setFont("Times-Roman", 24)
     can.drawString(x, y, 'Resoconto ricevute della missione')
     y -= 30
@@ -127,24 +129,18 @@ def genera_resoconto_ricevute(request, id):
     can.setFont("Times-Roman", 14)
 
     for s in pasti:
-        if s.img_scontrino1 or s.img_scontrino2 or s.img_scontrino3:
+        voci = sorted((v for v in s.voci.all() if v.img_scontrino), key=lambda v: v.tipo)
+        if voci:
             can.drawString(x, y, 'Data: ' + s.data.strftime('%d/%m/%Y'))
 
-        for etichetta, immagine, descrizione in etichetta_con_immagine:
-            # gettattr prende il valore dell'attributo dell'oggetto in modo dinamico
-            # in questo caso restituisce il path dell'immagine
-            img = getattr(s, immagine)
-            desc = getattr(s, descrizione)
+        for voce in voci:
+            if voce.descrizione:
+                can.drawString(x, y - spazio_didascalia, 'Descrizione: ')
+                can.drawString(x, y - spazio_didascalia * 2, voce.descrizione)
 
-            if img:
-
-                if desc:
-                    can.drawString(x, y - spazio_didascalia, 'Descrizione: ')
-                    can.drawString(x, y - spazio_didascalia * 2, desc)
-
-                can.drawImage(img.path, x, (y - altezza_immagine - (spazio_didascalia * 3)), larghezza_immagine,
-                              altezza_immagine)
-                x += larghezza_immagine + margine_lat
+            can.drawImage(voce.img_scontrino.path, x, (y - altezza_immagine - (spazio_didascalia * 3)),
+                          larghezza_immagine, altezza_immagine)
+            x += larghezza_immagine + margine_lat
 
         x = margine_lat
         y -= altezza_immagine + spazio_vert + 3 * spazio_didascalia + 15
@@ -216,44 +212,46 @@ def add_new_pdf(pdf_writer, img_obj):
 
     if filename.endswith('.pdf'):
         # It's a PDF file
-        pdf_reader = PdfFileReader(filename)
-
-        # Check whether the pdf id actually fine (it should be improved)
-        try:
-            reader = PdfFileReader(filename)
-            print("Opening '{}', pages={}".format(filename, reader.getNumPages()))
-            # Try to write it into an dummy ByteIO stream to check whether pdf is broken
-            writer = PdfFileWriter()
-            writer.addPage(reader.getPage(0))
-            writer.write(io.BytesIO())
-        except:
-            print("Error reading '{}".format(filename))
-            return
-
-        for page_num in range(pdf_reader.getNumPages()):
-            page = pdf_reader.getPage(page_num)
-            pdf_writer.addPage(page)
+        with fase('lettura_pdf'):
+            pdf_reader = PyPDF2.PdfFileReader(filename)
+
+            # Check whether the pdf id actually fine (it should be improved)
+            try:
+                reader = PyPDF2.PdfFileReader(filename)
+                print("Opening '{}', pages={}".format(filename, reader.getNumPages()))
+                # Try to write it into an dummy ByteIO stream to check whether pdf is broken
+                writer = PyPDF2.PdfFileWriter()
+                writer.addPage(reader.getPage(0))
+                writer.write(io.BytesIO())
+            except:
+                print("Error reading '{}".format(filename))
+                return
+
+            for page_num in range(pdf_reader.getNumPages()):
+                page = pdf_reader.getPage(page_num)
+                pdf_writer.addPage(page)
     else:
         # Assume it's an image file
-        try:
-            image = Image.open(filename)
-        except IOError:
-            return
-
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-
-        # Convert the image to a PDF page in memory
-        image_pdf_bytes = io.BytesIO()
-        image.save(image_pdf_bytes, format='PDF')
-        image_pdf_bytes.seek(0)
+        with fase('immagini'):
+            try:
+                image = Image.open(filename)
+            except IOError:
+                return
+
+            # Convert the image to a PDF page in memory
+            with IMMAGINI_SECONDI.time():
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image_pdf_bytes = io.BytesIO()
+                image.save(image_pdf_bytes, format='PDF')
+                image_pdf_bytes.seek(0)
 
         # Check whether the pdf id actually fine (it should be improved)
         try:
-            reader = PdfFileReader(image_pdf_bytes)
+            reader = PyPDF2.PdfFileReader(image_pdf_bytes)
             print("Opening '{}', pages={}".format(filename, reader.getNumPages()))
             # Try to write it into an dummy ByteIO stream to check whether pdf is broken
-            writer = PdfFileWriter()
+            writer = PyPDF2.PdfFileWriter()
             writer.addPage(reader.getPage(0))
             writer.write(io.BytesIO())
         except:
@@ -261,7 +259,7 @@ def add_new_pdf(pdf_writer, img_obj):
             return
 
         # Read the PDF page and add it to the writer
-        image_pdf_reader = PdfFileReader(image_pdf_bytes)
+        image_pdf_reader = PyPDF2.PdfFileReader(image_pdf_bytes)
         page = image_pdf_reader.getPage(0)
         pdf_writer.addPage(page)
 
@@ -272,18 +270,13 @@ def genera_report_scontrini(request, id):
     missione = Missione.objects.get(user=request.user, id=id)
     profile = Profile.objects.get(user=request.user)
     trasporti = Trasporto.objects.filter(missione=missione).order_by('data')
-    pasti = Pasti.objects.filter(missione=missione).order_by('data')
+    pasti = Pasto.objects.filter(pasti__missione=missione).exclude(img_scontrino='') \
+        .exclude(img_scontrino__isnull=True).order_by('pasti__data', 'tipo')
     spese = SpesaMissione.objects.filter(missione=missione).order_by('spesa__data')
 
-    pdf_writer = PdfFileWriter()
-    prev_date = None
-    for pasti_del_giorno in pasti:
-        if pasti_del_giorno.data != prev_date:
-            pass
-
-        add_new_pdf(pdf_writer, pasti_del_giorno.img_scontrino1)
-        add_new_pdf(pdf_writer, pasti_del_giorno.img_scontrino2)
-        add_new_pdf(pdf_writer, pasti_del_giorno.img_scontrino3)
+    pdf_writer = PyPDF2.PdfFileWriter()
+    for pasto in pasti:
+        add_new_pdf(pdf_writer, pasto.img_scontrino)
 
     for trasporto in trasporti:
         add_new_pdf(pdf_writer, trasporto.img_scontrino)
@@ -291,29 +284,31 @@ def genera_report_scontrini(request, id):
     for spesa in spese:
         add_new_pdf(pdf_writer, spesa.spesa.img_scontrino)
 
-    # Write the combined PDF to a BytesIO object
-    output_pdf_bytes = io.BytesIO()
-    pdf_writer.write(output_pdf_bytes)
-    output_pdf_bytes.seek(0)
+    with fase('merge'):
+        # Write the combined PDF to a BytesIO object
+        output_pdf_bytes = io.BytesIO()
+        pdf_writer.write(output_pdf_bytes)
+        output_pdf_bytes.seek(0)
 
-    output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_prove_di_acquisto_tmp.pdf')
-    outputStream = open(output_name_tmp, "wb")
-    pdf_writer.write(outputStream)
-    outputStream.close()
+    with fase('scrittura'):
+        output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_prove_di_acquisto_tmp.pdf')
+        outputStream = open(output_name_tmp, "wb")
+        pdf_writer.write(outputStream)
+        outputStream.close()
 
-    # Salvo il pdf appena creato dentro a un FileField
-    output_name = f'Missione_{missione.id}_prove_di_acquisto.pdf'
-    outputStream = open(output_name_tmp, "rb")
-    moduli_missione = ModuliMissione.objects.get(missione=missione)
-    moduli_missione.prove_acquisto_file.save(output_name, outputStream)
-    moduli_missione.resoconto_ricevute.save(output_name, outputStream)
+        # Salvo il pdf appena creato dentro a un FileField
+        output_name = f'Missione_{missione.id}_prove_di_acquisto.pdf'
+        outputStream = open(output_name_tmp, "rb")
+        moduli_missione = ModuliMissione.objects.get(missione=missione)
+        moduli_missione.prove_acquisto_file.save(output_name, outputStream)
+        moduli_missione.resoconto_ricevute.save(output_name, outputStream)
 
-    # moduli_missione = ModuliMissione.objects.get(missione=missione)
-    # moduli_missione.resoconto_ricevute.save(output_name, pdf_file)
-    # moduli_missione.save()
+        # moduli_missione = ModuliMissione.objects.get(missione=missione)
+        # moduli_missione.resoconto_ricevute.save(output_name, pdf_file)
+        # moduli_missione.save()
 
-    # Elimino il file temporaneo
-    os.remove(output_name_tmp)
+        # Elimino il file temporaneo
+        os.remove(output_name_tmp)
 
 
 def compila_anticipo(request, id, firma_richiedente, firma_titolare):
@@ -321,10 +316,12 @@ def compila_anticipo(request, id, firma_richiedente, firma_titolare):
     moduli_output_path = os.path.join(settings.MEDIA_ROOT, 'moduli')
 
     input_file = os.path.join(moduli_input_path, 'ModuloAnticipo.docx')
-    document = Document(input_file)
+    with fase('docx'):
+        document = docx.Document(input_file)
     missione = Missione.objects.get(user=request.user, id=id)
     date_richiesta = ModuliMissione.objects.get(missione=missione)
     profile = Profile.objects.get(user=request.user)
+    precarica_riferimenti(missione, profile)
     # trasporto = Trasporto.objects.filter(missione=missione)
     # km_totali = trasporto.filter(mezzo='AUTO').aggregate(Sum('km'))['km__sum'] or 0
     #
@@ -374,33 +371,36 @@ def compila_anticipo(request, id, firma_richiedente, firma_titolare):
     # config.append('che il costo della fattura/ricevuta __________________________ ', ['aa'])
     # config.append('Data richiesta', [date_richiesta.parte_2.strftime('%d/%m/%Y')])
 
-    for k, values, excludes in config:
-        str = ''
-        for par in document.paragraphs:
-            if k in par.text:
-                for s1, s2 in zip_longest(re.sub('_+', '_', par.text).split('_'), values, fillvalue=''):
-                    if s2 != '':
-                        str += f'{s1}__{s2}__'
-                    else:
-                        str += f'{s1}'
-                for r in par.runs:
-                    if len(r.text) > 0:
-                        r.text = ''
-                par.add_run(text=str)
-                break
-
-    inserisci_firme(document, firma_richiedente, firma_titolare)
-
-    output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_anticipo_tmp.docx')
-    output_name = f'Missione_{missione.id}_anticipo.docx'
-    document.save(os.path.join(moduli_output_path, output_name_tmp))
-    # Salvo il docx appena creato dentro a un FileField
-    moduli_missione = ModuliMissione.objects.get(missione=missione)
-    outputStream = open(output_name_tmp, "rb")
-    moduli_missione.anticipo_file.save(output_name, outputStream)
-
-    # Elimino il file temporaneo
-    os.remove(output_name_tmp)
+    with fase('docx'):
+        for k, values, excludes in config:
+            str = ''
+            for par in document.paragraphs:
+                if k in par.text:
+                    for s1, s2 in zip_longest(re.sub('_+', '_', par.text).split('_'), values, fillvalue=''):
+                        if s2 != '':
+                            str += f'{s1}__{s2}__'
+                        else:
+                            str += f'{s1}'
+                    for r in par.runs:
+                        if len(r.text) > 0:
+                            r.text = ''
+                    par.add_run(text=str)
+                    break
+
+    with fase('firme'):
+        inserisci_firme(document, firma_richiedente, firma_titolare)
+
+    with fase('scrittura'):
+        output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_anticipo_tmp.docx')
+        output_name = f'Missione_{missione.id}_anticipo.docx'
+        document.save(os.path.join(moduli_output_path, output_name_tmp))
+        # Salvo il docx appena creato dentro a un FileField
+        moduli_missione = ModuliMissione.objects.get(missione=missione)
+        outputStream = open(output_name_tmp, "rb")
+        moduli_missione.anticipo_file.save(output_name, outputStream)
+
+        # Elimino il file temporaneo
+        os.remove(output_name_tmp)
 
 
 def compila_parte_1(request, id, idR, idT):
@@ -438,6 +438,7 @@ def compila_parte_1(request, id, idR, idT):
     missione = Missione.objects.get(user=request.user, id=id)
     date_richiesta = ModuliMissione.objects.get(missione=missione)
     profile = Profile.objects.get(user=request.user)
+    precarica_riferimenti(missione, profile)
     trasporto = Trasporto.objects.filter(missione=missione)
 
     trasporto_set = set()
@@ -503,49 +504,52 @@ def compila_parte_1(request, id, idR, idT):
         "data_richiesta": date_richiesta.parte_1.strftime('%d/%m/%Y'),
     }
 
-    buffer = io.BytesIO()
-    can = canvas.Canvas(buffer)
-    can.setFont("Times-Roman", 11)
-    # Write values
-    for k, v in coords_dict.items():
-        if k == 'cf':
-            can.setFont('Courier', 18.2)
-            can.drawString(*v, value_dict[k])
-            can.setFont("Times-Roman", 11)
-        else:
-            if value_dict[k] is None:
-                value_dict[k] = ""
-            can.drawString(*v, value_dict[k])
-
-    inserisci_firme_pdf(can, idR, firma_coords_richiedente, idT, firma_coords_titolare)
-
-    can.showPage()
-    can.save()
-    buffer.seek(0)
-    new_pdf = PdfFileReader(buffer)
-
-    # Leggo il file base
-    input = PdfFileReader(open(input_file, "rb"))  # Base file
-    page = input.getPage(0)
-    # Faccio il merge delle modifiche con il file base
-    page.mergePage(new_pdf.getPage(0))
-
-    # Scrivo tutto in un file temporaneo
-    output = PdfFileWriter()
-    output.addPage(page)
-    output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_parte_1_tmp.pdf')
-    outputStream = open(output_name_tmp, "wb")
-    output.write(outputStream)
-    outputStream.close()
-
-    # Salvo il pdf appena creato dentro a un FileField
-    output_name = f'Missione_{missione.id}_parte_1.pdf'
-    outputStream = open(output_name_tmp, "rb")
-    moduli_missione = ModuliMissione.objects.get(missione=missione)
-    moduli_missione.parte_1_file.save(output_name, outputStream)
-
-    # Elimino il file temporaneo
-    os.remove(output_name_tmp)
+    with fase('overlay'):
+        buffer = io.BytesIO()
+        can = canvas.Canvas(buffer)
+        can.setFont("Times-Roman", 11)
+        # Write values
+        for k, v in coords_dict.items():
+            if k == 'cf':
+                can.setFont('Courier', 18.2)
+                can.drawString(*v, value_dict[k])
+                can.setFont("Times-Roman", 11)
+            else:
+                if value_dict[k] is None:
+                    value_dict[k] = ""
+                can.drawString(*v, value_dict[k])
+
+        inserisci_firme_pdf(can, idR, firma_coords_richiedente, idT, firma_coords_titolare)
+
+        can.showPage()
+        can.save()
+        buffer.seek(0)
+        new_pdf = PyPDF2.PdfFileReader(buffer)
+
+    with fase('merge'):
+        # Leggo il file base
+        input = PyPDF2.PdfFileReader(open(input_file, "rb"))  # Base file
+        page = input.getPage(0)
+        # Faccio il merge delle modifiche con il file base
+        page.mergePage(new_pdf.getPage(0))
+
+    with fase('scrittura'):
+        # Scrivo tutto in un file temporaneo
+        output = PyPDF2.PdfFileWriter()
+        output.addPage(page)
+        output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_parte_1_tmp.pdf')
+        outputStream = open(output_name_tmp, "wb")
+        output.write(outputStream)
+        outputStream.close()
+
+        # Salvo il pdf appena creato dentro a un FileField
+        output_name = f'Missione_{missione.id}_parte_1.pdf'
+        outputStream = open(output_name_tmp, "rb")
+        moduli_missione = ModuliMissione.objects.get(missione=missione)
+        moduli_missione.parte_1_file.save(output_name, outputStream)
+
+        # Elimino il file temporaneo
+        os.remove(output_name_tmp)
 
 
 def compila_parte_2(request, id, firma_richiedente, firma_titolare):
@@ -553,10 +557,12 @@ def compila_parte_2(request, id, firma_richiedente, firma_titolare):
     moduli_output_path = os.path.join(settings.MEDIA_ROOT, 'moduli')
 
     input_file = os.path.join(moduli_input_path, 'ModuloMissione_Part2.docx')
-    document = Document(input_file)
+    with fase('docx'):
+        document = docx.Document(input_file)
     missione = Missione.objects.get(user=request.user, id=id)
     date_richiesta = ModuliMissione.objects.get(missione=missione)
     profile = Profile.objects.get(user=request.user)
+    precarica_riferimenti(missione, profile)
     trasporto = Trasporto.objects.filter(missione=missione)
     km_totali = trasporto.filter(mezzo='AUTO').aggregate(Sum('km'))['km__sum'] or 0
 
@@ -595,48 +601,51 @@ def compila_parte_2(request, id, firma_richiedente, firma_titolare):
     # config.append('che il costo della fattura/ricevuta __________________________ ', ['aa'])
     config.append('Data richiesta', [date_richiesta.parte_2.strftime('%d/%m/%Y')])
 
-    for k, values, excludes in config:
-        str = ''
-        for par in document.paragraphs:
-            if k in par.text:
-                for s1, s2 in zip_longest(re.sub('_+', '_', par.text).split('_'), values, fillvalue=''):
-                    if s2 != '':
-                        str += f'{s1}__{s2}__'
-                    else:
-                        str += f'{s1}'
-                for r in par.runs:
-                    if len(r.text) > 0:
-                        r.text = ''
-                par.add_run(text=str)
-                break
-
-    # Tabella `VIAGGIO E TRASPORTO`
-    table = document.tables[0]
-
-    while len(table.rows) <= len(trasporto):
-        row = table.add_row()
-
-    for i, t in enumerate(trasporto, start=1):
-        costo_str = f'{t.costo:.2f} {t.valuta}'
-        if t.valuta != 'EUR':
-            costo_in_euro = money_exchange(t.data, t.valuta, t.costo)
-            costo_str += f' ({costo_in_euro:.2f} EUR)'
-
-        table.cell(i, 0).text = t.data.strftime('%d/%m/%Y')
-        table.cell(i, 1).text = f'da {t.da or ""}'
-        table.cell(i, 2).text = f'a {t.a or ""}'
-        table.cell(i, 3).text = t.mezzo
-        if t.costo == 0:
-            t.tipo_costo = t.tipo_costo or ''
-            t.tipo_costo += ' + ' if t.tipo_costo != '' else ''
-            t.tipo_costo += f'Rimborso km {t.km}'
-        table.cell(i, 4).text = t.tipo_costo or ''
-        table.cell(i, 5).text = costo_str
-        table.rows[i].height = Cm(0.61)
+    with fase('docx'):
+        for k, values, excludes in config:
+            str = ''
+            for par in document.paragraphs:
+                if k in par.text:
+                    for s1, s2 in zip_longest(re.sub('_+', '_', par.text).split('_'), values, fillvalue=''):
+                        if s2 != '':
+                            str += f'{s1}__{s2}__'
+                        else:
+                            str += f'{s1}'
+                    for r in par.runs:
+                        if len(r.text) > 0:
+                            r.text = ''
+                    par.add_run(text=str)
+                    break
+
+    with fase('tabelle'):
+        # Tabella `VIAGGIO E TRASPORTO`
+        table = document.tables[0]
+
+        while len(table.rows) <= len(trasporto):
+            row = table.add_row()
+
+        for i, t in enumerate(trasporto, start=1):
+            costo_str = f'{t.money}'
+            if t.valuta != 'EUR':
+                costo_str += f' ({t.money.in_euro(t.data)})'
+
+            table.cell(i, 0).text = t.data.strftime('%d/%m/%Y')
+            table.cell(i, 1).text = f'da {t.da or ""}'
+            table.cell(i, 2).text = f'a {t.a or ""}'
+            table.cell(i, 3).text = t.mezzo
+            if t.costo == 0:
+                t.tipo_costo = t.tipo_costo or ''
+                t.tipo_costo += ' + ' if t.tipo_costo != '' else ''
+                t.tipo_costo += f'Rimborso km {t.km}'
+            table.cell(i, 4).text = t.tipo_costo or ''
+            table.cell(i, 5).text = costo_str
+            table.rows[i].height = docx_shared.Cm(0.61)
 
     # Recupero delle altre spese dal database
     pernottamenti = Spesa.objects.filter(spesamissione__missione=missione, spesamissione__tipo='PERNOTTAMENTO')
-    pasti = Pasti.objects.filter(missione=missione)
+    # Una riga per ogni pasto con importo, già ordinate per giorno e tipo
+    pasti = Pasto.objects.filter(pasti__missione=missione, importo__isnull=False).exclude(importo=0) \
+        .select_related('pasti').order_by('pasti__data', 'tipo')
     convegni = Spesa.objects.filter(spesamissione__missione=missione, spesamissione__tipo='CONVEGNO')
     altre_spese = Spesa.objects.filter(spesamissione__missione=missione, spesamissione__tipo='ALTRO')
 
@@ -698,48 +707,18 @@ def compila_parte_2(request, id, firma_richiedente, firma_titolare):
     # END: Old json-based version
     ##################################
 
-    # Fill all the remaining tables
-    for index, (key, queryset) in enumerate(spese_dict.items(), start=1):
-        table = document.tables[index]
-
-        total_rows = queryset.count()
-        if key == 'pasto':
-            total_rows = sum(1 for spesa in queryset for j in range(1, 4) if getattr(spesa, f'importo{j}'))
-
-        # while len(table.rows) <= total_rows:
-        #     row = table.add_row()
-
-        row_index = 1
-        for spesa in queryset:
-            if key == 'pasto':
-                for j in range(1, 4):
-                    importo = getattr(spesa, f'importo{j}')
-                    if importo:
-                        valuta = getattr(spesa, f'valuta{j}')
-                        descrizione = getattr(spesa, f'descrizione{j}')
-                        data = spesa.data
-                        costo_str = f'{importo:.2f} {valuta}'
-                        if valuta != 'EUR':
-                            costo_in_euro = money_exchange(data, valuta, importo)
-                            costo_str += f' ({costo_in_euro:.2f} EUR)'
-
-                        if row_index >= len(table.rows):
-                            table.add_row()
-
-                        table.cell(row_index, 0).text = data.strftime('%d/%m/%Y')
-                        table.cell(row_index, 1).text = descrizione if descrizione else ''
-                        table.cell(row_index, 2).text = costo_str
-                        table.rows[row_index].height = Cm(0.61)
-                        row_index += 1
-            else:
-                importo = spesa.importo
-                valuta = spesa.valuta
+    with fase('tabelle'):
+        # Fill all the remaining tables
+        for index, (key, queryset) in enumerate(spese_dict.items(), start=1):
+            table = document.tables[index]
+
+            row_index = 1
+            for spesa in queryset:
                 descrizione = spesa.descrizione
                 data = spesa.data
-                costo_str = f'{importo:.2f} {valuta}'
-                if valuta != 'EUR':
-                    costo_in_euro = money_exchange(data, valuta, importo)
-                    costo_str += f' ({costo_in_euro:.2f} EUR)'
+                costo_str = f'{spesa.money}'
+                if spesa.valuta != 'EUR':
+                    costo_str += f' ({spesa.money.in_euro(data)})'
 
                 if row_index >= len(table.rows):
                     table.add_row()
@@ -747,21 +726,23 @@ def compila_parte_2(request, id, firma_richiedente, firma_titolare):
                 table.cell(row_index, 0).text = data.strftime('%d/%m/%Y')
                 table.cell(row_index, 1).text = descrizione if descrizione else ''
                 table.cell(row_index, 2).text = costo_str
-                table.rows[row_index].height = Cm(0.61)
+                table.rows[row_index].height = docx_shared.Cm(0.61)
                 row_index += 1
 
-    inserisci_firme(document, firma_richiedente, firma_titolare)       # sezione aggiunta firma richiedente e titolare
+    with fase('firme'):
+        inserisci_firme(document, firma_richiedente, firma_titolare)       # sezione aggiunta firma richiedente e titolare
 
-    output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_parte_2_tmp.docx')
-    output_name = f'Missione_{missione.id}_parte_2.docx'
-    document.save(os.path.join(moduli_output_path, output_name_tmp))
-    # Salvo il docx appena creato dentro a un FileField
-    moduli_missione = ModuliMissione.objects.get(missione=missione)
-    outputStream = open(output_name_tmp, "rb")
-    moduli_missione.parte_2_file.save(output_name, outputStream)
+    with fase('scrittura'):
+        output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_parte_2_tmp.docx')
+        output_name = f'Missione_{missione.id}_parte_2.docx'
+        document.save(os.path.join(moduli_output_path, output_name_tmp))
+        # Salvo il docx appena creato dentro a un FileField
+        moduli_missione = ModuliMissione.objects.get(missione=missione)
+        outputStream = open(output_name_tmp, "rb")
+        moduli_missione.parte_2_file.save(output_name, outputStream)
 
-    # Elimino il file temporaneo
-    os.remove(output_name_tmp)
+        # Elimino il file temporaneo
+        os.remove(output_name_tmp)
 
 
 def compila_autorizz_dottorandi(request, id):
@@ -784,6 +765,7 @@ def compila_autorizz_dottorandi(request, id):
     missione = Missione.objects.get(user=request.user, id=id)
     date_richiesta = ModuliMissione.objects.get(missione=missione)
     profile = Profile.objects.get(user=request.user)
+    precarica_riferimenti(missione, profile)
 
     value_dict = {
         'data_richiesta': date_richiesta.dottorandi.strftime('%d/%m/%Y'),
@@ -797,47 +779,50 @@ def compila_autorizz_dottorandi(request, id):
         'motivazione': missione.motivazione,
     }
 
-    buffer = io.BytesIO()
-    can = canvas.Canvas(buffer)
-    can.setFont("Times-Roman", 11)
-    # Write values
-    for k, v in coords_dict.items():
-        if k == 'cf':
-            can.setFont('Courier', 18.2)
-            can.drawString(*v, value_dict[k])
-            can.setFont("Times-Roman", 11)
-        else:
-            if value_dict[k] is None:
-                value_dict[k] = ""
-            can.drawString(*v, value_dict[k])
-
-    can.showPage()
-    can.save()
-    buffer.seek(0)
-    new_pdf = PdfFileReader(buffer)
-
-    # Leggo il file base
-    input = PdfFileReader(open(input_file, "rb"))  # Base file
-    page = input.getPage(0)
-    # Faccio il merge delle modifiche con il file base
-    page.mergePage(new_pdf.getPage(0))
-
-    # Scrivo tutto in un file temporaneo
-    output = PdfFileWriter()
-    output.addPage(page)
-    output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_autoriz_dottorandi_tmp.pdf')
-    outputStream = open(output_name_tmp, "wb")
-    output.write(outputStream)
-    outputStream.close()
-
-    # Salvo il pdf appena creato dentro a un FileField
-    output_name = f'Missione_{missione.id}_autoriz_dottorandi.pdf'
-    outputStream = open(output_name_tmp, "rb")
-    moduli_missione = ModuliMissione.objects.get(missione=missione)
-    moduli_missione.dottorandi_file.save(output_name, outputStream)
-
-    # Elimino il file temporaneo
-    os.remove(output_name_tmp)
+    with fase('overlay'):
+        buffer = io.BytesIO()
+        can = canvas.Canvas(buffer)
+        can.setFont("Times-Roman", 11)
+        # Write values
+        for k, v in coords_dict.items():
+            if k == 'cf':
+                can.setFont('Courier', 18.2)
+                can.drawString(*v, value_dict[k])
+                can.setFont("Times-Roman", 11)
+            else:
+                if value_dict[k] is None:
+                    value_dict[k] = ""
+                can.drawString(*v, value_dict[k])
+
+        can.showPage()
+        can.save()
+        buffer.seek(0)
+        new_pdf = PyPDF2.PdfFileReader(buffer)
+
+    with fase('merge'):
+        # Leggo il file base
+        input = PyPDF2.PdfFileReader(open(input_file, "rb"))  # Base file
+        page = input.getPage(0)
+        # Faccio il merge delle modifiche con il file base
+        page.mergePage(new_pdf.getPage(0))
+
+    with fase('scrittura'):
+        # Scrivo tutto in un file temporaneo
+        output = PyPDF2.PdfFileWriter()
+        output.addPage(page)
+        output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_autoriz_dottorandi_tmp.pdf')
+        outputStream = open(output_name_tmp, "wb")
+        output.write(outputStream)
+        outputStream.close()
+
+        # Salvo il pdf appena creato dentro a un FileField
+        output_name = f'Missione_{missione.id}_autoriz_dottorandi.pdf'
+        outputStream = open(output_name_tmp, "rb")
+        moduli_missione = ModuliMissione.objects.get(missione=missione)
+        moduli_missione.dottorandi_file.save(output_name, outputStream)
+
+        # Elimino il file temporaneo
+        os.remove(output_name_tmp)
 
 
 def set_need_appearances_writer(writer):
@@ -845,9 +830,9 @@ def set_need_appearances_writer(writer):
         catalog = writer._root_object
         # get the AcroForm tree and add "/NeedAppearances attribute
         if "/AcroForm" not in catalog:
-            writer._root_object.update({NameObject("/AcroForm"): IndirectObject(len(writer._objects), 0, writer)})
-        need_appearances = NameObject("/NeedAppearances")
-        writer._root_object["/AcroForm"][need_appearances] = BooleanObject(True)
+            writer._root_object.update({pdf_generic.NameObject("/AcroForm"): pdf_generic.IndirectObject(len(writer._objects), 0, writer)})
+        need_appearances = pdf_generic.NameObject("/NeedAppearances")
+        writer._root_object["/AcroForm"][need_appearances] = pdf_generic.BooleanObject(True)
     except Exception as e:
         print('set_need_appearances_writer() catch : ', repr(e))
 
@@ -860,18 +845,19 @@ def compila_atto_notorio(request, id, firma_richiedente, dichiarazione_check_std
     missione = Missione.objects.get(user=request.user, id=id)
     input_file = os.path.join(moduli_input_path, 'dichiarazione_atto_notorieta.pdf')
     modulo_missione = ModuliMissione.objects.get(missione=missione)
+    precarica_riferimenti(missione)
 
     # open the pdf
     input_stream = open(input_file, "rb")
-    pdf_reader = PdfFileReader(input_stream, strict=False)
+    pdf_reader = PyPDF2.PdfFileReader(input_stream, strict=False)
     if "/AcroForm" in pdf_reader.trailer["/Root"]:
-        pdf_reader.trailer["/Root"]["/AcroForm"].update({NameObject("/NeedAppearances"): BooleanObject(True)})
+        pdf_reader.trailer["/Root"]["/AcroForm"].update({pdf_generic.NameObject("/NeedAppearances"): pdf_generic.BooleanObject(True)})
 
-    pdf_writer = PdfFileWriter()
+    pdf_writer = PyPDF2.PdfFileWriter()
     set_need_appearances_writer(pdf_writer)
     if "/AcroForm" in pdf_writer._root_object:
         # Acro form is form field, set needs appearances to fix printing issues
-        pdf_writer._root_object["/AcroForm"].update({NameObject("/NeedAppearances"): BooleanObject(True)})
+        pdf_writer._root_object["/AcroForm"].update({pdf_generic.NameObject("/NeedAppearances"): pdf_generic.BooleanObject(True)})
 
     dichiarazione = ''
     if dichiarazione_check_std:
@@ -920,39 +906,42 @@ def compila_atto_notorio(request, id, firma_richiedente, dichiarazione_check_std
         '20': f'Modena, {modulo_missione.atto_notorio.strftime("%d/%m/%Y")}',
     }
 
-    pdf_writer.addPage(pdf_reader.getPage(0))
-    page = pdf_writer.getPage(0)
-    pdf_writer.updatePageFormFieldValues(page, data_dict)
-
-    # Sezione firma
-    if firma_richiedente:
-        try:
-            firma_richiedente_img_path = firma_richiedente.img_firma.path
-            firma_pdf = crea_firma_pdf(firma_richiedente_img_path)
-            # Unisci la pagina della firma con il PDF originale
-            page = pdf_writer.getPage(0)
-            page.mergePage(firma_pdf.getPage(0))  # Sovrapponi la pagina della firma
-        except Http404:
-            print(f"Firma del richiedente {firma_richiedente} non trovata.")
-            # TODO error handling should be rethought in the following functions
+    with fase('merge'):
+        pdf_writer.addPage(pdf_reader.getPage(0))
+        page = pdf_writer.getPage(0)
+        pdf_writer.updatePageFormFieldValues(page, data_dict)
+
+    with fase('firme'):
+        # Sezione firma
+        if firma_richiedente:
+            try:
+                firma_richiedente_img_path = firma_richiedente.img_firma.path
+                firma_pdf = crea_firma_pdf(firma_richiedente_img_path)
+                # Unisci la pagina della firma con il PDF originale
+                page = pdf_writer.getPage(0)
+                page.mergePage(firma_pdf.getPage(0))  # Sovrapponi la pagina della firma
+            except Http404:
+                print(f"Firma del richiedente {firma_richiedente} non trovata.")
+                # TODO error handling should be rethought in the following functions
 
     # Disable the fillable fields
     # for j in range(0, len(page['/Annots'])):
     #     writer_annot = page['/Annots'][j].getObject()
     #     writer_annot.update({NameObject("/Ff"): NumberObject(1)})
 
-    output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_atto_notorio_tmp.pdf')
-    outputStream = open(output_name_tmp, "wb")
-    pdf_writer.write(outputStream)
-    outputStream.close()
+    with fase('scrittura'):
+        output_name_tmp = os.path.join(moduli_output_path, f'Missione_{missione.id}_atto_notorio_tmp.pdf')
+        outputStream = open(output_name_tmp, "wb")
+        pdf_writer.write(outputStream)
+        outputStream.close()
 
-    # Salvo il pdf appena creato dentro a un FileField
-    output_name = f'Missione_{missione.id}_atto_notorio.pdf'
-    outputStream = open(output_name_tmp, "rb")
-    modulo_missione.atto_notorio_file.save(output_name, outputStream)
+        # Salvo il pdf appena creato dentro a un FileField
+        output_name = f'Missione_{missione.id}_atto_notorio.pdf'
+        outputStream = open(output_name_tmp, "rb")
+        modulo_missione.atto_notorio_file.save(output_name, outputStream)
 
-    # Elimino il file temporaneo
-    os.remove(output_name_tmp)
+        # Elimino il file temporaneo
+        os.remove(output_name_tmp)
 
 # TODO error handling should be rethought in the following functions
 def inserisci_firme(document, firma_richiedente, firma_titolare):
@@ -997,7 +986,7 @@ def inserisci_firma(firma_img_path, document, str):
                 # ricostruzione del paragrafo con :
                 par.add_run(start_text)     #  il testo prima delle linee
                 par.add_run("__")           #  una parte delle sottolineature prima della firma
-                par.add_run().add_picture(firma_img_path, width=Inches(0.8))        #  l'immagine della firma
+                par.add_run().add_picture(firma_img_path, width=docx_shared.Inches(0.8))        #  l'immagine della firma
                 par.add_run("__")           #  la parte finale delle sottolineature dopo la firma
                 par.add_run(end_text)       # il continuo del testo
             break
@@ -1031,4 +1020,4 @@ def crea_firma_pdf(firma_path, firma_coords=[380, 150], firma_size=(100, 100)):
     can.showPage()
     can.save()
     buffer.seek(0)
-    return PdfFileReader(buffer)
\ No newline at end of file
+    return PyPDF2.PdfFileReader(buffer)
\ No newline at end of file
@@ -0,0 +1,321 @@
+"""
+Dati sintetici per benchmark e prove di carico (`manage.py genera_dati_sintetici`).
+
+A parità di seed e di parametri i dati generati sono gli stessi: tutti i valori vengono da un solo
+random.Random consumato sempre nello stesso ordine. Le chiavi primarie sono assegnate qui a partire dal
+massimo esistente, così bulk_create funziona anche con MySQL, che non restituisce gli id inseriti; per lo
+stesso motivo il comando non va eseguito mentre altri scrivono sulle stesse tabelle.
+bulk_create non invia i signal: profili, struttura fondi e moduli vengono creati esplicitamente, l'indice di
+ricerca e le statistiche vanno ricostruiti dopo con `indici_ricerca` e `aggiorna_statistiche`.
+"""
+import datetime
+import io
+import os
+import random
+import string
+from decimal import Decimal
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from RimborsiApp.models import Automobile, Indirizzo, Missione, ModuliMissione, Pasti, Pasto, Profile, Spesa, \
+    SpesaMissione, Stato, Trasporto
+from RimborsiApp.riferimenti import normalizza_nome, struttura_da_testo
+from RimborsiApp.sequenze import Sequenza
+
+PREFISSO_USERNAME = 'sintetico'
+CARTELLA_FILE = 'sintetici'
+
+NOMI = ('Marco', 'Giulia', 'Luca', 'Francesca', 'Andrea', 'Chiara', 'Matteo', 'Sara', 'Davide', 'Elena',
+        'Simone', 'Martina', 'Federico', 'Alessia', 'Lorenzo', 'Valentina', 'Stefano', 'Silvia', 'Paolo', 'Laura')
+COGNOMI = ('Rossi', 'Bianchi', 'Ferrari', 'Russo', 'Romano', 'Gallo', 'Costa', 'Fontana', 'Conti', 'Esposito',
+           'Ricci', 'Bruno', 'Moretti', 'Marino', 'Greco', 'Barbieri', 'Lombardi', 'Giordano', 'Colombo', 'Mancini')
+QUALIFICHE = (('DOTTORANDO', 30), ('ASSEGNISTA', 15), ('RTDA', 8), ('RTDB', 7), ('RTT', 5), ('RU', 5), ('PA', 12),
+              ('PO', 8), ('PTA', 8), ('STUDENTE', 2))
+STRUTTURE_FONDI = ('Dipartimento di Ingegneria "Enzo Ferrari"', 'AIRI', 'Softech-ICT', 'DIEF - AIRI',
+                   'Centro Softech-ICT', 'Dipartimento di Scienze Fisiche, Informatiche e Matematiche')
+FONDI = ('FAR 2023', 'FAR 2024', 'PRIN 2022', 'PNRR ECOSISTER', 'PNRR FAIR', 'H2020 ELISE', 'HORIZON EUROPE',
+         'Conto terzi', 'Dottorato XXXVIII ciclo', 'Dottorato XXXIX ciclo')
+MOTIVAZIONI = ('Partecipazione a conferenza', 'Riunione di progetto', 'Workshop', 'Collaborazione scientifica',
+               'Scuola estiva', 'Attività di ricerca', 'Presentazione articolo', 'Visita di laboratorio')
+CITTA_ITALIA = ('Roma', 'Milano', 'Bologna', 'Torino', 'Napoli', 'Firenze', 'Padova', 'Pisa', 'Trento', 'Genova',
+                'Venezia', 'Bari', 'Catania', 'Palermo', 'Parma')
+
+# Prefisso del nome dello stato (normalizzato) -> città e valuta locale
+DESTINAZIONI_ESTERE = (
+    ('stati uniti d', ('Boston', 'San Francisco', 'Seattle', 'Chicago'), 'USD'),
+    ('regno unito', ('Londra', 'Cambridge', 'Oxford', 'Edimburgo'), 'GBP'),
+    ('svizzera', ('Zurigo', 'Losanna', 'Basilea'), 'CHF'),
+    ('giappone', ('Tokyo', 'Kyoto', 'Osaka'), 'JPY'),
+    ('cina repubblica', ('Pechino', 'Shanghai'), 'CNY'),
+    ('svezia', ('Stoccolma', 'Goteborg'), 'SEK'),
+    ('francia', ('Lione', 'Nizza', 'Grenoble'), 'EUR'),
+    ('germania', ('Monaco', 'Amburgo', 'Tubinga'), 'EUR'),
+    ('spagna', ('Barcellona', 'Valencia', 'Siviglia'), 'EUR'),
+    ('paesi bassi', ('Amsterdam', 'Delft', 'Eindhoven'), 'EUR'),
+)
+# Unità di valuta locale per un euro, solo per avere importi plausibili
+FATTORI_VALUTA = {'EUR': 1, 'USD': 1.1, 'GBP': 0.86, 'CHF': 0.95, 'JPY': 160, 'CNY': 7.8, 'SEK': 11.5}
+
+DESCRIZIONI_ALTRO = ('Visto', 'Parcheggio', 'Pedaggio autostradale', 'Carburante', 'Assicurazione viaggio',
+                     'Abbonamento trasporto locale', 'Deposito bagagli')
+DESCRIZIONI_CONVEGNO = ('Quota di iscrizione', 'Iscrizione workshop', 'Cena sociale', 'Iscrizione scuola estiva')
+
+
+def _scegli_pesato(rng, coppie):
+    valori, pesi = zip(*coppie)
+    return rng.choices(valori, weights=pesi)[0]
+
+
+def _importo(rng, media, sigma=0.35, valuta='EUR'):
+    """Importo log-normale intorno a media (in euro), convertito a grandi linee nella valuta locale."""
+    valore = rng.lognormvariate(0, sigma) * media * FATTORI_VALUTA.get(valuta, 1)
+    decimali = 0 if valuta == 'JPY' else 2
+    return Decimal(str(round(valore, decimali))).quantize(Decimal('0.01'))
+
+
+def crea_file_scontrini(rng, n_immagini=16, n_pdf=4):
+    """
+    Scrive in MEDIA_ROOT/sintetici un insieme di scontrini (JPEG da fotocamera e PDF scansionati di 1-3 pagine)
+    condivisi da tutte le righe generate. Restituisce i nomi da assegnare ai FileField.
+    """
+    from PIL import Image
+
+    cartella = os.path.join(settings.MEDIA_ROOT, CARTELLA_FILE)
+    os.makedirs(cartella, exist_ok=True)
+
+    def pagina(larghezza, altezza):
+        # Rumore a bassa risoluzione ingrandito: si comprime come una foto e non come un'immagine uniforme
+        piccola = (larghezza // 8, altezza // 8)
+        dati = bytes(rng.getrandbits(8) for _ in range(piccola[0] * piccola[1] * 3))
+        return Image.frombytes('RGB', piccola, dati).resize((larghezza, altezza), Image.BILINEAR)
+
+    nomi = []
+    for i in range(n_immagini):
+        larghezza, altezza = rng.choice(((960, 1280), (1536, 2048), (2448, 3264)))
+        nome = os.path.join(CARTELLA_FILE, f'scontrino_{i:02d}.jpg')
+        pagina(larghezza, altezza).save(os.path.join(settings.MEDIA_ROOT, nome), format='JPEG',
+                                        quality=rng.choice((75, 85, 92)))
+        nomi.append(nome)
+    for i in range(n_pdf):
+        pagine = [pagina(1240, 1754) for _ in range(rng.randint(1, 3))]
+        nome = os.path.join(CARTELLA_FILE, f'ricevuta_{i:02d}.pdf')
+        buffer = io.BytesIO()
+        pagine[0].save(buffer, format='PDF', save_all=True, append_images=pagine[1:], resolution=150)
+        with open(os.path.join(settings.MEDIA_ROOT, nome), 'wb') as f:
+            f.write(buffer.getvalue())
+        nomi.append(nome)
+    return nomi
+
+
+class GeneratoreDati:
+    """
+    Genera n_utenti utenti con profilo e n_missioni missioni ciascuno, con pasti, trasporti, pernottamenti,
+    convegni e altre spese. Le righe sono accumulate e inserite con bulk_create ogni `blocco` missioni.
+    """
+
+    def __init__(self, seed=0, fino_al=None, anni=3, blocco=500, file_scontrini=(), quota_scontrini=0.8):
+        if blocco < 1:
+            raise ValueError('blocco deve essere almeno 1')
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.fino_al = fino_al or datetime.date.today()
+        self.giorni_periodo = anni * 365
+        self.blocco = blocco
+        self.file_scontrini = list(file_scontrini)
+        self.quota_scontrini = quota_scontrini
+
+        self.stati = {normalizza_nome(nome): id for id, nome in Stato.objects.order_by('id').values_list('id', 'nome')}
+        if not self.stati:
+            raise ValueError('Nessuno stato nel db: caricare prima stati e categorie.')
+        self.italia = self.stati.get('italia') or min(self.stati.values())
+        self.estere = []
+        for prefisso, citta, valuta in DESTINAZIONI_ESTERE:
+            id = next((id for nome, id in sorted(self.stati.items()) if nome.startswith(prefisso)), None)
+            if id is not None:
+                self.estere.append((id, citta, valuta))
+
+        Comune = apps.get_model('comuni_italiani', 'Comune')
+        self.comuni = list(Comune.objects.order_by('pk').values_list('pk', 'provincia_id')[:5000])
+        self.strutture = {testo: struttura_da_testo(testo) for testo in STRUTTURE_FONDI}
+
+        self.id = {model: Sequenza(model) for model in (User, Indirizzo, Profile, Automobile, Missione,
+                                                        ModuliMissione, Spesa, SpesaMissione, Pasti, Pasto,
+                                                        Trasporto)}
+        self.righe = {model: [] for model in self.id}
+        self.missioni_in_attesa = 0
+        self.totali = dict.fromkeys((m._meta.verbose_name_plural for m in self.id), 0)
+
+    # -------------------------------------------------------------------------------------------------------------- #
+
+    def aggiungi(self, oggetto):
+        model = type(oggetto)
+        oggetto.pk = self.id[model]()
+        self.righe[model].append(oggetto)
+        return oggetto.pk
+
+    def svuota(self):
+        # Ordine degli inserimenti compatibile con le foreign key
+        with transaction.atomic():
+            for model, righe in self.righe.items():
+                if righe:
+                    # Righe per INSERT scelte da Django (bulk_batch_size): SQLite ne accetta al più 500
+                    model.objects.bulk_create(righe)
+                    self.totali[model._meta.verbose_name_plural] += len(righe)
+        self.righe = {model: [] for model in self.righe}
+        self.missioni_in_attesa = 0
+
+    def scontrino(self):
+        # Consuma sempre due numeri casuali: con o senza file i dati generati restano gli stessi
+        allegato, scelta = self.rng.random() < self.quota_scontrini, self.rng.random()
+        if self.file_scontrini and allegato:
+            return self.file_scontrini[int(scelta * len(self.file_scontrini))]
+        return None
+
+    # -------------------------------------------------------------------------------------------------------------- #
+
+    def genera(self, n_utenti, n_missioni, avanzamento=None):
+        for i in range(n_utenti):
+            user_id = self.utente(i)
+            auto_id = self.automobile(user_id) if self.rng.random() < 0.4 else None
+            for _ in range(n_missioni):
+                self.missione(user_id, auto_id)
+                self.missioni_in_attesa += 1
+                if self.missioni_in_attesa >= self.blocco:
+                    self.svuota()
+                    if avanzamento:
+                        avanzamento(self.totali)
+        self.svuota()
+        return self.totali
+
+    def indirizzo(self):
+        rng = self.rng
+        if self.comuni:
+            comune_id, provincia_id = rng.choice(self.comuni)
+            return self.aggiungi(Indirizzo(via=f'Via {rng.choice(COGNOMI)}', n=str(rng.randint(1, 200)),
+                                           comune_id=comune_id, provincia_id=provincia_id))
+        return self.aggiungi(Indirizzo(via=f'Via {rng.choice(COGNOMI)}', n=str(rng.randint(1, 200)),
+                                       comune_straniero=rng.choice(CITTA_ITALIA), provincia_straniero=''))
+
+    def utente(self, i):
+        rng = self.rng
+        nome, cognome = rng.choice(NOMI), rng.choice(COGNOMI)
+        username = f'{PREFISSO_USERNAME}-{self.seed}-{i}'
+        user_id = self.aggiungi(User(username=username, first_name=nome, last_name=cognome,
+                                     email=f'{username}@example.org', password='!', is_active=True))
+        residenza_id = self.indirizzo()
+        domicilio_id = self.indirizzo()
+        luogo_nascita_id = rng.choice(self.comuni)[0] if self.comuni else None
+        self.aggiungi(Profile(
+            user_id=user_id,
+            data_nascita=datetime.date(rng.randint(1960, 2000), rng.randint(1, 12), rng.randint(1, 28)),
+            luogo_nascita_id=luogo_nascita_id,
+            straniero=luogo_nascita_id is None,
+            luogo_nascita_straniero=None if luogo_nascita_id else 'Estero',
+            sesso=rng.choice('MF'),
+            qualifica=_scegli_pesato(rng, QUALIFICHE),
+            datore_lavoro='UNIMORE',
+            residenza_id=residenza_id,
+            domicilio_id=domicilio_id,
+            telefono=str(rng.randint(2050000, 2059999)),
+            cf=''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16)),
+        ))
+        return user_id
+
+    def automobile(self, user_id):
+        rng = self.rng
+        marca, modello = rng.choice((('Fiat', 'Panda'), ('Volkswagen', 'Golf'), ('Toyota', 'Yaris'),
+                                     ('Renault', 'Clio'), ('Peugeot', '208')))
+        targa = ''.join(rng.choice(string.ascii_uppercase) for _ in range(2)) + str(rng.randint(100, 999)) + \
+            ''.join(rng.choice(string.ascii_uppercase) for _ in range(2))
+        return self.aggiungi(Automobile(user_id=user_id, marca=marca, modello=modello, targa=targa))
+
+    def missione(self, user_id, auto_id):
+        rng = self.rng
+        estera = self.estere and rng.random() < 0.35
+        if estera:
+            stato_id, citta, valuta_locale = rng.choice(self.estere)
+            citta = rng.choice(citta)
+        else:
+            stato_id, citta, valuta_locale = self.italia, rng.choice(CITTA_ITALIA), 'EUR'
+
+        durata = _scegli_pesato(rng, ((1, 30), (2, 25), (3, 20), (4, 12), (5, 8), (7, 4), (14, 1)))
+        inizio = self.fino_al - datetime.timedelta(days=rng.randrange(self.giorni_periodo))
+        fine = inizio + datetime.timedelta(days=durata - 1)
+
+        if estera:
+            mezzo_viaggio = _scegli_pesato(rng, (('AEREO', 85), ('TRENO', 15)))
+        else:
+            mezzo_viaggio = _scegli_pesato(rng, (('TRENO', 55), ('AUTO', 30 if auto_id else 0), ('BUS', 5),
+                                                 ('AEREO', 10)))
+        mezzi = [mezzo_viaggio] + (['TAXI'] if rng.random() < 0.3 else [])
+        struttura_fondi = rng.choice(STRUTTURE_FONDI)
+        struttura = self.strutture[struttura_fondi]
+
+        missione_id = self.aggiungi(Missione(
+            user_id=user_id, citta_destinazione=citta, stato_destinazione_id=stato_id,
+            inizio=inizio, inizio_ora=datetime.time(rng.randint(6, 14), rng.choice((0, 15, 30, 45))),
+            fine=fine, fine_ora=datetime.time(rng.randint(15, 22), rng.choice((0, 15, 30, 45))),
+            fondo=rng.choice(FONDI), motivazione=rng.choice(MOTIVAZIONI), struttura_fondi=struttura_fondi,
+            struttura_id=struttura and struttura.pk, tipo=rng.choice(('RICERCA', 'PROGETTO')),
+            automobile_id=auto_id if mezzo_viaggio == 'AUTO' else None,
+            anticipo=Decimal('0.00') if rng.random() < 0.9 else _importo(rng, 300),
+            mezzi_previsti=str(mezzi),
+            motivazione_automobile=str(['Convenienza economica']) if mezzo_viaggio == 'AUTO' else None,
+            missione_conclusa=fine < self.fino_al - datetime.timedelta(days=30) and rng.random() < 0.9,
+        ))
+        richiesta = inizio - datetime.timedelta(days=rng.randint(1, 30))
+        self.aggiungi(ModuliMissione(missione_id=missione_id, anticipo=richiesta, parte_1=richiesta,
+                                     parte_2=fine + datetime.timedelta(days=rng.randint(1, 20)), kasko=richiesta,
+                                     atto_notorio=fine + datetime.timedelta(days=1), dottorandi=richiesta))
+
+        self.trasporti(missione_id, inizio, fine, mezzo_viaggio, 'TAXI' in mezzi, valuta_locale)
+        self.pasti(missione_id, inizio, durata, valuta_locale)
+        if durata > 1:
+            notti = durata - 1
+            self.spesa(missione_id, 'PERNOTTAMENTO', inizio, _importo(rng, 95 * notti, valuta=valuta_locale),
+                       valuta_locale, f'Hotel {citta}, {notti} notti')
+        if rng.random() < 0.4:
+            valuta = 'EUR' if rng.random() < 0.7 else valuta_locale
+            self.spesa(missione_id, 'CONVEGNO', inizio, _importo(rng, 450, 0.5, valuta), valuta,
+                       rng.choice(DESCRIZIONI_CONVEGNO))
+        if rng.random() < 0.2:
+            self.spesa(missione_id, 'ALTRO', inizio + datetime.timedelta(days=rng.randrange(durata)),
+                       _importo(rng, 30, 0.8, valuta_locale), valuta_locale, rng.choice(DESCRIZIONI_ALTRO))
+
+    def spesa(self, missione_id, tipo, data, importo, valuta, descrizione):
+        spesa_id = self.aggiungi(Spesa(data=data, importo=importo, valuta=valuta, descrizione=descrizione,
+                                       img_scontrino=self.scontrino()))
+        self.aggiungi(SpesaMissione(missione_id=missione_id, spesa_id=spesa_id, tipo=tipo))
+
+    def trasporti(self, missione_id, inizio, fine, mezzo, taxi, valuta_locale):
+        rng = self.rng
+        for data, da, a in ((inizio, 'Modena', 'destinazione'), (fine, 'destinazione', 'Modena')):
+            if mezzo == 'AUTO':
+                self.aggiungi(Trasporto(missione_id=missione_id, data=data, da=da, a=a, mezzo='AUTO',
+                                        costo=Decimal('0.00'), km=round(rng.uniform(40, 450), 1)))
+            else:
+                media = {'AEREO': 220, 'TRENO': 45, 'BUS': 15}[mezzo]
+                self.aggiungi(Trasporto(missione_id=missione_id, data=data, da=da, a=a, mezzo=mezzo,
+                                        tipo_costo='Biglietto', costo=_importo(rng, media, 0.5), valuta='EUR',
+                                        img_scontrino=self.scontrino()))
+        if taxi:
+            self.aggiungi(Trasporto(missione_id=missione_id, data=inizio, da='Stazione/aeroporto', a='Hotel',
+                                    mezzo='TAXI', tipo_costo='Corsa', costo=_importo(rng, 25, 0.4, valuta_locale),
+                                    valuta=valuta_locale, img_scontrino=self.scontrino()))
+
+    def pasti(self, missione_id, inizio, durata, valuta_locale):
+        rng = self.rng
+        for giorno in range(durata):
+            pasti_id = self.aggiungi(Pasti(missione_id=missione_id, data=inizio + datetime.timedelta(days=giorno)))
+            for tipo, probabilita, media in ((1, 0.3, 6), (2, 0.85, 18), (3, 0.85, 28)):
+                if rng.random() < probabilita:
+                    self.aggiungi(Pasto(pasti_id=pasti_id, tipo=tipo, importo=_importo(rng, media, 0.4, valuta_locale),
+                                        valuta=valuta_locale, descrizione='', img_scontrino=self.scontrino()))
+
+
+def elimina_dati_sintetici():
+    """Cancella gli utenti sintetici e, a cascata, tutte le loro missioni. Restituisce il numero di righe eliminate."""
+    return User.objects.filter(username__startswith=f'{PREFISSO_USERNAME}-').delete()[0]
@@ -0,0 +1,198 @@
+import csv
+import datetime
+import io
+import re
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.db.models import Sum
+
+from RimborsiApp.models import TIPO_PASTO_CHOICES, Pasto, SpesaMissione, Trasporto
+from RimborsiApp.money import EUR, money_exchange
+from RimborsiApp.statistiche import CATEGORIE_SPESA, totali_euro
+
+# Missioni lette per blocco: la memoria usata dipende da questo valore e non dalla lunghezza dello storico
+BLOCCO = 500
+
+COLONNE_MISSIONI = ['id', 'cognome', 'nome', 'citta_destinazione', 'stato_destinazione', 'inizio', 'fine', 'fondo',
+                    'struttura_fondi', 'struttura', 'tipo', 'anticipo', 'km_auto'] + \
+                   [f'{c}_eur' for c in CATEGORIE_SPESA] + ['totale_eur']
+COLONNE_SPESE = ['missione', 'data', 'categoria', 'descrizione', 'importo', 'valuta', 'importo_eur']
+
+_CAMPI_MISSIONE = ('id', 'user__last_name', 'user__first_name', 'citta_destinazione', 'stato_destinazione__nome',
+                   'inizio', 'fine', 'fondo', 'struttura_fondi', 'struttura__nome', 'tipo', 'anticipo')
+
+
+def blocchi_missioni(missioni, n=BLOCCO):
+    """
+    Scorre le missioni a blocchi di n in ordine di id con keyset pagination.
+    Con MySQL iterator() scarica comunque tutto il risultato nel client, così invece ogni query è limitata.
+    """
+    ultimo = 0
+    while True:
+        blocco = list(missioni.filter(id__gt=ultimo).order_by('id').values(*_CAMPI_MISSIONE)[:n])
+        if not blocco:
+            return
+        yield blocco
+        ultimo = blocco[-1]['id']
+
+
+def _km_auto(ids):
+    return dict(Trasporto.objects.filter(missione__in=ids, mezzo='AUTO').values('missione')
+                .annotate(km=Sum('km')).order_by().values_list('missione', 'km'))
+
+
+def righe_missioni(missioni):
+    """Una riga per missione con i totali in euro per categoria di spesa."""
+    yield COLONNE_MISSIONI
+    for blocco in blocchi_missioni(missioni):
+        ids = [m['id'] for m in blocco]
+        totali = totali_euro(ids)
+        km = _km_auto(ids)
+        for m in blocco:
+            per_categoria = [totali[m['id']][c] for c in CATEGORIE_SPESA] if m['id'] in totali \
+                else [Decimal('0.00')] * len(CATEGORIE_SPESA)
+            yield [m[c] for c in _CAMPI_MISSIONE] + [km.get(m['id']) or 0.] + per_categoria + [sum(per_categoria)]
+
+
+def _in_euro(data, valuta, importo):
+    if importo is None or not valuta or valuta == EUR:
+        return importo
+    return money_exchange(data, valuta, importo)
+
+
+def righe_spese(missioni):
+    """Una riga per ogni voce di spesa (spese, pasti e trasporti) delle missioni."""
+    tipi_pasto = dict(TIPO_PASTO_CHOICES)
+    yield COLONNE_SPESE
+    for blocco in blocchi_missioni(missioni):
+        ids = [m['id'] for m in blocco]
+        righe = []
+        spese = SpesaMissione.objects.filter(missione__in=ids) \
+            .values_list('missione', 'spesa__data', 'tipo', 'spesa__descrizione', 'spesa__importo', 'spesa__valuta')
+        for missione, data, tipo, descrizione, importo, valuta in spese:
+            righe.append([missione, data, tipo.lower(), descrizione, importo, valuta])
+        pasti = Pasto.objects.filter(pasti__missione__in=ids, importo__isnull=False) \
+            .values_list('pasti__missione', 'pasti__data', 'tipo', 'descrizione', 'importo', 'valuta')
+        for missione, data, tipo, descrizione, importo, valuta in pasti:
+            righe.append([missione, data, tipi_pasto.get(tipo, '').lower(), descrizione, importo, valuta])
+        trasporti = Trasporto.objects.filter(missione__in=ids) \
+            .values_list('missione', 'data', 'mezzo', 'da', 'a', 'costo', 'valuta')
+        for missione, data, mezzo, da, a, costo, valuta in trasporti:
+            righe.append([missione, data, mezzo.lower(), f'{da or ""} - {a or ""}', costo, valuta])
+
+        righe.sort(key=lambda r: (r[0], r[1]))
+        for r in righe:
+            yield r + [_in_euro(r[1], r[5], r[4])]
+
+
+class _Echo:
+    """Oggetto file che restituisce quello che gli viene scritto, per csv.writer in streaming."""
+
+    def write(self, value):
+        return value
+
+
+def csv_stream(righe):
+    writer = csv.writer(_Echo(), delimiter=';')
+    for r in righe:
+        yield writer.writerow(['' if v is None else v for v in r])
+
+
+class _BufferZip(io.RawIOBase):
+    """Stream non posizionabile: zipfile ci scrive sopra e i byte vengono ripresi a ogni riga di foglio."""
+
+    def __init__(self):
+        self._parti = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._parti.append(bytes(b))
+        return len(b)
+
+    def svuota(self):
+        dati = b''.join(self._parti)
+        self._parti = []
+        return dati
+
+
+_XLSX_FILE = {
+    '[Content_Types].xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>',
+    'xl/workbook.xml':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="{foglio}" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    'xl/_rels/workbook.xml.rels':
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>',
+}
+
+# Caratteri di controllo non ammessi in XML 1.0
+_XML_NON_VALIDI = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _cella(v):
+    if v is None:
+        return '<c/>'
+    if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool):
+        return f'<c t="n"><v>{v}</v></c>'
+    if isinstance(v, (datetime.date, datetime.datetime)):
+        v = v.isoformat()
+    testo = escape(_XML_NON_VALIDI.sub('', str(v)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{testo}</t></is></c>'
+
+
+def xlsx_stream(righe, foglio='Dati'):
+    """
+    Scrive un file XLSX minimale (un foglio, stringhe inline, nessuno stile) riga per riga.
+    Lo zip è scritto su uno stream non posizionabile, quindi la memoria resta costante.
+    """
+    buffer = _BufferZip()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for nome, contenuto in _XLSX_FILE.items():
+            zf.writestr(nome, contenuto.replace('{foglio}', escape(foglio)))
+        yield buffer.svuota()
+
+        with zf.open('xl/worksheets/sheet1.xml', mode='w', force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            for r in righe:
+                sheet.write(('<row>' + ''.join(_cella(v) for v in r) + '</row>').encode('utf-8'))
+                dati = buffer.svuota()
+                if dati:
+                    yield dati
+            sheet.write(b'</sheetData></worksheet>')
+    yield buffer.svuota()
+
+
+ESPORTAZIONI = {
+    'missioni': righe_missioni,
+    'spese': righe_spese,
+}
+
+FORMATI = {
+    'csv': (csv_stream, 'text/csv; charset=utf-8'),
+    'xlsx': (xlsx_stream, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
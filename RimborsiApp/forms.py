@@ -1,9 +1,9 @@
-from comuni_italiani import models as comuni_italiani_models
 from crispy_forms.bootstrap import Div, InlineCheckboxes
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Column, Fieldset, Layout, Row, Submit, HTML
 from dal import autocomplete
 from django import forms
+from django.apps import apps
 from django.contrib.auth.forms import UserCreationForm
 from django.forms.models import formset_factory, inlineformset_factory, modelformset_factory
 
@@ -11,11 +11,41 @@ from django.db.models.sql.datastructures import Empty
 from genericpath import exists
 
 from .models import *
-from .widgets import CustomClearableFileInput, PastiCustomClearableFileInput ,FirmeCustomClearableFileInput
+from .riferimenti import CATEGORIE, COMUNI, PROVINCE, STATI, STRUTTURE_FONDI, precarica_riferimenti
+from .widgets import CustomClearableFileInput, PastiCustomClearableFileInput ,FirmeCustomClearableFileInput, \
+    RiferimentoSelect2
 from django.forms import ClearableFileInput
 
 from django.db.models import Q
 
+
+class RiferimentoChoiceIterator(forms.models.ModelChoiceIterator):
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in self.field.tabella.tutti():
+            yield self.choice(obj)
+
+    def __len__(self):
+        return len(self.field.tabella.tutti()) + (1 if self.field.empty_label is not None else 0)
+
+
+class RiferimentoChoiceField(forms.ModelChoiceField):
+    """ModelChoiceField su una tabella di riferimento in cache: né il render né la validazione fanno query."""
+    iterator = RiferimentoChoiceIterator
+
+    def __init__(self, tabella, **kwargs):
+        self.tabella = tabella
+        super().__init__(queryset=apps.get_model(tabella.model).objects.all(), **kwargs)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        riga = self.tabella.cerca(value)
+        if riga is None:
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return riga
+
 class ForeignProfileForm(forms.ModelForm):
     nome = forms.CharField(max_length=30, label='Name')
     cognome = forms.CharField(max_length=30, label='Surname')
@@ -137,27 +167,31 @@ class ProfileForm(forms.ModelForm):
 
     residenza_via = forms.CharField(max_length=100, label='Via')
     residenza_n = forms.CharField(max_length=20, label='Civico')
-    residenza_comune = forms.ModelChoiceField(queryset=comuni_italiani_models.Comune.objects.all(), label='Comune',
-                                              widget=autocomplete.ModelSelect2(url='comune-autocomplete',
+    residenza_comune = RiferimentoChoiceField(COMUNI, label='Comune',
+                                              widget=RiferimentoSelect2(url='RimborsiApp:comune_autocomplete',
                                                                                attrs={'data-html': True,
                                                                                       'data-theme': 'bootstrap4', }))
-    residenza_provincia = forms.ModelChoiceField(queryset=comuni_italiani_models.Provincia.objects.all(),
+    residenza_provincia = RiferimentoChoiceField(PROVINCE,
                                                  label='Provincia',
-                                                 widget=autocomplete.ModelSelect2(url='provincia-autocomplete',
+                                                 widget=RiferimentoSelect2(url='RimborsiApp:provincia_autocomplete',
                                                                                   attrs={'data-html': True,
                                                                                          'data-theme': 'bootstrap4', }))
 
     domicilio_via = forms.CharField(max_length=100, label='Via')
     domicilio_n = forms.CharField(max_length=20, label='Civico')
-    domicilio_comune = forms.ModelChoiceField(queryset=comuni_italiani_models.Comune.objects.all(), label='Comune',
-                                              widget=autocomplete.ModelSelect2(url='comune-autocomplete',
+    domicilio_comune = RiferimentoChoiceField(COMUNI, label='Comune',
+                                              widget=RiferimentoSelect2(url='RimborsiApp:comune_autocomplete',
                                                                                attrs={'data-html': True,
                                                                                       'data-theme': 'bootstrap4', }))
-    domicilio_provincia = forms.ModelChoiceField(queryset=comuni_italiani_models.Provincia.objects.all(),
+    domicilio_provincia = RiferimentoChoiceField(PROVINCE,
                                                  label='Provincia',
-                                                 widget=autocomplete.ModelSelect2(url='provincia-autocomplete',
+                                                 widget=RiferimentoSelect2(url='RimborsiApp:provincia_autocomplete',
                                                                                   attrs={'data-html': True,
                                                                                          'data-theme': 'bootstrap4', }))
+    luogo_nascita = RiferimentoChoiceField(COMUNI, label='Luogo nascita', required=False,
+                                           widget=RiferimentoSelect2(url='RimborsiApp:comune_autocomplete',
+                                                                     attrs={'data-html': True,
+                                                                            'data-theme': 'bootstrap4', }))
 
     class Meta:
         model = Profile
@@ -168,8 +202,6 @@ class ProfileForm(forms.ModelForm):
             'data_fine_rapporto': forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
             'tutor': forms.TextInput(attrs={'placeholder': 'Prof/Prof.ssa'}),
             'anno_dottorato': forms.NumberInput(attrs={'placeholder': '1, 2, 3'}),
-            'luogo_nascita': autocomplete.ModelSelect2(url='comune-autocomplete',
-                                                       attrs={'data-html': True, 'data-theme': 'bootstrap4', }),
         }
         labels = {
             'data_nascita': 'Data di nascita',
@@ -184,6 +216,7 @@ class ProfileForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super(ProfileForm, self).__init__(*args, **kwargs)
+        precarica_riferimenti(profile=self.instance)
         self.fields['nome'].initial = self.instance.user.first_name
         self.fields['cognome'].initial = self.instance.user.last_name
         self.fields['cf'].initial = self.instance.cf
@@ -253,6 +286,7 @@ class ProfileForm(forms.ModelForm):
 
 
 class MissioneForm(forms.ModelForm):
+    stato_destinazione = RiferimentoChoiceField(STATI, label='Stato di destinazione')
     mezzi_previsti = forms.MultipleChoiceField(choices=MEZZO_CHOICES, required=False)
     automobile = forms.ModelChoiceField(queryset=None, empty_label="---", required=False)
     motivazione_automobile = forms.MultipleChoiceField(choices=MOTIVAZIONE_AUTO_CHOICES, required=False,
@@ -273,7 +307,6 @@ class MissioneForm(forms.ModelForm):
         }
 
         labels = {
-            'stato_destinazione': 'Stato di destinazione',
             'citta_destinazione': 'Città di destinazione',
             'mezzi_previsti': 'Mezzi',
             'automobile_altrui': 'Proprietario auto',
@@ -382,40 +415,50 @@ class MissioneForm(forms.ModelForm):
 
 
 class PastiForm(forms.ModelForm):
+    # Una card per giorno. I campi importoN/valutaN/descrizioneN/img_scontrinoN non sono colonne di Pasti:
+    # vengono letti e scritti sulle voci Pasto del giorno, con N uguale al tipo di pasto (1 colazione, 2 pranzo, 3 cena).
     class Meta:
         model = Pasti
-        fields = '__all__'
+        fields = ('data',)
         widgets = {
             'data': forms.DateInput(attrs={'type': 'date', 'class': 'form-control form-control-sm'}),
-            'importo1': forms.NumberInput(attrs={'class': 'form-control form-control-sm'}),
-            'valuta1': forms.Select(attrs={'class': 'form-control form-control-sm'}),
-            'descrizione1': forms.TextInput(attrs={'class': 'form-control form-control-sm'}),
-            'img_scontrino1': PastiCustomClearableFileInput(attrs={'class': 'form-control form-control-sm'}),
-            'importo2': forms.NumberInput(attrs={'class': 'form-control form-control-sm'}),
-            'valuta2': forms.Select(attrs={'class': 'form-control form-control-sm'}),
-            'descrizione2': forms.TextInput(attrs={'class': 'form-control form-control-sm'}),
-            'img_scontrino2': PastiCustomClearableFileInput(attrs={'class': 'form-control form-control-sm'}),
-            'importo3': forms.NumberInput(attrs={'class': 'form-control form-control-sm'}),
-            'valuta3': forms.Select(attrs={'class': 'form-control form-control-sm'}),
-            'descrizione3': forms.TextInput(attrs={'class': 'form-control form-control-sm'}),
-            'img_scontrino3': PastiCustomClearableFileInput(attrs={'class': 'form-control form-control-sm'}),
         }
         labels = {
             'data': 'Data',
-            'importo1': 'Importo',
-            'valuta1': 'Valuta',
-            'descrizione1': 'Descrizione',
-            'img_scontrino1': 'Immagine Scontrino',
-            'importo2': 'Importo',
-            'valuta2': 'Valuta',
-            'descrizione2': 'Descrizione',
-            'img_scontrino2': 'Immagine Scontrino',
-            'importo3': 'Importo',
-            'valuta3': 'Valuta',
-            'descrizione3': 'Descrizione',
-            'img_scontrino3': 'Immagine Scontrino',
         }
 
+    def __init__(self, *args, **kwargs):
+        super(PastiForm, self).__init__(*args, **kwargs)
+        voci = {}
+        if self.instance.pk:
+            # Usa la cache di prefetch_related('voci') quando disponibile
+            voci = {v.tipo: v for v in self.instance.voci.all()}
+
+        for tipo, _ in TIPO_PASTO_CHOICES:
+            voce = voci.get(tipo)
+            self.fields[f'importo{tipo}'] = forms.DecimalField(
+                max_digits=10, decimal_places=2, required=False, label='Importo', initial=voce and voce.importo,
+                widget=forms.NumberInput(attrs={'class': 'form-control form-control-sm'}))
+            self.fields[f'valuta{tipo}'] = forms.ChoiceField(
+                choices=VALUTA_CHOICES, required=False, label='Valuta', initial=(voce and voce.valuta) or 'EUR',
+                widget=forms.Select(attrs={'class': 'form-control form-control-sm'}))
+            self.fields[f'descrizione{tipo}'] = forms.CharField(
+                max_length=255, required=False, label='Descrizione', initial=voce and voce.descrizione,
+                widget=forms.TextInput(attrs={'class': 'form-control form-control-sm'}))
+            self.fields[f'img_scontrino{tipo}'] = forms.FileField(
+                required=False, label='Immagine Scontrino', initial=voce and voce.img_scontrino,
+                widget=PastiCustomClearableFileInput(attrs={'class': 'form-control form-control-sm'}))
+
+    def _save_m2m(self):
+        # Chiamato da save() sia con commit=True che tramite save_m2m(): salva le voci dopo il giorno
+        super(PastiForm, self)._save_m2m()
+        for tipo, _ in TIPO_PASTO_CHOICES:
+            self.instance.aggiorna_voce(tipo,
+                                        self.cleaned_data.get(f'importo{tipo}'),
+                                        self.cleaned_data.get(f'valuta{tipo}'),
+                                        self.cleaned_data.get(f'descrizione{tipo}'),
+                                        self.cleaned_data.get(f'img_scontrino{tipo}'))
+
 
 class SpesaForm(forms.ModelForm):
     class Meta:
@@ -801,6 +844,39 @@ class Firme_Shared_ChooseForm(forms.ModelForm):
             else :
                 self.fields['firma_titolare'].empty_label = 'Nessuna firma condivisa'
 
+
+class FiltroStatisticheForm(forms.Form):
+    """Filtri della pagina/API statistiche. Le date sono mesi perché la tabella dei fatti è mensile."""
+    dal = forms.DateField(required=False, input_formats=['%Y-%m'], label='Dal mese',
+                          widget=forms.DateInput(attrs={'type': 'month'}, format='%Y-%m'))
+    al = forms.DateField(required=False, input_formats=['%Y-%m'], label='Al mese',
+                         widget=forms.DateInput(attrs={'type': 'month'}, format='%Y-%m'))
+    struttura = RiferimentoChoiceField(STRUTTURE_FONDI, required=False, label='Struttura fondi')
+    fondo = forms.CharField(max_length=100, required=False)
+    tipo = forms.ChoiceField(choices=(('', '---------'),) + TIPO_MISSIONE_CHOICES, required=False,
+                             label='Tipologia')
+    categoria = RiferimentoChoiceField(CATEGORIE, required=False, label='Categoria destinazione')
+
+    def clean(self):
+        cleaned_data = super(FiltroStatisticheForm, self).clean()
+        dal = cleaned_data.get('dal')
+        al = cleaned_data.get('al')
+        if dal and al and al < dal:
+            raise forms.ValidationError("Il mese di inizio deve essere antecedente a quello di fine.")
+        return cleaned_data
+
+    def __init__(self, *args, **kwargs):
+        super(FiltroStatisticheForm, self).__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_method = 'get'
+        self.helper.add_input(Submit('submit', 'Filtra'))
+        self.helper.layout = Layout(
+            Row(Div('dal', css_class="col-lg-2 col-sm-6"), Div('al', css_class="col-lg-2 col-sm-6"),
+                Div('struttura', css_class="col-lg-2 col-sm-6"), Div('fondo', css_class="col-lg-2 col-sm-6"),
+                Div('tipo', css_class="col-lg-2 col-sm-6"), Div('categoria', css_class="col-lg-2 col-sm-6")),
+        )
+
+
 #---------------------------- fromsets ----------------------------#
 
 automobile_formset = inlineformset_factory(User, Automobile, AutomobileForm, extra=0, can_delete=True,
@@ -0,0 +1,99 @@
+import time
+import uuid
+
+from django.core.cache import cache
+
+from RimborsiApp.riferimenti import VERIFICA_VERSIONE_SECONDI
+
+# Chiave di sessione in cui vengono salvati i gruppi dell'utente autenticato
+SESSION_KEY = 'gruppi_utente'
+# Anche senza invalidazione esplicita i gruppi in sessione vengono riletti dopo questo intervallo
+SESSION_TTL = 5 * 60
+
+# Versioni nella cache condivisa (CACHES in settings), così un'invalidazione fatta da un worker vale per tutti.
+# Sono valori casuali e non contatori: se una chiave sparisce dalla cache ne viene creata una nuova, diversa da
+# tutte quelle salvate nelle sessioni, invece di ripartire da un valore già usato.
+# Come per le tabelle di riferimento, ogni processo rilegge una versione al più ogni VERIFICA_VERSIONE_SECONDI:
+# le richieste in mezzo non toccano la cache condivisa (con DatabaseCache, il db), e un'invalidazione fatta da un
+# altro worker arriva entro quell'intervallo.
+_VERSIONE_GLOBALE = 'gruppi_versione'
+_VERSIONE_UTENTE = 'gruppi_versione_{}'
+
+# chiave -> (versione, time.monotonic() della lettura); svuotato quando supera MAX_VERSIONI_LETTE chiavi
+_versioni_lette = {}
+MAX_VERSIONI_LETTE = 10000
+
+
+def _versioni(user_id):
+    chiavi = [_VERSIONE_GLOBALE, _VERSIONE_UTENTE.format(user_id)]
+    adesso = time.monotonic()
+    versioni = {}
+    for chiave in chiavi:
+        letta = _versioni_lette.get(chiave)
+        if letta is not None and adesso - letta[1] < VERIFICA_VERSIONE_SECONDI:
+            versioni[chiave] = letta[0]
+
+    da_leggere = [chiave for chiave in chiavi if chiave not in versioni]
+    if da_leggere:
+        lette = cache.get_many(da_leggere)
+        mancanti = {chiave: uuid.uuid4().hex for chiave in da_leggere if chiave not in lette}
+        if mancanti:
+            cache.set_many(mancanti, None)
+            lette.update(mancanti)
+        if len(_versioni_lette) > MAX_VERSIONI_LETTE:
+            _versioni_lette.clear()
+        for chiave, versione in lette.items():
+            _versioni_lette[chiave] = (versione, adesso)
+        versioni.update(lette)
+    return [versioni[chiave] for chiave in chiavi]
+
+
+def invalida_gruppi_utente(user_id=None):
+    """Invalida i gruppi salvati in sessione di un utente, o di tutti gli utenti se user_id è None."""
+    chiave = _VERSIONE_GLOBALE if user_id is None else _VERSIONE_UTENTE.format(user_id)
+    versione = uuid.uuid4().hex
+    cache.set(chiave, versione, None)
+    # Il processo che fa la modifica la vede subito
+    _versioni_lette[chiave] = (versione, time.monotonic())
+
+
+def gruppi_utente(user):
+    """
+    Restituisce i nomi dei gruppi dell'utente come frozenset.
+    Il risultato è memorizzato sull'oggetto user, quindi ogni richiesta fa al più una query.
+    """
+    if not user.is_authenticated:
+        return frozenset()
+    gruppi = getattr(user, '_gruppi', None)
+    if gruppi is None:
+        gruppi = frozenset(user.groups.values_list('name', flat=True))
+        user._gruppi = gruppi
+    return gruppi
+
+
+def ha_gruppo(user, nome):
+    return nome in gruppi_utente(user)
+
+
+def carica_da_sessione(request):
+    """Se la sessione contiene i gruppi ancora validi li assegna a request.user evitando la query."""
+    salvati = request.session.get(SESSION_KEY)
+    if not salvati or salvati.get('user') != request.user.pk or salvati.get('scadenza', 0) < time.time():
+        return
+    if salvati.get('versioni') != _versioni(request.user.pk):
+        return
+    request.user._gruppi = frozenset(salvati['gruppi'])
+    request._gruppi_da_sessione = True
+
+
+def salva_in_sessione(request):
+    """Salva in sessione i gruppi calcolati durante la richiesta, se non arrivavano già da lì."""
+    gruppi = getattr(request.user, '_gruppi', None)
+    if gruppi is None or getattr(request, '_gruppi_da_sessione', False):
+        return
+    request.session[SESSION_KEY] = {
+        'user': request.user.pk,
+        'gruppi': sorted(gruppi),
+        'versioni': _versioni(request.user.pk),
+        'scadenza': time.time() + SESSION_TTL,
+    }
@@ -0,0 +1,270 @@
+"""
+Caricamento in blocco delle tabelle di riferimento dai file del repository: stati e categorie di diaria
+(stati_categorie.csv) e regioni, province e comuni (DatiComuniProvince.xlsx), con `manage.py importa_stati` e
+`manage.py importa_comuni`.
+
+I file sono letti in streaming (il foglio xlsx con iterparse, senza openpyxl) e confrontati con le righe
+presenti: vengono inserite le righe nuove e aggiornate solo quelle cambiate, con bulk_create/bulk_update in
+transazioni brevi da BLOCCO righe, così le tabelle non restano bloccate per tutto il caricamento. Le righe del
+db assenti dal file vengono solo segnalate: sono referenziate da missioni e profili.
+bulk_create e bulk_update non inviano i signal, quindi le cache di riferimenti.py vengono invalidate qui.
+"""
+import csv
+import zipfile
+from xml.etree import ElementTree
+
+from django.apps import apps
+from django.db import transaction
+
+from RimborsiApp.riferimenti import CATEGORIE, COMUNI, PROVINCE, STATI
+
+BLOCCO = 500
+
+_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_NS_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+# Colonne del foglio Province (senza intestazione, formato delle ripartizioni ISTAT)
+PROVINCE_CODICE_REGIONE, PROVINCE_NOME_REGIONE = 5, 9
+PROVINCE_CODICE, PROVINCE_NOME, PROVINCE_SIGLA = 10, 14, 15
+
+
+class ErroreFile(Exception):
+    pass
+
+
+class Differenze:
+    """Righe del file confrontate con quelle del db per un model."""
+
+    def __init__(self, model, chiave):
+        self.model = model
+        self.chiave = chiave
+        self.nuove = []  # istanze da inserire
+        self.modificate = []  # (istanza aggiornata, {campo: (prima, dopo)})
+        self.assenti = []  # chiavi presenti nel db ma non nel file
+        self.invariate = 0
+
+    @property
+    def campi_modificati(self):
+        return sorted({campo for _, cambi in self.modificate for campo in cambi})
+
+    def __bool__(self):
+        return bool(self.nuove or self.modificate)
+
+
+def confronta(model, chiave, righe):
+    """
+    righe: {valore della chiave: {campo: valore}} letto dal file.
+    Restituisce le Differenze con le istanze già pronte per bulk_create/bulk_update.
+    """
+    campi = sorted({campo for valori in righe.values() for campo in valori})
+    differenze = Differenze(model, chiave)
+    esistenti = {getattr(istanza, chiave): istanza for istanza in model.objects.only(chiave, *campi)}
+    for valore_chiave, valori in righe.items():
+        istanza = esistenti.pop(valore_chiave, None)
+        if istanza is None:
+            differenze.nuove.append(model(**{chiave: valore_chiave}, **valori))
+            continue
+        cambi = {campo: (getattr(istanza, campo), valore) for campo, valore in valori.items()
+                 if getattr(istanza, campo) != valore}
+        if cambi:
+            for campo, (_, valore) in cambi.items():
+                setattr(istanza, campo, valore)
+            differenze.modificate.append((istanza, cambi))
+        else:
+            differenze.invariate += 1
+    differenze.assenti = sorted(esistenti)
+    return differenze
+
+
+def applica(differenze, blocco=BLOCCO):
+    """Scrive nuove righe e modifiche a blocchi, una transazione per blocco."""
+    model = differenze.model
+    for i in range(0, len(differenze.nuove), blocco):
+        with transaction.atomic():
+            model.objects.bulk_create(differenze.nuove[i:i + blocco])
+    campi = differenze.campi_modificati
+    modificate = [istanza for istanza, _ in differenze.modificate]
+    for i in range(0, len(modificate), blocco):
+        with transaction.atomic():
+            model.objects.bulk_update(modificate[i:i + blocco], campi)
+
+
+def _intero(valore):
+    if valore in (None, '', '-'):
+        return None
+    return int(float(valore))
+
+
+# Stati
+
+def leggi_stati(percorso):
+    """Righe (id, nome, categoria) di stati_categorie.csv."""
+    with open(percorso, newline='', encoding='utf-8') as f:
+        for numero, riga in enumerate(csv.reader(f), 1):
+            if not riga:
+                continue
+            try:
+                id, nome, categoria = riga
+                yield int(id), nome.strip(), categoria.strip()
+            except ValueError:
+                raise ErroreFile(f'{percorso}, riga {numero}: attese le colonne id,nome,categoria: {riga!r}')
+
+
+def confronta_stati(percorso):
+    """
+    Differenze tra il csv e la tabella Stato; la categoria del file è il nome di una Categoria, che deve già
+    esistere (i massimali non sono nel file).
+    """
+    categorie = {c.nome: c.id for c in apps.get_model('RimborsiApp.Categoria').objects.all()}
+    righe, mancanti = {}, set()
+    for id, nome, categoria in leggi_stati(percorso):
+        if categoria not in categorie:
+            mancanti.add(categoria)
+            continue
+        righe[id] = {'nome': nome, 'categoria_id': categorie[categoria]}
+    if mancanti:
+        raise ErroreFile(f'Categorie non presenti nel db: {", ".join(sorted(mancanti))}')
+    return [confronta(apps.get_model('RimborsiApp.Stato'), 'id', righe)]
+
+
+def invalida_stati():
+    CATEGORIE.invalida()
+    STATI.invalida()
+
+
+# Comuni e province
+
+class FoglioXlsx:
+    """Lettura in streaming dei fogli di un file xlsx, con solo la libreria standard."""
+
+    def __init__(self, percorso):
+        try:
+            self.zip = zipfile.ZipFile(percorso)
+        except zipfile.BadZipFile:
+            raise ErroreFile(f'{percorso} non è un file xlsx')
+        self._stringhe = None
+
+    def fogli(self):
+        """Nome del foglio -> percorso nel file zip."""
+        workbook = ElementTree.fromstring(self.zip.read('xl/workbook.xml'))
+        relazioni = ElementTree.fromstring(self.zip.read('xl/_rels/workbook.xml.rels'))
+        destinazioni = {r.get('Id'): r.get('Target') for r in relazioni}
+        fogli = {}
+        for foglio in workbook.iter(_NS + 'sheet'):
+            destinazione = destinazioni[foglio.get(_NS_REL + 'id')]
+            fogli[foglio.get('name')] = destinazione.lstrip('/') if destinazione.startswith('/xl/') \
+                else 'xl/' + destinazione
+        return fogli
+
+    @property
+    def stringhe(self):
+        if self._stringhe is None:
+            self._stringhe = []
+            if 'xl/sharedStrings.xml' in self.zip.namelist():
+                with self.zip.open('xl/sharedStrings.xml') as f:
+                    for _, elemento in ElementTree.iterparse(f):
+                        if elemento.tag == _NS + 'si':
+                            self._stringhe.append(''.join(t.text or '' for t in elemento.iter(_NS + 't')))
+                            elemento.clear()
+        return self._stringhe
+
+    @staticmethod
+    def _colonna(riferimento):
+        n = 0
+        for carattere in riferimento:
+            if not carattere.isalpha():
+                break
+            n = n * 26 + ord(carattere.upper()) - ord('A') + 1
+        return n - 1
+
+    def righe(self, nome):
+        """Righe del foglio come liste di stringhe (None per le celle vuote)."""
+        fogli = self.fogli()
+        if nome not in fogli:
+            raise ErroreFile(f'Foglio {nome} non trovato (fogli: {", ".join(fogli)})')
+        with self.zip.open(fogli[nome]) as f:
+            for _, elemento in ElementTree.iterparse(f):
+                if elemento.tag != _NS + 'row':
+                    continue
+                celle = {}
+                for cella in elemento.iter(_NS + 'c'):
+                    tipo, valore = cella.get('t'), cella.find(_NS + 'v')
+                    if tipo == 'inlineStr':
+                        celle[self._colonna(cella.get('r'))] = ''.join(t.text or '' for t in cella.iter(_NS + 't'))
+                    elif valore is not None:
+                        celle[self._colonna(cella.get('r'))] = \
+                            self.stringhe[int(valore.text)] if tipo == 's' else valore.text
+                elemento.clear()
+                yield [celle.get(i) for i in range(max(celle) + 1)] if celle else []
+
+
+def confronta_comuni(percorso):
+    """Differenze per Regione, Provincia e Comune; i comuni sono collegati alla provincia tramite la sigla."""
+    xlsx = FoglioXlsx(percorso)
+    Regione = apps.get_model('comuni_italiani.Regione')
+    Provincia = apps.get_model('comuni_italiani.Provincia')
+    Comune = apps.get_model('comuni_italiani.Comune')
+
+    regioni, province = {}, {}
+    for riga in xlsx.righe('Province'):
+        if len(riga) <= PROVINCE_SIGLA or _intero(riga[PROVINCE_CODICE]) is None:
+            continue
+        codice_regione = _intero(riga[PROVINCE_CODICE_REGIONE])
+        regioni[codice_regione] = {'name': riga[PROVINCE_NOME_REGIONE]}
+        province[_intero(riga[PROVINCE_CODICE])] = {'name': riga[PROVINCE_NOME], 'codice_targa': riga[PROVINCE_SIGLA],
+                                                    'regione_id': codice_regione}
+
+    # Sigle dal file, poi dal db per le province che il file non contiene
+    province_per_sigla = {valori['codice_targa']: codice for codice, valori in province.items()}
+    for codice, sigla in Provincia.objects.values_list('codice_provincia', 'codice_targa'):
+        province_per_sigla.setdefault(sigla, codice)
+
+    righe = xlsx.righe('Comuni')
+    intestazione = next(righe, None)
+    attese = ('stat', 'Comune', 'Provincia', 'CodFisco', 'Abitanti')
+    if not intestazione or any(colonna not in intestazione for colonna in attese):
+        raise ErroreFile(f'Il foglio Comuni deve avere le colonne {", ".join(attese)}')
+    indice = {colonna: intestazione.index(colonna) for colonna in attese}
+    comuni, sigle_sconosciute = {}, set()
+    for riga in righe:
+        riga = riga + [None] * (len(intestazione) - len(riga))
+        codice_istat = _intero(riga[indice['stat']])
+        if codice_istat is None:
+            continue
+        sigla = riga[indice['Provincia']]
+        if sigla not in province_per_sigla:
+            sigle_sconosciute.add(sigla)
+            continue
+        comuni[codice_istat] = {'name': riga[indice['Comune']], 'provincia_id': province_per_sigla[sigla],
+                                'codice_catastale': riga[indice['CodFisco']],
+                                'popolazione': _intero(riga[indice['Abitanti']])}
+    if sigle_sconosciute:
+        raise ErroreFile(f'Comuni con sigla di provincia sconosciuta: {", ".join(sorted(map(str, sigle_sconosciute)))}')
+
+    return [
+        confronta(Regione, 'codice_regione', regioni),
+        confronta(Provincia, 'codice_provincia', province),
+        confronta(Comune, 'codice_istat', comuni),
+    ]
+
+
+def invalida_comuni():
+    PROVINCE.invalida()
+    COMUNI.invalida()
+
+
+def descrivi(differenze, dettagli=10):
+    """Righe di testo con il riepilogo delle differenze e i primi `dettagli` esempi per tipo."""
+    nome = differenze.model._meta.verbose_name_plural
+    righe = [f'{nome}: {len(differenze.nuove)} nuove, {len(differenze.modificate)} modificate, '
+             f'{differenze.invariate} invariate, {len(differenze.assenti)} assenti dal file']
+    for istanza in differenze.nuove[:dettagli]:
+        # Non str(istanza): per Provincia e Comune legge la riga padre, che con il db vuoto non esiste ancora
+        nome = getattr(istanza, 'name', None) or getattr(istanza, 'nome', '')
+        righe.append(f'  + {getattr(istanza, differenze.chiave)}: {nome}')
+    for istanza, cambi in differenze.modificate[:dettagli]:
+        testo = ', '.join(f'{campo}: {prima!r} -> {dopo!r}' for campo, (prima, dopo) in cambi.items())
+        righe.append(f'  ~ {istanza.pk}: {testo}')
+    for chiave in differenze.assenti[:dettagli]:
+        righe.append(f'  - {chiave}')
+    return righe
@@ -0,0 +1,65 @@
+"""
+Librerie pesanti per documenti, immagini e HTTP (PyPDF2, reportlab, python-docx, PIL, requests), importate al
+primo uso invece che all'avvio del worker: chi serve solo liste e card non le carica mai.
+
+Si usano come i moduli veri (`librerie.canvas.Canvas(...)`, `librerie.Image.open(...)`); il primo accesso a un
+attributo importa il modulo. Il tempo del primo import resta in `tempi_import`, per `manage.py tempi_avvio`.
+"""
+import importlib
+import sys
+import threading
+import time
+
+_lock = threading.RLock()
+_dopo_import = {}  # modulo -> funzioni da chiamare una volta dopo l'import
+tempi_import = {}  # modulo -> ms del primo import fatto da qui
+
+
+def carica(nome):
+    """Importa il modulo (se serve) ed esegue le funzioni registrate con dopo_import."""
+    modulo = sys.modules.get(nome)
+    if modulo is not None and nome not in _dopo_import:
+        return modulo
+    with _lock:
+        if nome not in sys.modules:
+            inizio = time.perf_counter()
+            importlib.import_module(nome)
+            tempi_import[nome] = (time.perf_counter() - inizio) * 1000
+        for funzione in _dopo_import.pop(nome, ()):
+            funzione(sys.modules[nome])
+        return sys.modules[nome]
+
+
+def dopo_import(nome, funzione):
+    """Chiama funzione(modulo) appena il modulo viene importato; subito, se lo è già."""
+    with _lock:
+        if nome in sys.modules:
+            funzione(sys.modules[nome])
+        else:
+            _dopo_import.setdefault(nome, []).append(funzione)
+
+
+class ModuloPigro:
+    """Segnaposto di un modulo, importato al primo accesso a un suo attributo."""
+
+    def __init__(self, nome):
+        self.__dict__['_nome'] = nome
+
+    def __getattr__(self, attributo):
+        return getattr(carica(self._nome), attributo)
+
+    def __repr__(self):
+        stato = 'caricato' if self._nome in sys.modules else 'non caricato'
+        return f'<ModuloPigro {self._nome} ({stato})>'
+
+
+PyPDF2 = ModuloPigro('PyPDF2')
+pdf_generic = ModuloPigro('PyPDF2.generic')
+docx = ModuloPigro('docx')
+docx_shared = ModuloPigro('docx.shared')
+canvas = ModuloPigro('reportlab.pdfgen.canvas')
+pagesizes = ModuloPigro('reportlab.lib.pagesizes')
+Image = ModuloPigro('PIL.Image')
+requests = ModuloPigro('requests')
+
+PESANTI = ('PyPDF2', 'docx', 'reportlab', 'PIL', 'bs4', 'requests')
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from RimborsiApp.statistiche import aggiorna_statistiche
+
+
+class Command(BaseCommand):
+    help = 'Ricalcola la tabella StatisticaMissioni usata dalla pagina statistiche (da eseguire ogni notte da cron).'
+
+    def handle(self, *args, **options):
+        n = aggiorna_statistiche()
+        self.stdout.write(self.style.SUCCESS(f'Statistiche aggiornate: {n} righe.'))
@@ -0,0 +1,60 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from RimborsiApp.benchmark import Benchmark, confronta, rapporto
+from RimborsiApp.dati_sintetici import PREFISSO_USERNAME
+from RimborsiApp.models import Missione
+from RimborsiApp.servizi_locali import servizi_locali
+
+
+class Command(BaseCommand):
+    help = 'Misura latenza, query e memoria delle viste principali e dei generatori di moduli, ' \
+           'con i servizi esterni sostituiti da servizi locali. Scrive i risultati in JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='File JSON dei risultati (default: stdout)')
+        parser.add_argument('--ripetizioni', type=int, default=10)
+        parser.add_argument('--missione', type=int, help='Id della missione (default: la più recente del primo '
+                                                          'utente sintetico)')
+        parser.add_argument('--caso', action='append', help='Esegue solo questo caso (ripetibile)')
+        parser.add_argument('--ritardo-servizi', type=int, default=0, help='Latenza dei servizi locali in ms')
+        parser.add_argument('--confronta', help='Rapporto JSON precedente con cui confrontare le mediane')
+        parser.add_argument('--soglia', type=float, default=0.1, help='Peggioramento oltre cui segnalare (0.1 = 10%%)')
+
+    def handle(self, *args, **options):
+        if options['missione']:
+            missione = Missione.objects.filter(id=options['missione']).select_related('user').first()
+        else:
+            user = User.objects.filter(username__startswith=f'{PREFISSO_USERNAME}-').order_by('id').first()
+            missione = user and Missione.objects.filter(user=user).select_related('user').order_by('-inizio').first()
+        if missione is None:
+            raise CommandError('Nessuna missione: generare i dati con `genera_dati_sintetici` o usare --missione.')
+
+        def avanzamento(nome, risultato):
+            self.stderr.write(f'{nome}: {risultato["ms"]["mediana"]} ms, {risultato["query"]} query, '
+                              f'{risultato["memoria_picco_kib"]} KiB')
+
+        with servizi_locali(options['ritardo_servizi']):
+            benchmark = Benchmark(missione.user, missione)
+            risultati = benchmark.esegui(options['ripetizioni'], options['caso'], avanzamento)
+        dati = rapporto(risultati, options['ripetizioni'], missione)
+
+        testo = json.dumps(dati, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(testo)
+        else:
+            self.stdout.write(testo)
+
+        if options['confronta']:
+            with open(options['confronta']) as f:
+                precedente = json.load(f)
+            regressioni = 0
+            for nome, prima, ora, variazione, regressione in confronta(precedente, dati, options['soglia']):
+                riga = f'{nome:<30} {prima:>10.1f} {ora:>10.1f} {variazione:>+8.1%}'
+                self.stderr.write(self.style.ERROR(riga) if regressione else riga)
+                regressioni += regressione
+            if regressioni:
+                raise CommandError(f'{regressioni} casi peggiorati rispetto a {options["confronta"]}.')
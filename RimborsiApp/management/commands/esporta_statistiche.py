@@ -0,0 +1,40 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from RimborsiApp.export import ESPORTAZIONI, FORMATI
+from RimborsiApp.forms import FiltroStatisticheForm
+from RimborsiApp.statistiche import filtra_statistiche
+
+
+class Command(BaseCommand):
+    help = 'Esporta missioni o voci di spesa in CSV o XLSX, con gli stessi filtri della pagina statistiche.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tabella', choices=sorted(ESPORTAZIONI))
+        parser.add_argument('--formato', choices=sorted(FORMATI), default='csv')
+        parser.add_argument('--output', help='File di destinazione (default: stdout)')
+        parser.add_argument('--dal', help='Mese iniziale, YYYY-MM')
+        parser.add_argument('--al', help='Mese finale, YYYY-MM')
+        parser.add_argument('--struttura', help='Id della StrutturaFondi')
+        parser.add_argument('--fondo')
+        parser.add_argument('--tipo')
+        parser.add_argument('--categoria', help='Id della Categoria di destinazione')
+
+    def handle(self, *args, **options):
+        campi = ('dal', 'al', 'struttura', 'fondo', 'tipo', 'categoria')
+        form = FiltroStatisticheForm({c: options[c] for c in campi if options[c]})
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        _, missioni = filtra_statistiche(form.cleaned_data)
+
+        stream, _ = FORMATI[options['formato']]
+        righe = ESPORTAZIONI[options['tabella']](missioni)
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for dati in stream(righe):
+                    f.write(dati.encode('utf-8') if isinstance(dati, str) else dati)
+            self.stdout.write(self.style.SUCCESS(f'Esportazione scritta in {options["output"]}.'))
+        else:
+            for dati in stream(righe):
+                sys.stdout.buffer.write(dati.encode('utf-8') if isinstance(dati, str) else dati)
@@ -0,0 +1,61 @@
+import datetime
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from RimborsiApp.dati_sintetici import GeneratoreDati, crea_file_scontrini, elimina_dati_sintetici
+
+
+class Command(BaseCommand):
+    help = 'Genera utenti e missioni sintetici (deterministici a parità di seed) per benchmark e prove di carico.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--utenti', type=int, default=100)
+        parser.add_argument('--missioni', type=int, default=20, help='Missioni per utente')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--fino-al', help='Data più recente delle missioni, YYYY-MM-DD (default: oggi). '
+                                              'Va fissata per ottenere gli stessi dati in giorni diversi.')
+        parser.add_argument('--anni', type=int, default=3, help='Anni coperti dalle missioni')
+        parser.add_argument('--blocco', type=int, default=500, help='Missioni inserite per transazione')
+        parser.add_argument('--senza-file', action='store_true', help='Non crea né collega immagini e PDF')
+        parser.add_argument('--elimina', action='store_true', help='Cancella i dati sintetici esistenti e termina')
+
+    def handle(self, *args, **options):
+        if options['elimina']:
+            n = elimina_dati_sintetici()
+            self.stdout.write(self.style.SUCCESS(f'Eliminate {n} righe di dati sintetici.'))
+            return
+
+        if options['blocco'] < 1:
+            raise CommandError('--blocco deve essere almeno 1')
+
+        fino_al = None
+        if options['fino_al']:
+            try:
+                fino_al = datetime.datetime.strptime(options['fino_al'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--fino-al deve essere nel formato YYYY-MM-DD')
+
+        file_scontrini = ()
+        if not options['senza_file']:
+            # Random separato: i dati generati non dipendono dalla presenza dei file
+            file_scontrini = crea_file_scontrini(random.Random(options['seed']))
+
+        try:
+            generatore = GeneratoreDati(seed=options['seed'], fino_al=fino_al, anni=options['anni'],
+                                        blocco=options['blocco'], file_scontrini=file_scontrini)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        inizio = time.perf_counter()
+
+        def avanzamento(totali):
+            self.stdout.write(f'{totali["Missioni"]} missioni ({time.perf_counter() - inizio:.0f} s)')
+
+        totali = generatore.genera(options['utenti'], options['missioni'], avanzamento)
+        for nome, n in totali.items():
+            self.stdout.write(f'  {nome}: {n}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Dati sintetici generati in {time.perf_counter() - inizio:.1f} s. '
+            f'Eseguire `indici_ricerca` e `aggiorna_statistiche` per aggiornare ricerca e statistiche.'))
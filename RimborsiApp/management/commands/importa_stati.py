@@ -0,0 +1,34 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from RimborsiApp.importa_riferimenti import BLOCCO, ErroreFile, applica, confronta_stati, descrivi, invalida_stati
+
+
+class Command(BaseCommand):
+    help = 'Aggiorna gli stati e la loro categoria di diaria da stati_categorie.csv (id,nome,categoria), ' \
+           'inserendo e modificando solo le righe cambiate.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=os.path.join(settings.BASE_DIR, 'stati_categorie.csv'))
+        parser.add_argument('--solo-confronto', action='store_true', help='Mostra le differenze senza scrivere')
+        parser.add_argument('--blocco', type=int, default=BLOCCO, help='Righe per transazione')
+        parser.add_argument('--dettagli', type=int, default=10, help='Esempi mostrati per tipo di differenza')
+
+    def handle(self, *args, **options):
+        try:
+            tabelle = confronta_stati(options['file'])
+        except (OSError, ErroreFile) as e:
+            raise CommandError(str(e))
+
+        for differenze in tabelle:
+            for riga in descrivi(differenze, options['dettagli']):
+                self.stdout.write(riga)
+        if options['solo_confronto'] or not any(tabelle):
+            return
+
+        for differenze in tabelle:
+            applica(differenze, options['blocco'])
+        invalida_stati()
+        self.stdout.write(self.style.SUCCESS('Stati aggiornati.'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from RimborsiApp.models import Missione
+from RimborsiApp.ricerca import crea_indici_fulltext, indicizza_missione, usa_fulltext
+
+
+class Command(BaseCommand):
+    help = 'Crea gli indici FULLTEXT per la ricerca (MySQL) o ricostruisce l\'indice invertito TermineRicerca (altri db).'
+
+    def handle(self, *args, **options):
+        if usa_fulltext():
+            creati, rimossi = crea_indici_fulltext()
+            self.stdout.write(self.style.SUCCESS(f'Indici FULLTEXT creati: {", ".join(creati) or "nessuno"}; '
+                                                 f'rimossi: {", ".join(rimossi) or "nessuno"}.'))
+            return
+
+        n = 0
+        for missione_id in Missione.objects.order_by('id').values_list('id', flat=True).iterator(chunk_size=1000):
+            indicizza_missione(missione_id)
+            n += 1
+        self.stdout.write(self.style.SUCCESS(f'Indice di ricerca ricostruito per {n} missioni.'))
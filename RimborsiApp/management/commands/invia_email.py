@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from RimborsiApp.posta import BLOCCO, svuota_coda
+
+
+class Command(BaseCommand):
+    help = 'Invia le e-mail in coda (EmailInUscita) con una sola connessione SMTP per giro. Con --continuo resta ' \
+           'attivo, per quando il thread di invio nel processo web è disattivato (EMAIL_CODA_THREAD=0).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--continuo', action='store_true', help='Continua a controllare la coda')
+        parser.add_argument('--intervallo', type=float, default=10, help='Secondi tra due controlli con --continuo')
+        parser.add_argument('--blocco', type=int, default=BLOCCO, help='Messaggi prenotati per giro')
+
+    def handle(self, *args, **options):
+        while True:
+            inviati, falliti = svuota_coda(options['blocco'])
+            if inviati or falliti or not options['continuo']:
+                self.stdout.write(self.style.SUCCESS(f'E-mail inviate: {inviati}, rimandate o in errore: {falliti}.'))
+            if not options['continuo']:
+                return
+            time.sleep(options['intervallo'])
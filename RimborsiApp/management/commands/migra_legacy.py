@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from RimborsiApp.migrazioni import BLOCCO, MIGRAZIONI
+
+
+class Command(BaseCommand):
+    help = 'Migra a blocchi le spese dal vecchio formato JSON dei campi della missione e le voci dei pasti ' \
+           'dalle colonne legacy di Pasti. Un\'esecuzione interrotta riprende dall\'ultimo blocco salvato.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('migrazioni', nargs='+', choices=list(MIGRAZIONI))
+        parser.add_argument('--blocco', type=int, default=BLOCCO, help='Missioni (o giorni) per transazione')
+        parser.add_argument('--ricomincia', action='store_true',
+                            help='Ignora il checkpoint e riparte dalla prima missione; le missioni già '
+                                 'migrate vengono comunque saltate')
+
+    def handle(self, *args, **options):
+        for nome in options['migrazioni']:
+            inizio = time.perf_counter()
+
+            def avanzamento(ultimo_id, totali):
+                self.stdout.write(f'{nome}: fino all\'id {ultimo_id}, {totali["righe"]} righe '
+                                  f'({time.perf_counter() - inizio:.0f} s)')
+
+            totali = MIGRAZIONI[nome](blocco=options['blocco'], ricomincia=options['ricomincia'],
+                                      avanzamento=avanzamento)
+            dettagli = ', '.join(f'{chiave} {valore}' for chiave, valore in sorted(totali.items())) or 'niente da fare'
+            self.stdout.write(self.style.SUCCESS(
+                f'Migrazione {nome} completata in {time.perf_counter() - inizio:.1f} s: {dettagli}.'))
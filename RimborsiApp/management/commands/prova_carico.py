@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from RimborsiApp.prova_carico import esegui_prova
+
+
+class Command(BaseCommand):
+    help = 'Prova di carico: utenti sintetici concorrenti percorrono login, creazione della missione, card, ' \
+           'upload, resoconto e genera_pdf contro un\'istanza in esecuzione avviata con i servizi locali ' \
+           '(`servizi_locali`). Riporta throughput e percentili di latenza per passo.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Indirizzo dell\'istanza sotto prova')
+        parser.add_argument('--utenti', type=int, default=20, help='Utenti virtuali concorrenti')
+        parser.add_argument('--durata', type=float, default=60, help='Secondi di carico a regime, dopo la rampa')
+        parser.add_argument('--rampa', type=float, default=10, help='Secondi in cui avviare gli utenti')
+        parser.add_argument('--pensiero', type=float, default=1., help='Pausa media tra due passi, in secondi')
+        parser.add_argument('--email', type=float, default=0.2, help='Quota di percorsi che inviano la mail di '
+                                                                     'autorizzazione')
+        parser.add_argument('--seed', type=int, default=0, help='Seed usato da genera_dati_sintetici')
+        parser.add_argument('--output', help='File JSON dei risultati (default: stdout)')
+
+    def handle(self, *args, **options):
+        if options['utenti'] < 1:
+            raise CommandError('--utenti deve essere almeno 1')
+        try:
+            dati = esegui_prova(options['url'], options['utenti'], options['durata'], options['rampa'],
+                                options['pensiero'], options['seed'], options['email'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        for passo, risultato in dati['passi'].items():
+            ms = risultato['ms']
+            riga = f'{passo:<28} {risultato["richieste"]:>6} {risultato["errori"]:>5} ' \
+                   f'{ms["p50"]:>9.1f} {ms["p95"]:>9.1f} {ms["p99"]:>9.1f} {ms["max"]:>9.1f}'
+            self.stderr.write(self.style.ERROR(riga) if risultato['errori'] else riga)
+
+        testo = json.dumps(dati, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(testo)
+        else:
+            self.stdout.write(testo)
+        self.stderr.write(self.style.SUCCESS(
+            f'{dati["richieste"]} richieste ({dati["richieste_al_secondo"]}/s), {dati["errori"]} errori, '
+            f'{dati["percorsi_completati"]} percorsi completati.'))
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from RimborsiApp.servizi_locali import ServiziLocali, SmtpLocale
+
+
+class Command(BaseCommand):
+    help = 'Avvia i sostituti locali di Banca d\'Italia, MASE e server SMTP per le prove di carico, ' \
+           'fino a Ctrl-C. Stampa le variabili d\'ambiente da dare all\'istanza sotto prova, che va avviata con ' \
+           'runserver (il login da header richiede DEBUG).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--porta-http', type=int, default=8081)
+        parser.add_argument('--porta-smtp', type=int, default=8025)
+        parser.add_argument('--ritardo', type=int, default=0, help='Latenza dei servizi HTTP in ms')
+
+    def handle(self, *args, **options):
+        http = ServiziLocali(options['host'], options['porta_http'], options['ritardo']).avvia()
+        smtp = SmtpLocale(options['host'], options['porta_smtp']).avvia()
+        impostazioni = {**http.impostazioni, **smtp.impostazioni, 'EMAIL_USE_TLS': 0,
+                        'SHIBBOLETH_ATTRIBUTI_DA_HEADER': 1}
+        for nome, valore in impostazioni.items():
+            self.stdout.write(f'export {nome}={int(valore) if isinstance(valore, bool) else valore}')
+        self.stdout.write(self.style.SUCCESS('Servizi locali avviati, Ctrl-C per terminare.'))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http.ferma()
+            smtp.ferma()
+        self.stdout.write(self.style.SUCCESS(f'Email ricevute: {smtp.messaggi}'))
@@ -0,0 +1,57 @@
+import json
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Misura in processi nuovi il tempo di avvio di un worker (setup, URLconf, middleware), ' \
+           'la memoria occupata e le librerie pesanti caricate all\'avvio.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ripetizioni', type=int, default=5)
+        parser.add_argument('--output', help='File JSON dei risultati')
+
+    def handle(self, *args, **options):
+        misure = []
+        for _ in range(options['ripetizioni']):
+            processo = subprocess.run([sys.executable, '-m', 'RimborsiApp.avvio'], cwd=settings.BASE_DIR,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if processo.returncode:
+                raise CommandError(processo.stderr.decode(errors='replace'))
+            misure.append(json.loads(processo.stdout.decode().strip().splitlines()[-1]))
+
+        def mediana(estrai):
+            return round(statistics.median(estrai(m) for m in misure), 1)
+
+        ultima = misure[-1]
+        dati = {
+            'ripetizioni': len(misure),
+            'ms': {fase: mediana(lambda m: m['ms'][fase]) for fase in ultima['ms']},
+            'memoria_kib': mediana(lambda m: m['memoria_kib']),
+            'memoria_dopo_primo_uso_kib': mediana(lambda m: m['memoria_dopo_primo_uso_kib']),
+            'moduli': ultima['moduli'],
+            'pesanti_caricate': ultima['pesanti_caricate'],
+            'primo_uso_ms': {nome: mediana(lambda m: m['primo_uso_ms'].get(nome, 0))
+                             for nome in ultima['primo_uso_ms']},
+        }
+
+        for fase, ms in dati['ms'].items():
+            self.stdout.write(f'{fase:<28} {ms:>9.1f} ms')
+        self.stdout.write(f'{"memoria_kib":<28} {dati["memoria_kib"]:>9.0f} KiB')
+        self.stdout.write(f'{"memoria_dopo_primo_uso_kib":<28} {dati["memoria_dopo_primo_uso_kib"]:>9.0f} KiB')
+        for nome, ms in dati['primo_uso_ms'].items():
+            self.stdout.write(f'  primo uso {nome:<17} {ms:>9.1f} ms')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(dati, f, indent=2)
+
+        if dati['pesanti_caricate']:
+            self.stdout.write(self.style.WARNING(
+                f'Librerie pesanti caricate all\'avvio: {", ".join(dati["pesanti_caricate"])}'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Nessuna libreria pesante caricata all\'avvio.'))
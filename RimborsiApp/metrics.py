@@ -0,0 +1,112 @@
+"""
+Metriche in memoria esposte su /metrics nel formato testuale di Prometheus.
+
+Non serve nessun servizio esterno: contatori e istogrammi vivono nel processo e costano un lock e
+qualche somma per osservazione. Con più worker ogni processo espone solo i propri valori (etichetta pid) e
+una richiesta a /metrics arriva a un worker qualsiasi: questo endpoint non aggrega nulla. Per avere i totali
+l'agente deve raccogliere da ogni worker (ad esempio un target per porta) e sommare per etichetta, ignorando
+pid; ogni riavvio di un worker riparte da zero, come un contatore Prometheus azzerato.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_registro = {}
+
+BUCKET_SECONDI = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+BUCKET_BYTE = (10 * 1024, 100 * 1024, 512 * 1024, 1024 ** 2, 2 * 1024 ** 2, 5 * 1024 ** 2, 10 * 1024 ** 2)
+
+
+def _etichette(nomi, valori):
+    coppie = list(zip(nomi, valori)) + [('pid', str(os.getpid()))]
+    testo = ','.join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in coppie)
+    return '{' + testo + '}'
+
+
+class Counter:
+    def __init__(self, nome, descrizione, etichette=()):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self._valori = {}
+        _registro[nome] = self
+
+    def inc(self, valore=1, **etichette):
+        chiave = tuple(str(etichette.get(e, '')) for e in self.etichette)
+        with _lock:
+            self._valori[chiave] = self._valori.get(chiave, 0) + valore
+
+    def esporta(self):
+        righe = [f'# HELP {self.nome} {self.descrizione}', f'# TYPE {self.nome} counter']
+        for chiave, valore in sorted(self._valori.items()):
+            righe.append(f'{self.nome}{_etichette(self.etichette, chiave)} {valore}')
+        return righe
+
+
+class Histogram:
+    def __init__(self, nome, descrizione, etichette=(), bucket=BUCKET_SECONDI):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self.bucket = tuple(bucket)
+        self._valori = {}  # chiave -> [conteggi per bucket, somma, totale]
+        _registro[nome] = self
+
+    def observe(self, valore, **etichette):
+        chiave = tuple(str(etichette.get(e, '')) for e in self.etichette)
+        with _lock:
+            dati = self._valori.get(chiave)
+            if dati is None:
+                dati = self._valori[chiave] = [[0] * len(self.bucket), 0., 0]
+            for i, limite in enumerate(self.bucket):
+                if valore <= limite:
+                    dati[0][i] += 1
+            dati[1] += valore
+            dati[2] += 1
+
+    @contextmanager
+    def time(self, **etichette):
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - inizio, **etichette)
+
+    def esporta(self):
+        righe = [f'# HELP {self.nome} {self.descrizione}', f'# TYPE {self.nome} histogram']
+        for chiave, (conteggi, somma, totale) in sorted(self._valori.items()):
+            for limite, conteggio in zip(self.bucket, conteggi):
+                etichette = _etichette(self.etichette + ('le',), chiave + (repr(float(limite)),))
+                righe.append(f'{self.nome}_bucket{etichette} {conteggio}')
+            righe.append(f'{self.nome}_bucket{_etichette(self.etichette + ("le",), chiave + ("+Inf",))} {totale}')
+            righe.append(f'{self.nome}_sum{_etichette(self.etichette, chiave)} {somma}')
+            righe.append(f'{self.nome}_count{_etichette(self.etichette, chiave)} {totale}')
+        return righe
+
+
+def esporta():
+    with _lock:
+        righe = [r for metrica in _registro.values() for r in metrica.esporta()]
+    return '\n'.join(righe) + '\n'
+
+
+RICHIESTE_SECONDI = Histogram('rimborsi_richieste_secondi', 'Durata delle richieste per vista.',
+                              ('vista', 'metodo', 'status'))
+PDF_FASE_SECONDI = Histogram('rimborsi_pdf_fase_secondi', 'Durata delle fasi di genera_pdf.', ('fase',))
+TASSI_CAMBIO_CACHE = Counter('rimborsi_tassi_cambio_cache_totale',
+                             'Tassi di cambio serviti dalla memoria (hit), letti da TassoCambio (db) o scaricati (miss).',
+                             ('esito',))
+UPLOAD_BYTE = Histogram('rimborsi_upload_byte', 'Dimensione dei file caricati.', ('campo',), bucket=BUCKET_BYTE)
+IMMAGINI_SECONDI = Histogram('rimborsi_conversione_immagini_secondi',
+                             'Conversione delle immagini degli scontrini in pagine PDF.')
+HTTP_USCITA_SECONDI = Histogram('rimborsi_http_uscita_secondi', 'Durata delle chiamate HTTP verso servizi esterni.',
+                                ('host', 'status'))
+
+EMAIL_TOTALE = Counter('rimborsi_email_totale', 'E-mail della coda inviate, rimandate o scartate dopo troppi errori.',
+                       ('esito',))
+
+
+def osserva_http(host, ms, status):
+    HTTP_USCITA_SECONDI.observe(ms / 1000, host=host, status=status)
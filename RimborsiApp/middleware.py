@@ -1,23 +1,117 @@
+import random
+
 from django.shortcuts import reverse, redirect
 from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from RimborsiApp import metrics, performance
+from RimborsiApp.gruppi import carica_da_sessione, salva_in_sessione
 
 
 class MaintenanceModeMiddleware:
+    """
+    Con MAINTENANCE_MODE rimanda ogni richiesta alla pagina di manutenzione, tranne quella pagina e i file statici.
+    Chi apre un URL con MAINTENANCE_BYPASS_QUERY nella query string riceve un cookie firmato che lo fa passare
+    per BYPASS_DURATA secondi. Il salt della firma contiene il valore di bypass, quindi cambiarlo revoca i cookie
+    già emessi.
+    Con la manutenzione spenta il middleware non viene nemmeno installato; per attivarla (MAINTENANCE_MODE=1
+    nell'environment) serve riavviare i worker.
+    """
+    COOKIE = 'bypass_manutenzione'
+    BYPASS_DURATA = 12 * 60 * 60
+
     def __init__(self, get_response):
+        if not settings.MAINTENANCE_MODE:
+            raise MiddlewareNotUsed
         self.get_response = get_response
+        self.bypass = settings.MAINTENANCE_BYPASS_QUERY
+        self.salt = f'RimborsiApp.middleware.MaintenanceModeMiddleware:{self.bypass}'
+        self.esclusi = tuple(p for p in (settings.STATIC_URL,) if p)
+        self._percorso = None
+
+    @property
+    def percorso(self):
+        # reverse() una volta sola, al primo uso: nel costruttore gli URL potrebbero non essere ancora caricati
+        if self._percorso is None:
+            self._percorso = reverse("RimborsiApp:maintenance")
+        return self._percorso
 
     def __call__(self, request):
-        path = request.META.get('PATH_INFO', "")
-        query = request.META.get('QUERY_STRING', "")
+        path = request.path_info
+        if path == self.percorso or path.startswith(self.esclusi):
+            return self.get_response(request)
+
+        if self.bypass and self.bypass in request.META.get('QUERY_STRING', ""):
+            response = self.get_response(request)
+            response.set_signed_cookie(self.COOKIE, '1', salt=self.salt, max_age=self.BYPASS_DURATA, httponly=True,
+                                       secure=request.is_secure(), samesite='Lax')
+            return response
+        if self.bypass and request.get_signed_cookie(self.COOKIE, default=None, salt=self.salt,
+                                                     max_age=self.BYPASS_DURATA) == '1':
+            return self.get_response(request)
 
-        if settings.MAINTENANCE_BYPASS_QUERY in query:
-            request.session['bypass_maintenance'] = True
+        return redirect(self.percorso)
 
-        if not request.session.get('bypass_maintenance', False):
-            if settings.MAINTENANCE_MODE and path != reverse("RimborsiApp:maintenance"):
-                response = redirect(reverse("RimborsiApp:maintenance"))
-                return response
+
+class GruppiUtenteMiddleware:
+    """
+    Tiene in sessione i gruppi dell'utente autenticato, così has_group nella navbar non fa query.
+    Va messo dopo AuthenticationMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.user.is_authenticated:
+            carica_da_sessione(request)
 
         response = self.get_response(request)
 
-        return response
\ No newline at end of file
+        if request.user.is_authenticated:
+            salva_in_sessione(request)
+        return response
+
+
+
+class PerformanceMiddleware:
+    """
+    Misura ogni richiesta: tempo totale, query e tempo sul db, render dei template, chiamate HTTP
+    esterne e byte inviati. Aggiunge l'header Server-Timing e scrive nel logger RimborsiApp.performance
+    una riga JSON per una frazione delle richieste (PERFORMANCE_LOG_SAMPLE_RATE) e per tutte quelle
+    più lente di PERFORMANCE_SLOW_MS. Va messo per primo, così misura anche gli altri middleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PERFORMANCE_LOG_SAMPLE_RATE', 0.01)
+        self.slow_ms = getattr(settings, 'PERFORMANCE_SLOW_MS', 2000)
+        performance.installa()
+        if metrics.osserva_http not in performance.osservatori_http:
+            performance.osservatori_http.append(metrics.osserva_http)
+
+    def __call__(self, request):
+        misure = performance.inizia_misure()
+        try:
+            with connection.execute_wrapper(performance.db_wrapper):
+                response = self.get_response(request)
+        finally:
+            performance.termina_misure()
+
+        # Con le risposte in streaming il tempo non comprende la generazione del contenuto
+        totale_ms = misure.totale_ms
+        if response.streaming:
+            byte = int(response['Content-Length']) if response.has_header('Content-Length') else None
+        else:
+            byte = len(response.content)
+        response['Server-Timing'] = performance.server_timing(misure, totale_ms)
+
+        resolver_match = getattr(request, 'resolver_match', None)
+        metrics.RICHIESTE_SECONDI.observe(totale_ms / 1000, vista=resolver_match.view_name if resolver_match else '',
+                                          metodo=request.method, status=response.status_code)
+        # Solo se la vista ha già letto i file: qui non si vuole forzare il parsing del body
+        for campo, file in getattr(request, '_files', {}).items():
+            metrics.UPLOAD_BYTE.observe(file.size, campo=campo)
+
+        if totale_ms >= self.slow_ms or random.random() < self.sample_rate:
+            performance.log_richiesta(request, response, misure, totale_ms, byte)
+        return response
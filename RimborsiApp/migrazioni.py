@@ -0,0 +1,232 @@
+"""
+Migrazione dei dati dal vecchio formato: le spese salvate come JSON nei campi testo della missione
+(scontrino, pernottamento, convegno, altrespese) e i campi importoN/valutaN/... delle righe Pasti.
+Si eseguono con `manage.py migra_legacy`.
+
+Le missioni sono lette a blocchi in ordine di id, con solo il campo JSON. Ogni blocco è inserito con
+bulk_create in una transazione che aggiorna anche il CheckpointMigrazione, quindi un'interruzione fa perdere al
+più il blocco in corso e la ripresa riparte dalla missione successiva all'ultima salvata. Le missioni che hanno
+già righe del tipo migrato (es. dalle vecchie funzioni senza checkpoint) vengono saltate, così rieseguire non
+duplica nulla. Gli id sono assegnati esplicitamente con Sequenza: meglio eseguire a sito fermo, un
+inserimento concorrente sullo stesso id fa fallire il blocco, che verrà ripreso al rilancio.
+I dati legacy illeggibili (JSON non valido o non a lista, voci senza data o non oggetti, importi non numerici)
+non fermano la migrazione: la voce viene saltata e contata nei totali.
+"""
+import json
+from collections import Counter
+from datetime import datetime as dt
+
+from django.db import transaction
+
+from RimborsiApp.models import CheckpointMigrazione, Missione, Pasti, Pasto, Spesa, SpesaMissione
+from RimborsiApp.money import parse_importo, to_decimal
+from RimborsiApp.ricerca import indicizza_missione, usa_fulltext
+from RimborsiApp.sequenze import Sequenza
+
+BLOCCO = 500
+
+
+def _voci(testo, totali):
+    """
+    Voci non cancellate di un campo JSON legacy. Un JSON illeggibile o che non è una lista viene contato in
+    json_non_validi e saltato, una voce che non è un oggetto in voci_non_valide.
+    """
+    try:
+        voci = json.loads(testo)
+    except ValueError:
+        totali['json_non_validi'] += 1
+        return []
+    if not isinstance(voci, list):
+        totali['json_non_validi'] += 1
+        return []
+    valide = []
+    for v in voci:
+        if not isinstance(v, dict):
+            totali['voci_non_valide'] += 1
+        elif not v.get('DELETE', False):
+            valide.append(v)
+    return valide
+
+
+def _importo(valore, totali):
+    """
+    Importo di una voce legacy come parse_importo (None se vuoto); un importo illeggibile (es. "12,50 €")
+    viene contato in importi_non_validi e la voce saltata. Restituisce (valido, importo).
+    """
+    try:
+        return True, parse_importo(valore)
+    except (ValueError, ArithmeticError):
+        totali['importi_non_validi'] += 1
+        return False, None
+
+
+def _data(voce, totali):
+    try:
+        return dt.strptime(voce['data'], '%Y-%m-%d').date()
+    except (KeyError, TypeError, ValueError):
+        totali['voci_senza_data'] += 1
+        return None
+
+
+def _spese(tipo):
+    def converti(righe, totali):
+        gia_migrate = set(SpesaMissione.objects.filter(missione_id__in=[id for id, _ in righe], tipo=tipo)
+                          .values_list('missione_id', flat=True))
+        id_spesa = Sequenza(Spesa)
+        spese, spese_missione = [], []
+        for missione_id, testo in righe:
+            if missione_id in gia_migrate:
+                totali['missioni_saltate'] += 1
+                continue
+            totali['missioni'] += 1
+            for voce in _voci(testo, totali):
+                data = _data(voce, totali)
+                if data is None:
+                    continue
+                valido, importo = _importo(voce.get('s1'), totali)
+                if not valido:
+                    continue
+                spesa = Spesa(id=id_spesa(), data=data, importo=to_decimal(importo),
+                              valuta=voce.get('v1') or 'EUR', descrizione=voce.get('d1', ''))
+                spese.append(spesa)
+                spese_missione.append(SpesaMissione(missione_id=missione_id, spesa_id=spesa.id, tipo=tipo))
+        Spesa.objects.bulk_create(spese)
+        SpesaMissione.objects.bulk_create(spese_missione)
+        totali['righe'] += len(spese)
+        return {sm.missione_id for sm in spese_missione}
+    return converti
+
+
+def _pasti(righe, totali):
+    gia_migrate = set(Pasti.objects.filter(missione_id__in=[id for id, _ in righe])
+                      .values_list('missione_id', flat=True))
+    id_giorno = Sequenza(Pasti)
+    giorni, voci = [], []
+    for missione_id, testo in righe:
+        if missione_id in gia_migrate:
+            totali['missioni_saltate'] += 1
+            continue
+        totali['missioni'] += 1
+        for pasto in _voci(testo, totali):
+            data = _data(pasto, totali)
+            if data is None:
+                continue
+            giorno = Pasti(id=id_giorno(), missione_id=missione_id, data=data)
+            giorni.append(giorno)
+            for tipo in (1, 2, 3):
+                valido, importo = _importo(pasto.get(f's{tipo}'), totali)
+                if not valido:
+                    continue
+                descrizione = pasto.get(f'd{tipo}', '') or ''
+                # Come Pasti.aggiorna_voce: le voci vuote non vengono salvate
+                if importo is None and not descrizione:
+                    continue
+                voci.append(Pasto(pasti_id=giorno.id, tipo=tipo, importo=importo,
+                                  valuta=pasto.get(f'v{tipo}') or 'EUR', descrizione=descrizione))
+    Pasti.objects.bulk_create(giorni)
+    Pasto.objects.bulk_create(voci)
+    totali['righe'] += len(voci)
+    return {g.missione_id for g in giorni}
+
+
+def migra_json(nome, campo, converti, blocco=BLOCCO, ricomincia=False, avanzamento=None):
+    """
+    Migra il campo JSON di tutte le missioni a blocchi, ripartendo dal checkpoint `nome`.
+    converti(righe, totali) riceve le coppie (id missione, testo JSON), inserisce le righe nuove e restituisce
+    gli id delle missioni modificate. Restituisce i totali (missioni, righe, saltate, scartate).
+    """
+    checkpoint, _ = CheckpointMigrazione.objects.get_or_create(nome=nome)
+    if ricomincia:
+        checkpoint.ultimo_id = 0
+        checkpoint.completata = False
+        checkpoint.save()
+
+    missioni = Missione.objects.exclude(**{f'{campo}__isnull': True}).exclude(**{campo: ''}).order_by('id')
+    ultimo_id = checkpoint.ultimo_id
+    totali = Counter()
+    while True:
+        righe = list(missioni.filter(id__gt=ultimo_id).values_list('id', campo)[:blocco])
+        if not righe:
+            break
+        with transaction.atomic():
+            modificate = converti(righe, totali)
+            ultimo_id = righe[-1][0]
+            CheckpointMigrazione.objects.filter(pk=checkpoint.pk).update(ultimo_id=ultimo_id)
+        # bulk_create non invia i signal che aggiornano l'indice di ricerca
+        if not usa_fulltext():
+            for missione_id in modificate:
+                indicizza_missione(missione_id)
+        if avanzamento:
+            avanzamento(ultimo_id, totali)
+
+    CheckpointMigrazione.objects.filter(pk=checkpoint.pk).update(completata=True)
+    return totali
+
+
+def migra_pernottamenti(**kwargs):
+    return migra_json('pernottamenti', 'pernottamento', _spese('PERNOTTAMENTO'), **kwargs)
+
+
+def migra_altre_spese(**kwargs):
+    return migra_json('altre_spese', 'altrespese', _spese('ALTRO'), **kwargs)
+
+
+def migra_convegni(**kwargs):
+    return migra_json('convegni', 'convegno', _spese('CONVEGNO'), **kwargs)
+
+
+def migra_pasti(**kwargs):
+    return migra_json('pasti', 'scontrino', _pasti, **kwargs)
+
+
+def migra_pasti_voci(blocco=BLOCCO, ricomincia=False, avanzamento=None):
+    """
+    Copia importoN/valutaN/descrizioneN/img_scontrinoN delle righe Pasti nelle voci Pasto (N = tipo del pasto).
+    I giorni che hanno già almeno una voce vengono saltati, quindi la funzione può essere rieseguita senza
+    checkpoint; ogni blocco di giorni è inserito in una transazione.
+    """
+    giorni = Pasti.objects.filter(voci__isnull=True).order_by('id')
+
+    ultimo_id = 0
+    totali = Counter()
+    while True:
+        blocco_giorni = list(giorni.filter(id__gt=ultimo_id)[:blocco])
+        if not blocco_giorni:
+            break
+        voci = []
+        for giorno in blocco_giorni:
+            for tipo in (1, 2, 3):
+                importo = getattr(giorno, f'importo{tipo}')
+                descrizione = getattr(giorno, f'descrizione{tipo}') or ''
+                img_scontrino = getattr(giorno, f'img_scontrino{tipo}')
+                if importo is None and not descrizione and not img_scontrino:
+                    continue
+                valido, importo = _importo(importo, totali)
+                if not valido:
+                    continue
+                voci.append(Pasto(pasti=giorno,
+                                  tipo=tipo,
+                                  importo=importo,
+                                  valuta=getattr(giorno, f'valuta{tipo}') or 'EUR',
+                                  descrizione=descrizione,
+                                  img_scontrino=img_scontrino.name if img_scontrino else None))
+        with transaction.atomic():
+            Pasto.objects.bulk_create(voci)
+        ultimo_id = blocco_giorni[-1].id
+        totali['giorni'] += len(blocco_giorni)
+        totali['righe'] += len(voci)
+        if not usa_fulltext():
+            for missione_id in {g.missione_id for g in blocco_giorni}:
+                indicizza_missione(missione_id)
+        if avanzamento:
+            avanzamento(ultimo_id, totali)
+    return totali
+
+
+MIGRAZIONI = {
+    'pernottamenti': migra_pernottamenti,
+    'altre_spese': migra_altre_spese,
+    'convegni': migra_convegni,
+    'pasti': migra_pasti,
+    'pasti_voci': migra_pasti_voci,
+}
@@ -1,12 +1,15 @@
 import datetime
 
 from codicefiscale import codicefiscale
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
 from django.db import models
 from django.db.models import ForeignKey
 from django.utils import timezone
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
 from django.dispatch import receiver
+from RimborsiApp.gruppi import invalida_gruppi_utente
+from RimborsiApp.money import Money
+from RimborsiApp.riferimenti import struttura_da_testo
 from RimborsiApp.storage import OverwriteStorage
 
 from polymorphic.models import PolymorphicModel
@@ -203,6 +206,12 @@ MOTIVAZIONE_AUTO_CHOICES = (
     # (7, "Vuoto"),
 )
 
+TIPO_PASTO_CHOICES = (
+    (1, "Colazione"),
+    (2, "Pranzo"),
+    (3, "Cena"),
+)
+
 TIPO_SCONTRINO_CHOICES = (
     ("PASTO", "PASTO"),
     ("PERNOTTAMENTO", "PERNOTTAMENTO"),
@@ -210,6 +219,13 @@ TIPO_SCONTRINO_CHOICES = (
     ("CONVEGNO", "CONVEGNO"),
 )
 
+STATO_EMAIL_CHOICES = (
+    ("IN_CODA", "In coda"),
+    ("IN_INVIO", "In invio"),
+    ("INVIATA", "Inviata"),
+    ("ERRORE", "Errore"),
+)
+
 class Automobile(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     marca = models.CharField(max_length=50)
@@ -225,8 +241,8 @@ class Automobile(models.Model):
 
 class Categoria(models.Model):
     nome = models.CharField(max_length=1)
-    massimale_docenti = models.FloatField()
-    massimale_tecnici = models.FloatField()
+    massimale_docenti = models.DecimalField(max_digits=10, decimal_places=2)
+    massimale_tecnici = models.DecimalField(max_digits=10, decimal_places=2)
 
     def __str__(self):
         return self.nome
@@ -245,6 +261,20 @@ class Stato(models.Model):
     class Meta:
         verbose_name_plural = "Stati"
 
+
+class StrutturaFondi(models.Model):
+    """Struttura fondi canonica: il campo libero Missione.struttura_fondi viene ricondotto a una di queste."""
+    nome = models.CharField(max_length=100, unique=True)
+    # Parole separate da virgola cercate (senza accenti e maiuscole) nel testo inserito dall'utente
+    parole_chiave = models.CharField(max_length=200)
+
+    def __str__(self):
+        return self.nome
+
+    class Meta:
+        verbose_name = "Struttura fondi"
+        verbose_name_plural = "Strutture fondi"
+
 def profile_type_path_firma(instance, filename):
     if instance.user_owner is None:
         user = instance.user
@@ -270,17 +300,24 @@ def trasporti_path(instance, filename):
 
 
 def pasti_path(instance, filename):
-    user_id = instance.missione.user.id if instance else 'unknown_user'
-    id_missione = instance.missione.id if instance else 'unknown_mission'
+    # instance può essere il giorno (Pasti) o la singola voce (Pasto)
+    missione = instance.pasti.missione if isinstance(instance, Pasto) else instance.missione
+    user_id = missione.user.id if instance else 'unknown_user'
+    id_missione = missione.id if instance else 'unknown_mission'
     return f'users/{user_id}/{id_missione}/PASTO/{filename}'
 
 
 class Spesa(models.Model):
     data = models.DateField()
-    importo = models.FloatField()
+    importo = models.DecimalField(max_digits=10, decimal_places=2)
     valuta = models.CharField(max_length=3, choices=VALUTA_CHOICES, default="EUR")
     descrizione = models.CharField(max_length=1024, null=True, blank=True)
     img_scontrino = models.FileField(upload_to=profile_type_path, null=True, blank=True)
+
+    @property
+    def money(self):
+        return Money(self.importo, self.valuta)
+
     class Meta:
         verbose_name = "Spesa"
         verbose_name_plural = "Spese"
@@ -297,10 +334,12 @@ class Missione(models.Model):
     fondo = models.CharField(max_length=100)
     motivazione = models.CharField(max_length=100)
     struttura_fondi = models.CharField(max_length=200)
+    # Valorizzata automaticamente da struttura_fondi, vedi riferimenti.struttura_da_testo()
+    struttura = models.ForeignKey(StrutturaFondi, on_delete=models.SET_NULL, null=True, blank=True, editable=False)
     automobile = models.ForeignKey(Automobile, null=True, blank=True, on_delete=models.SET_NULL)
     automobile_altrui = models.CharField(max_length=100, null=True, blank=True)
     tipo = models.CharField(max_length=8, choices=TIPO_MISSIONE_CHOICES, null=True)
-    anticipo = models.FloatField(null=True, blank=True, default=0)
+    anticipo = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, default=0)
 
     pernottamenti = models.ManyToManyField(Spesa, through='PernottamentoMissione',
                                            related_name='pernottamenti_missioni')
@@ -329,6 +368,10 @@ class Missione(models.Model):
 
     class Meta:
         verbose_name_plural = "Missioni"
+        indexes = [
+            # Lista missioni: filtro per utente/stato e keyset pagination su (inizio, id)
+            models.Index(fields=['user', 'missione_conclusa', '-inizio', '-id'], name='missione_lista_idx'),
+        ]
 
     def __str__(self):
         return f'{self.inizio} - {self.stato_destinazione} - {self.citta_destinazione}'
@@ -362,6 +405,9 @@ class AltreSpeseMissione(SpesaMissione):
 class Pasti(models.Model):
     missione = models.ForeignKey(Missione, on_delete=models.CASCADE)
     data = models.DateField()
+
+    # Colonne legacy: i pasti sono ora salvati come righe Pasto (una per tipo di pasto).
+    # Restano solo per poter eseguire `manage.py migra_legacy pasti_voci` e verranno rimosse in seguito.
     importo1 = models.FloatField(null=True, blank=True)
     valuta1 = models.CharField(max_length=3, choices=VALUTA_CHOICES, default='EUR')
     descrizione1 = models.CharField(max_length=255, null=True, blank=True)
@@ -375,11 +421,60 @@ class Pasti(models.Model):
     descrizione3 = models.CharField(max_length=255, null=True, blank=True)
     img_scontrino3 = models.FileField(upload_to=pasti_path, null=True, blank=True)
 
+    def aggiorna_voce(self, tipo, importo, valuta, descrizione, img_scontrino=None):
+        """
+        Crea, aggiorna o elimina la voce del pasto `tipo` per questo giorno.
+
+        :param img_scontrino: None lascia invariata l'immagine, False la rimuove, un file la sostituisce.
+        """
+        voce = self.voci.filter(tipo=tipo).first()
+        if voce is None:
+            voce = Pasto(pasti=self, tipo=tipo)
+
+        voce.importo = importo
+        voce.valuta = valuta or 'EUR'
+        voce.descrizione = descrizione or ''
+        if img_scontrino is False:
+            voce.img_scontrino = None
+        elif img_scontrino is not None:
+            voce.img_scontrino = img_scontrino
+
+        if voce.importo is None and not voce.descrizione and not voce.img_scontrino:
+            # Voce vuota: non serve tenerla nel db
+            if voce.pk:
+                voce.delete()
+            return None
+
+        voce.save()
+        return voce
+
     class Meta:
         verbose_name = "Pasto"
         verbose_name_plural = "Pasti"
 
 
+class Pasto(models.Model):
+    pasti = models.ForeignKey(Pasti, on_delete=models.CASCADE, related_name='voci')
+    tipo = models.PositiveSmallIntegerField(choices=TIPO_PASTO_CHOICES)
+    importo = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    valuta = models.CharField(max_length=3, choices=VALUTA_CHOICES, default='EUR')
+    descrizione = models.CharField(max_length=255, null=True, blank=True)
+    img_scontrino = models.FileField(upload_to=pasti_path, null=True, blank=True)
+
+    @property
+    def data(self):
+        return self.pasti.data
+
+    @property
+    def money(self):
+        return Money(self.importo, self.valuta)
+
+    class Meta:
+        verbose_name = "Voce pasto"
+        verbose_name_plural = "Voci pasti"
+        unique_together = ('pasti', 'tipo')
+
+
 class Trasporto(models.Model):
     missione = models.ForeignKey(Missione, on_delete=models.CASCADE)
     data = models.DateField()
@@ -387,11 +482,15 @@ class Trasporto(models.Model):
     a = models.CharField(max_length=100, null=True, blank=True)
     mezzo = models.CharField(max_length=5, choices=MEZZO_CHOICES)
     tipo_costo = models.CharField(max_length=50, null=True, blank=True)
-    costo = models.FloatField()
+    costo = models.DecimalField(max_digits=10, decimal_places=2)
     valuta = models.CharField(max_length=3, choices=VALUTA_CHOICES, default="EUR")
     km = models.FloatField(null=True, blank=True)
     img_scontrino = models.FileField(upload_to=trasporti_path, null=True, blank=True)
 
+    @property
+    def money(self):
+        return Money(self.costo, self.valuta)
+
     class Meta:
         verbose_name_plural = "Trasporti"
 
@@ -411,7 +510,43 @@ class Indirizzo(models.Model):
         verbose_name_plural = "Indirizzi"
 
 
-class Profile(models.Model):
+class SalvaSoloModificati(models.Model):
+    """
+    Il save() di un'istanza letta dal db scrive solo i campi cambiati da allora, e nessuna query se non è
+    cambiato nulla. Le istanze nuove e i save(update_fields=...) espliciti funzionano come sempre.
+    """
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        istanza = super().from_db(db, field_names, values)
+        istanza._valori_salvati = {nome: valore for nome, valore in zip(field_names, values)
+                                   if valore is not models.DEFERRED}
+        return istanza
+
+    def campi_modificati(self):
+        """Nomi dei campi cambiati dall'ultima lettura o dall'ultimo salvataggio."""
+        salvati = self._valori_salvati
+        return [f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.attname in self.__dict__
+                and (f.attname not in salvati or salvati[f.attname] != self.__dict__[f.attname])]
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and not self._state.adding and hasattr(self, '_valori_salvati'):
+            update_fields = self.campi_modificati()
+            if not update_fields:
+                return
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        campi = self._meta.concrete_fields if update_fields is None else \
+            [self._meta.get_field(nome) for nome in update_fields]
+        salvati = getattr(self, '_valori_salvati', {})
+        salvati.update({f.attname: self.__dict__[f.attname] for f in campi if f.attname in self.__dict__})
+        self._valori_salvati = salvati
+
+
+class Profile(SalvaSoloModificati):
     QUALIFICA_CHOICES = (
         ('DOTTORANDO', 'Dottorando'),
         ('ASSEGNISTA', 'Assegnista'),
@@ -467,15 +602,38 @@ class Profile(models.Model):
         verbose_name_plural = "Profili"
 
 
+@receiver(pre_save, sender=Missione)
+def assegna_struttura_fondi(sender, instance, **kwargs):
+    struttura = struttura_da_testo(instance.struttura_fondi)
+    instance.struttura_id = struttura and struttura.pk
+
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
 
 
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
+@receiver(m2m_changed, sender=User.groups.through)
+def invalida_gruppi_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if not reverse:
+        invalida_gruppi_utente(instance.pk)
+    elif action == 'pre_clear':
+        # Con clear() dal lato del gruppo pk_set è None: gli utenti vanno letti prima che vengano rimossi
+        for user_id in instance.user_set.values_list('pk', flat=True):
+            invalida_gruppi_utente(user_id)
+    elif pk_set:
+        for user_id in pk_set:
+            invalida_gruppi_utente(user_id)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalida_gruppi_tutti(sender, **kwargs):
+    # Un gruppo rinominato o cancellato cambia i gruppi di tutti i suoi utenti
+    invalida_gruppi_utente()
 
 
 class Firma(models.Model):
@@ -529,9 +687,126 @@ class ModuliMissione(models.Model):
     firma_richiedente = models.ForeignKey(Firma, on_delete=models.CASCADE, related_name='richiedente', null=True, blank=True)
     firma_titolare = models.ForeignKey(Firma, on_delete=models.CASCADE, related_name='titolare', null=True, blank=True)
 
+    # JSON con i tempi per modulo e fase dell'ultima generazione (vedi profilazione.py)
+    profilo_generazione = models.TextField(null=True, blank=True, editable=False)
+
     def is_user_allowed(self, user):
         return self.missione.user == user
 
     class Meta:
         verbose_name = "Moduli missione"
         verbose_name_plural = "Moduli missioni"
+
+
+class StatisticaMissioni(models.Model):
+    """
+    Tabella dei fatti per la pagina statistiche: totali delle missioni per struttura, fondo, tipo, mese e
+    destinazione. Viene ricalcolata per intero ogni notte da `manage.py aggiorna_statistiche`.
+    """
+    struttura = models.ForeignKey(StrutturaFondi, on_delete=models.CASCADE, null=True)
+    fondo = models.CharField(max_length=100)
+    tipo = models.CharField(max_length=8, choices=TIPO_MISSIONE_CHOICES, null=True)
+    mese = models.DateField()  # primo giorno del mese di inizio missione
+    stato_destinazione = models.ForeignKey(Stato, on_delete=models.SET_NULL, null=True)
+
+    n_missioni = models.PositiveIntegerField(default=0)
+    giorni = models.PositiveIntegerField(default=0)
+    km = models.FloatField(default=0)
+    # Spese documentate convertite in euro, senza indennità chilometrica (dipende dal prezzo del carburante)
+    totale_euro = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    aggiornato = models.DateTimeField()
+
+    class Meta:
+        verbose_name = "Statistica missioni"
+        verbose_name_plural = "Statistiche missioni"
+        indexes = [
+            models.Index(fields=['struttura', 'mese']),
+            models.Index(fields=['mese']),
+        ]
+
+
+class TassoCambio(models.Model):
+    """
+    Tasso di cambio verso l'euro (unità di valuta per un euro) di un giorno passato, scaricato una volta sola
+    dal servizio della Banca d'Italia. Per i giorni senza quotazione è salvato il tasso del giorno valido
+    precedente, così anche quelli non richiedono più il servizio.
+    """
+    data = models.DateField()
+    valuta = models.CharField(max_length=3)
+    tasso = models.DecimalField(max_digits=20, decimal_places=10)
+
+    class Meta:
+        verbose_name = "Tasso di cambio"
+        verbose_name_plural = "Tassi di cambio"
+        unique_together = ('data', 'valuta')
+
+
+class TermineRicerca(models.Model):
+    """
+    Indice invertito per la ricerca delle missioni sui db senza FULLTEXT (es. SQLite in sviluppo).
+    Mantenuto dai signal in ricerca.py; con MySQL resta vuoto.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    missione = models.ForeignKey(Missione, on_delete=models.CASCADE)
+    termine = models.CharField(max_length=40)
+    peso = models.FloatField()
+
+    class Meta:
+        verbose_name = "Termine di ricerca"
+        verbose_name_plural = "Termini di ricerca"
+        indexes = [
+            models.Index(fields=['user', 'termine']),
+        ]
+
+
+class CheckpointMigrazione(models.Model):
+    """Avanzamento di una migrazione dei dati legacy (`manage.py migra_legacy`): ultima missione elaborata."""
+    nome = models.CharField(max_length=50, unique=True)
+    ultimo_id = models.PositiveIntegerField(default=0)
+    completata = models.BooleanField(default=False)
+    aggiornato = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Checkpoint migrazione"
+        verbose_name_plural = "Checkpoint migrazioni"
+
+
+class EmailInUscita(models.Model):
+    """E-mail in attesa di invio o già inviata dal sender in background (posta.py, `manage.py invia_email`)."""
+    oggetto = models.CharField(max_length=255)
+    testo = models.TextField()
+    mittente = models.CharField(max_length=255)
+    destinatari = models.TextField()  # indirizzi separati da spazi
+    missione = models.ForeignKey(Missione, on_delete=models.SET_NULL, null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+
+    stato = models.CharField(max_length=8, choices=STATO_EMAIL_CHOICES, default="IN_CODA")
+    tentativi = models.PositiveSmallIntegerField(default=0)
+    prossimo_tentativo = models.DateTimeField(default=timezone.now)
+    ultimo_errore = models.TextField(blank=True, default='')
+    creata = models.DateTimeField(auto_now_add=True)
+    inviata = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "E-mail in uscita"
+        verbose_name_plural = "E-mail in uscita"
+        indexes = [
+            models.Index(fields=['stato', 'prossimo_tentativo']),
+        ]
+
+    @property
+    def lista_destinatari(self):
+        return self.destinatari.split()
+
+
+class AllegatoEmail(models.Model):
+    """File già presente nello storage (es. un modulo generato) da allegare a una EmailInUscita."""
+    email = models.ForeignKey(EmailInUscita, on_delete=models.CASCADE, related_name='allegati')
+    percorso = models.CharField(max_length=255)  # nome del file nello storage, relativo a MEDIA_ROOT
+    sha256 = models.CharField(max_length=64)
+    dimensione = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = "Allegato e-mail"
+        verbose_name_plural = "Allegati e-mail"
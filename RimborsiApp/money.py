@@ -0,0 +1,179 @@
+import datetime
+import json
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from django.conf import settings
+
+from RimborsiApp.librerie import requests
+from RimborsiApp.metrics import TASSI_CAMBIO_CACHE
+
+EUR = 'EUR'
+CENTESIMO = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+def to_decimal(value):
+    """
+    Converte un importo (Decimal, float, int, stringa o None) in un Decimal arrotondato al centesimo.
+    I float passano da repr() così 0.1 diventa Decimal('0.10') e non Decimal('0.1000000000000000055...').
+    """
+    if value is None or value == '':
+        return ZERO
+    if isinstance(value, Decimal):
+        d = value
+    elif isinstance(value, float):
+        d = Decimal(repr(value))
+    else:
+        try:
+            d = Decimal(str(value).strip().replace(',', '.'))
+        except InvalidOperation:
+            raise ValueError(f'Importo non valido: {value}')
+    if not d.is_finite():
+        raise ValueError(f'Importo non valido: {value}')
+    return d.quantize(CENTESIMO, rounding=ROUND_HALF_UP)
+
+
+def parse_importo(value):
+    """Come to_decimal, ma una stringa vuota o None restituisce None (importo non inserito)."""
+    if value is None or str(value).strip() == '':
+        return None
+    return to_decimal(value)
+
+
+class Money:
+    """Importo esatto al centesimo con la sua valuta. Somme tra valute diverse non sono ammesse."""
+    __slots__ = ('importo', 'valuta')
+
+    def __init__(self, importo, valuta=EUR):
+        self.importo = to_decimal(importo)
+        self.valuta = valuta or EUR
+
+    def _check(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        if other.valuta != self.valuta:
+            raise ValueError(f'Impossibile sommare {self.valuta} e {other.valuta}')
+        return other
+
+    def __add__(self, other):
+        other = self._check(other)
+        if other is NotImplemented:
+            return other
+        return Money(self.importo + other.importo, self.valuta)
+
+    def __radd__(self, other):
+        # Permette sum() su una lista di Money
+        if other == 0:
+            return self
+        return self.__add__(other)
+
+    def __sub__(self, other):
+        other = self._check(other)
+        if other is NotImplemented:
+            return other
+        return Money(self.importo - other.importo, self.valuta)
+
+    def __neg__(self):
+        return Money(-self.importo, self.valuta)
+
+    def __eq__(self, other):
+        return isinstance(other, Money) and self.importo == other.importo and self.valuta == other.valuta
+
+    def __hash__(self):
+        return hash((self.importo, self.valuta))
+
+    def __bool__(self):
+        return bool(self.importo)
+
+    def __repr__(self):
+        return f'Money({self.importo!r}, {self.valuta!r})'
+
+    def __str__(self):
+        return f'{self.importo:.2f} {self.valuta}'
+
+    def in_euro(self, data):
+        """Converte l'importo in euro al tasso di cambio della data indicata."""
+        if self.valuta == EUR:
+            return self
+        return Money(money_exchange(data, self.valuta, self.importo), EUR)
+
+
+# Cache dei tassi di cambio per (data, valuta): un tasso storico non cambia più, quindi viene scaricato una sola
+# volta e salvato in TassoCambio; in memoria resta una copia per processo per non interrogare il db ogni volta.
+_tassi_di_cambio = {}
+
+
+def carica_tassi_salvati(date=None):
+    """
+    Porta in memoria i tassi salvati in TassoCambio (tutti o solo quelli delle date indicate) con una query.
+    Lo usa il ricalcolo delle statistiche, che converte le spese di tutte le missioni.
+    """
+    from RimborsiApp.models import TassoCambio  # models importa Money da qui
+
+    tassi = TassoCambio.objects.all()
+    if date is not None:
+        tassi = tassi.filter(data__in=date)
+    for data, valuta, tasso in tassi.values_list('data', 'valuta', 'tasso').iterator():
+        _tassi_di_cambio[(data, valuta)] = tasso
+
+
+def _scarica_tasso(data, valuta):
+    url = settings.TASSI_CAMBIO_URL
+    valid_data = data
+    if data.weekday() >= 5:
+        valid_data = data - datetime.timedelta(days=data.weekday() - 4)
+    params = {
+        'startDate': valid_data,
+        'endDate': valid_data,
+        'baseCurrencyIsoCode': valuta,
+        'currencyIsoCode': 'EUR'
+    }
+    headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+    response = requests.get(url, params=params, headers=headers)
+    content = json.loads(response.content)
+
+    if content['resultsInfo']['totalRecords'] != 0:
+        return Decimal(str(content['rates'][0]['avgRate']))
+    # If the day has no valid exchange we are going to get the first valid exchange of previous days
+    return get_tasso_di_cambio(data - datetime.timedelta(days=1), valuta)
+
+
+def get_tasso_di_cambio(data, valuta):
+    from RimborsiApp.models import TassoCambio
+
+    if data >= data.today():
+        data = data.today() - datetime.timedelta(days=1)
+
+    tasso = _tassi_di_cambio.get((data, valuta))
+    if tasso is not None:
+        TASSI_CAMBIO_CACHE.inc(esito='hit')
+        return tasso
+
+    tasso = TassoCambio.objects.filter(data=data, valuta=valuta).values_list('tasso', flat=True).first()
+    if tasso is not None:
+        TASSI_CAMBIO_CACHE.inc(esito='db')
+    else:
+        TASSI_CAMBIO_CACHE.inc(esito='miss')
+        tasso = _scarica_tasso(data, valuta)
+        # Due processi possono scaricare lo stesso tasso insieme: il secondo trova la riga e non fa nulla
+        TassoCambio.objects.get_or_create(data=data, valuta=valuta, defaults={'tasso': tasso})
+
+    _tassi_di_cambio[(data, valuta)] = tasso
+    return tasso
+
+
+def money_exchange(data, valuta, cifra):
+    """
+    :param data: Data a partire da cui si richiedono le quotazioni.
+        Viene interpretata relativamente al fuso orario dell’Europa
+        Centrale nel seguente formato: "yyyy-MM-dd".
+        Se il parametro non viene specificato, o è specificato in un
+        formato errato, il servizio restituirà un messaggio con il formato
+        richiesto.
+    :param valuta: Codice ISO (case insensitive) della valuta per cui si richiede la quotazione
+    :param cifra: Quantità da convertire
+    :return: Quantità convertita in euro, come Decimal arrotondato al centesimo
+    """
+    tasso_cambio = get_tasso_di_cambio(data, valuta)
+    cifra_convertita = to_decimal(cifra) / tasso_cambio
+    return cifra_convertita.quantize(CENTESIMO, rounding=ROUND_HALF_UP)
@@ -0,0 +1,150 @@
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger('RimborsiApp.performance')
+
+# Misure della richiesta in corso nel thread (il server è WSGI: una richiesta per thread alla volta)
+_locale = threading.local()
+_installato = False
+
+
+class Misure:
+    """Tempi e conteggi raccolti durante una richiesta; i tempi sono in millisecondi."""
+    __slots__ = ('inizio', 'db_query', 'db_ms', 'template_ms', 'template_profondita', 'http')
+
+    def __init__(self):
+        self.inizio = time.perf_counter()
+        self.db_query = 0
+        self.db_ms = 0.
+        self.template_ms = 0.
+        self.template_profondita = 0
+        self.http = []  # (host, ms, status)
+
+    @property
+    def totale_ms(self):
+        return (time.perf_counter() - self.inizio) * 1000
+
+    @property
+    def http_ms(self):
+        return sum(ms for _, ms, _ in self.http)
+
+
+def misure_correnti():
+    return getattr(_locale, 'misure', None)
+
+
+def inizia_misure():
+    _locale.misure = Misure()
+    return _locale.misure
+
+
+def termina_misure():
+    misure = misure_correnti()
+    _locale.misure = None
+    return misure
+
+
+def db_wrapper(execute, sql, params, many, context):
+    """Da usare con connection.execute_wrapper(): conta le query e il loro tempo."""
+    misure = misure_correnti()
+    if misure is None:
+        return execute(sql, params, many, context)
+    inizio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        misure.db_query += 1
+        misure.db_ms += (time.perf_counter() - inizio) * 1000
+
+
+# Callback chiamate per ogni chiamata HTTP in uscita: f(host, ms, status)
+osservatori_http = []
+
+
+def installa():
+    """
+    Avvolge una sola volta il render dei template Django e requests.Session.send
+    per misurare tempo di render e chiamate HTTP esterne (Banca d'Italia, MASE) della richiesta.
+    requests viene avvolto solo quando è importato davvero (vedi librerie.py).
+    """
+    global _installato
+    if _installato:
+        return
+    _installato = True
+
+    from django.template.backends.django import Template
+
+    from RimborsiApp import librerie
+
+    render_originale = Template.render
+
+    def render(self, *args, **kwargs):
+        misure = misure_correnti()
+        if misure is None:
+            return render_originale(self, *args, **kwargs)
+        # Solo il render più esterno: render_to_string annidati sono già compresi nel suo tempo
+        misure.template_profondita += 1
+        inizio = time.perf_counter()
+        try:
+            return render_originale(self, *args, **kwargs)
+        finally:
+            misure.template_profondita -= 1
+            if misure.template_profondita == 0:
+                misure.template_ms += (time.perf_counter() - inizio) * 1000
+
+    Template.render = render
+    librerie.dopo_import('requests', _avvolgi_requests)
+
+
+def _avvolgi_requests(requests):
+    send_originale = requests.Session.send
+
+    def send(self, request, **kwargs):
+        inizio = time.perf_counter()
+        status = None
+        try:
+            response = send_originale(self, request, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            host = urlsplit(request.url).hostname or ''
+            ms = (time.perf_counter() - inizio) * 1000
+            misure = misure_correnti()
+            if misure is not None:
+                misure.http.append((host, ms, status))
+            for osservatore in osservatori_http:
+                osservatore(host, ms, status)
+
+    requests.Session.send = send
+
+
+def server_timing(misure, totale_ms):
+    """Valore dell'header Server-Timing, leggibile dagli strumenti di sviluppo del browser."""
+    voci = [
+        f'total;dur={totale_ms:.1f}',
+        f'db;dur={misure.db_ms:.1f};desc="{misure.db_query} query"',
+        f'tpl;dur={misure.template_ms:.1f}',
+    ]
+    if misure.http:
+        voci.append(f'http;dur={misure.http_ms:.1f};desc="{len(misure.http)} chiamate"')
+    return ', '.join(voci)
+
+
+def log_richiesta(request, response, misure, totale_ms, byte):
+    resolver_match = getattr(request, 'resolver_match', None)
+    logger.info(json.dumps({
+        'metodo': request.method,
+        'path': request.path,
+        'vista': resolver_match.view_name if resolver_match else None,
+        'status': response.status_code,
+        'utente': request.user.pk if getattr(request, 'user', None) and request.user.is_authenticated else None,
+        'totale_ms': round(totale_ms, 1),
+        'db_query': misure.db_query,
+        'db_ms': round(misure.db_ms, 1),
+        'template_ms': round(misure.template_ms, 1),
+        'http': [{'host': h, 'ms': round(ms, 1), 'status': s} for h, ms, s in misure.http],
+        'byte': byte,
+    }))
@@ -0,0 +1,279 @@
+"""
+Coda delle e-mail in uscita: le viste salvano il messaggio in EmailInUscita e tornano subito, l'invio SMTP avviene
+fuori dalla richiesta. Un SMTP lento o irraggiungibile non blocca più il worker e non produce un 500.
+
+L'invio lo fa un thread del processo web, svegliato al commit della transazione che ha accodato il messaggio
+(EMAIL_CODA_THREAD, attivo di default), oppure `manage.py invia_email [--continuo]` da cron o come servizio.
+Ogni giro usa una sola connessione SMTP per tutti i messaggi in scadenza; un messaggio fallito viene ritentato
+con attesa esponenziale e dopo MAX_TENTATIVI resta in stato ERRORE con l'ultimo errore, visibile nell'admin.
+I messaggi sono prenotati con un UPDATE condizionale, quindi più sender (thread di più worker e comando) possono
+girare insieme senza inviare due volte lo stesso messaggio.
+
+Gli allegati sono file già presenti nello storage (i moduli generati da compila_pdf): non vengono rigenerati
+né passano dal browser. Il file è letto una volta sola, all'accodamento (prepara_allegato), a blocchi da cui si
+calcolano insieme lo sha256 e la codifica base64. Il risultato codificato sta comunque tutto in memoria, come
+serve a EmailMessage, e resta in una cache LRU per hash (CACHE_ALLEGATI_BYTE): il thread di invio dello stesso
+processo non rilegge il disco e lo stesso modulo inviato più volte si codifica una volta. Se il file non si
+può leggere prepara_allegato solleva OSError, e la vista decide se accodare il messaggio senza.
+Un sender in un altro processo legge il file dallo storage; se nel frattempo il modulo è stato rigenerato viene
+allegata la versione corrente e l'hash dell'allegato aggiornato.
+
+Per provare senza SMTP: EMAIL_BACKEND=django.core.mail.backends.filebased.EmailBackend (file in EMAIL_FILE_PATH)
+oppure django.core.mail.backends.console.EmailBackend.
+"""
+import base64
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from email.mime.base import MIMEBase
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from RimborsiApp.metrics import EMAIL_TOTALE
+from RimborsiApp.models import AllegatoEmail, EmailInUscita
+
+logger = logging.getLogger(__name__)
+
+BLOCCO = 50
+MAX_TENTATIVI = 6
+ATTESA_BASE = 60  # secondi prima del secondo tentativo, poi raddoppia (1, 2, 4, 8, 16 minuti)
+TIMEOUT_INVIO = 10 * 60  # un messaggio IN_INVIO da più di così (sender interrotto) torna disponibile
+INTERVALLO = 60  # secondi tra due giri del thread quando nessuno lo sveglia, per i tentativi rimandati
+
+DA_INVIARE = ('IN_CODA', 'IN_INVIO')
+
+# Multiplo di 57 byte: ogni blocco codificato con encodebytes è fatto di righe base64 complete da 76 caratteri
+BLOCCO_LETTURA = 57 * 1024
+CACHE_ALLEGATI_BYTE = 32 * 1024 * 1024
+
+
+# Allegato già letto dallo storage, pronto da accodare
+AllegatoLetto = namedtuple('AllegatoLetto', 'percorso sha256 dimensione')
+
+
+def mittente_predefinito():
+    return f'Sistema Gestione Missioni <{settings.EMAIL_HOST_USER}>'
+
+
+def accoda_email(oggetto, testo, destinatari, mittente=None, missione=None, user=None, allegati=()):
+    """
+    Salva il messaggio nella coda; il thread di invio parte solo dopo il commit della transazione corrente.
+    allegati: AllegatoLetto, o FieldFile e nomi di file nello storage da allegare così come sono (questi ultimi
+    vengono letti qui e un file mancante fa sollevare OSError).
+    Gli indirizzi vanno validati prima (validate_email): qui si rifiuta solo un elenco vuoto, che Django
+    "invierebbe" senza consegnare nulla.
+    """
+    destinatari = list(destinatari)
+    if not destinatari:
+        raise ValueError('Nessun destinatario')
+    # Letti prima della transazione: la lettura dal disco non tiene aperta la transazione
+    letti = [a if isinstance(a, AllegatoLetto) else prepara_allegato(a) for a in allegati]
+    with transaction.atomic():
+        email = EmailInUscita.objects.create(
+            oggetto=oggetto,
+            testo=testo,
+            mittente=mittente or mittente_predefinito(),
+            destinatari=' '.join(destinatari),
+            missione=missione,
+            user=user,
+        )
+        AllegatoEmail.objects.bulk_create([
+            AllegatoEmail(email=email, percorso=percorso, sha256=sha256, dimensione=dimensione)
+            for percorso, sha256, dimensione in letti
+        ])
+    if getattr(settings, 'EMAIL_CODA_THREAD', True):
+        transaction.on_commit(sveglia_sender)
+    return email
+
+
+# Allegati
+
+_cache_allegati = OrderedDict()  # sha256 -> payload base64
+_cache_byte = 0
+_lock_cache = threading.Lock()
+
+
+def _in_cache(sha256, payload):
+    global _cache_byte
+    with _lock_cache:
+        if sha256 in _cache_allegati or len(payload) > CACHE_ALLEGATI_BYTE:
+            return
+        _cache_allegati[sha256] = payload
+        _cache_byte += len(payload)
+        while _cache_byte > CACHE_ALLEGATI_BYTE:
+            _, scartato = _cache_allegati.popitem(last=False)
+            _cache_byte -= len(scartato)
+
+
+def _da_cache(sha256):
+    with _lock_cache:
+        payload = _cache_allegati.get(sha256)
+        if payload is not None:
+            _cache_allegati.move_to_end(sha256)
+        return payload
+
+
+def _leggi_allegato(percorso):
+    """Legge il file a blocchi dallo storage; restituisce (sha256, byte, payload base64) e lo mette in cache."""
+    # I moduli usano OverwriteStorage, che come lo storage di default salva in MEDIA_ROOT
+    sha256 = hashlib.sha256()
+    dimensione = 0
+    righe = []
+    with default_storage.open(percorso, 'rb') as f:
+        for blocco in iter(lambda: f.read(BLOCCO_LETTURA), b''):
+            sha256.update(blocco)
+            dimensione += len(blocco)
+            righe.append(base64.encodebytes(blocco).decode('ascii'))
+    payload = ''.join(righe)
+    _in_cache(sha256.hexdigest(), payload)
+    return sha256.hexdigest(), dimensione, payload
+
+
+def prepara_allegato(file):
+    """Legge un FieldFile (o un nome di file nello storage) per accoda_email; OSError se non è leggibile."""
+    percorso = getattr(file, 'name', file)
+    sha256, dimensione, _ = _leggi_allegato(percorso)
+    return AllegatoLetto(percorso, sha256, dimensione)
+
+
+def _parte_mime(allegato):
+    """Parte MIME già codificata in base64, dalla cache se il contenuto con quell'hash è già stato letto."""
+    payload = _da_cache(allegato.sha256)
+    if payload is None:
+        sha256, dimensione, payload = _leggi_allegato(allegato.percorso)
+        if sha256 != allegato.sha256:
+            logger.info('Allegato %s cambiato dopo l\'accodamento, invio la versione corrente', allegato.percorso)
+            AllegatoEmail.objects.filter(id=allegato.id).update(sha256=sha256, dimensione=dimensione)
+    tipo = mimetypes.guess_type(allegato.percorso)[0] or 'application/octet-stream'
+    parte = MIMEBase(*tipo.split('/', 1))
+    parte.set_payload(payload)
+    parte['Content-Transfer-Encoding'] = 'base64'
+    parte.add_header('Content-Disposition', 'attachment', filename=os.path.basename(allegato.percorso))
+    return parte
+
+
+def _prenota(limite):
+    """Passa a IN_INVIO fino a `limite` messaggi in scadenza e li restituisce."""
+    adesso = timezone.now()
+    candidati = list(EmailInUscita.objects
+                     .filter(stato__in=DA_INVIARE, prossimo_tentativo__lte=adesso)
+                     .order_by('prossimo_tentativo')
+                     .values_list('id', 'prossimo_tentativo')[:limite])
+    prenotati = []
+    for id, prossimo in candidati:
+        # Se un altro sender l'ha già preso, prossimo_tentativo è cambiato e l'UPDATE non tocca nulla
+        if EmailInUscita.objects.filter(id=id, stato__in=DA_INVIARE, prossimo_tentativo=prossimo).update(
+                stato='IN_INVIO', tentativi=F('tentativi') + 1,
+                prossimo_tentativo=adesso + timedelta(seconds=TIMEOUT_INVIO)):
+            prenotati.append(id)
+    return list(EmailInUscita.objects.filter(id__in=prenotati).prefetch_related('allegati').order_by('id'))
+
+
+def messaggio(email, connection=None):
+    """EmailMessage di Django per una riga della coda, con gli allegati."""
+    msg = EmailMessage(email.oggetto, email.testo, email.mittente, email.lista_destinatari, connection=connection)
+    for allegato in email.allegati.all():
+        msg.attach(_parte_mime(allegato))
+    return msg
+
+
+def _inviata(email):
+    EmailInUscita.objects.filter(id=email.id).update(stato='INVIATA', inviata=timezone.now(), ultimo_errore='')
+    EMAIL_TOTALE.inc(esito='inviata')
+
+
+def _fallita(email, errore):
+    adesso = timezone.now()
+    if email.tentativi >= MAX_TENTATIVI:
+        stato, prossimo, esito = 'ERRORE', adesso, 'errore'
+    else:
+        stato, esito = 'IN_CODA', 'rimandata'
+        prossimo = adesso + timedelta(seconds=ATTESA_BASE * 2 ** (email.tentativi - 1))
+    EmailInUscita.objects.filter(id=email.id).update(stato=stato, prossimo_tentativo=prossimo,
+                                                     ultimo_errore=f'{type(errore).__name__}: {errore}')
+    EMAIL_TOTALE.inc(esito=esito)
+    logger.warning('Invio e-mail %s fallito (tentativo %s/%s): %s', email.id, email.tentativi, MAX_TENTATIVI, errore)
+
+
+def invia_in_coda(limite=BLOCCO):
+    """
+    Invia i messaggi in scadenza (al più `limite`) con una sola connessione; restituisce (inviati, falliti).
+    Dopo un errore la connessione viene chiusa e riaperta per il messaggio successivo; se non si riesce ad aprirla
+    tutti i messaggi rimasti vengono rimandati.
+    """
+    email = _prenota(limite)
+    inviati = falliti = 0
+    if not email:
+        return inviati, falliti
+    connection = get_connection(fail_silently=False)
+    try:
+        for i, corrente in enumerate(email):
+            try:
+                connection.open()  # non fa nulla se la connessione è già aperta
+            except Exception as e:
+                for rimasta in email[i:]:
+                    _fallita(rimasta, e)
+                falliti += len(email) - i
+                break
+            try:
+                messaggio(corrente, connection).send()
+            except Exception as e:
+                _fallita(corrente, e)
+                falliti += 1
+                connection.close()
+            else:
+                _inviata(corrente)
+                inviati += 1
+    finally:
+        connection.close()
+    return inviati, falliti
+
+
+def svuota_coda(limite=BLOCCO):
+    """Chiama invia_in_coda finché ci sono messaggi in scadenza; restituisce i totali (inviati, falliti)."""
+    inviati = falliti = 0
+    while True:
+        n_inviati, n_falliti = invia_in_coda(limite)
+        if not n_inviati and not n_falliti:
+            return inviati, falliti
+        inviati += n_inviati
+        falliti += n_falliti
+
+
+# Thread di invio nel processo web
+
+_sveglia = threading.Event()
+_lock = threading.Lock()
+_thread = None
+
+
+def _ciclo():
+    while True:
+        _sveglia.wait(INTERVALLO)
+        _sveglia.clear()
+        close_old_connections()
+        try:
+            svuota_coda()
+        except Exception:
+            logger.exception('Errore nel thread di invio delle e-mail')
+        finally:
+            close_old_connections()
+
+
+def sveglia_sender():
+    """Avvia il thread di invio se non è attivo e gli fa fare subito un giro."""
+    global _thread
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_ciclo, name='invio-email', daemon=True)
+            _thread.start()
+    _sveglia.set()
@@ -0,0 +1,113 @@
+"""
+Tempi delle fasi della generazione dei moduli (genera_pdf).
+
+Ogni compila_* è un modulo; dentro al modulo le fasi con nome (docx, overlay, merge, immagini, firme,
+scrittura) sommano il proprio tempo. Il tempo sul db viene misurato a parte per ogni modulo con un
+execute_wrapper, quindi si sovrappone alle fasi che salvano (es. FileField.save in scrittura).
+Fuori da profila_generazione() fase() non misura nulla.
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from RimborsiApp.metrics import PDF_FASE_SECONDI
+
+_locale = threading.local()
+
+
+class ProfiloGenerazione:
+    """Millisecondi per modulo e fase di una generazione dei moduli."""
+
+    def __init__(self):
+        self.inizio = time.perf_counter()
+        self.moduli = {}  # modulo -> {fase: ms}
+        self.modulo = 'genera_pdf'
+
+    def aggiungi(self, fase, ms):
+        tempi = self.moduli.setdefault(self.modulo, {})
+        tempi[fase] = tempi.get(fase, 0.) + ms
+
+    def come_dict(self):
+        return {
+            'data': timezone.now().isoformat(),
+            'totale_ms': round((time.perf_counter() - self.inizio) * 1000, 1),
+            'moduli': {m: {f: round(ms, 1) for f, ms in tempi.items()} for m, tempi in self.moduli.items()},
+        }
+
+    def json(self):
+        return json.dumps(self.come_dict())
+
+
+def profilo_corrente():
+    return getattr(_locale, 'profilo', None)
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    profilo = profilo_corrente()
+    inizio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if profilo is not None:
+            profilo.aggiungi('db', (time.perf_counter() - inizio) * 1000)
+
+
+def file_cprofile(missione_id):
+    """Percorso del dump cProfile, leggibile con pstats o convertibile in flamegraph (es. flameprof, snakeviz)."""
+    cartella = getattr(settings, 'PDF_PROFILE_DIR', None) or os.path.join(settings.BASE_DIR, 'profili')
+    os.makedirs(cartella, exist_ok=True)
+    return os.path.join(cartella, f'genera_pdf_{missione_id}_{timezone.now():%Y%m%d_%H%M%S}.prof')
+
+
+@contextmanager
+def profila_generazione(percorso_cprofile=None):
+    """Raccoglie i tempi delle fasi nel thread corrente; con percorso_cprofile salva anche il profilo cProfile."""
+    profilo = _locale.profilo = ProfiloGenerazione()
+    profiler = cProfile.Profile() if percorso_cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with connection.execute_wrapper(_db_wrapper):
+            yield profilo
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(percorso_cprofile)
+        _locale.profilo = None
+
+
+@contextmanager
+def modulo(nome):
+    """Un compila_*: osserva la durata su /metrics e attribuisce al modulo le fasi al suo interno."""
+    profilo = profilo_corrente()
+    precedente = profilo.modulo if profilo is not None else None
+    if profilo is not None:
+        profilo.modulo = nome
+    inizio = time.perf_counter()
+    try:
+        with PDF_FASE_SECONDI.time(fase=nome):
+            yield
+    finally:
+        if profilo is not None:
+            profilo.aggiungi('totale', (time.perf_counter() - inizio) * 1000)
+            profilo.modulo = precedente
+
+
+@contextmanager
+def fase(nome):
+    profilo = profilo_corrente()
+    if profilo is None:
+        yield
+        return
+    inizio = time.perf_counter()
+    try:
+        yield
+    finally:
+        profilo.aggiungi(nome, (time.perf_counter() - inizio) * 1000)
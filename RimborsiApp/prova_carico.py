@@ -0,0 +1,266 @@
+"""
+Prova di carico (`manage.py prova_carico`): utenti virtuali concorrenti ripetono il percorso tipico di fine
+anno (login Shibboleth, creazione della missione, salvataggio delle card, caricamento di uno scontrino,
+resoconto e generazione dei moduli) contro un'istanza in esecuzione, avviata con i servizi locali
+(`manage.py servizi_locali`) al posto di Banca d'Italia, MASE e SMTP.
+
+Gli utenti sono quelli sintetici di genera_dati_sintetici. Dal db, lo stesso dell'istanza, vengono letti solo
+lo stato di destinazione e gli id delle missioni create, perché crea_missione reindirizza alla lista senza
+restituire l'id.
+"""
+import datetime
+import os
+import random
+import threading
+import time
+import uuid
+
+import requests
+from django.conf import settings
+from django.db import connection
+from django.urls import reverse
+
+from RimborsiApp.benchmark import percentile
+from RimborsiApp.dati_sintetici import CARTELLA_FILE, PREFISSO_USERNAME
+from RimborsiApp.models import Missione, Stato
+
+PASSI = ('login', 'lista_missioni', 'crea_missione_form', 'crea_missione', 'missione', 'save_pasto',
+         'save_pasto_update', 'save_trasporto', 'save_trasporto_update', 'save_pernottamento', 'resoconto',
+         'genera_pdf', 'invia_email_autorizzazione')
+
+
+class Statistiche:
+    """Latenze ed errori per passo, condivisi tra i thread degli utenti virtuali."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tempi = {}  # passo -> [ms]
+        self.errori = {}  # passo -> numero
+        self.esempi_errori = {}  # passo -> primo errore visto
+        self.percorsi = 0
+
+    def registra(self, passo, ms, errore=None):
+        with self._lock:
+            self.tempi.setdefault(passo, []).append(ms)
+            if errore is not None:
+                self.errori[passo] = self.errori.get(passo, 0) + 1
+                self.esempi_errori.setdefault(passo, errore)
+
+    def percorso_completato(self):
+        with self._lock:
+            self.percorsi += 1
+
+    def rapporto(self, durata):
+        passi = {}
+        for passo in sorted(self.tempi, key=lambda p: PASSI.index(p) if p in PASSI else len(PASSI)):
+            tempi = self.tempi[passo]
+            passi[passo] = {
+                'richieste': len(tempi),
+                'errori': self.errori.get(passo, 0),
+                'richieste_al_secondo': round(len(tempi) / durata, 2),
+                'ms': {p: round(percentile(tempi, int(p[1:])), 1) for p in ('p50', 'p90', 'p95', 'p99')},
+            }
+            passi[passo]['ms']['max'] = round(max(tempi), 1)
+            if passo in self.esempi_errori:
+                passi[passo]['esempio_errore'] = self.esempi_errori[passo]
+        richieste = sum(len(t) for t in self.tempi.values())
+        return {
+            'durata_s': round(durata, 1),
+            'richieste': richieste,
+            'errori': sum(self.errori.values()),
+            'richieste_al_secondo': round(richieste / durata, 2),
+            'percorsi_completati': self.percorsi,
+            'percorsi_al_minuto': round(self.percorsi / durata * 60, 2),
+            'passi': passi,
+        }
+
+
+class ErrorePasso(Exception):
+    pass
+
+
+def _giorno_feriale(data, indietro=True):
+    while data.weekday() >= 5:
+        data += datetime.timedelta(days=-1 if indietro else 1)
+    return data
+
+
+class UtenteVirtuale:
+    """Un utente sintetico con la propria sessione HTTP; ogni percorso crea una nuova missione."""
+
+    def __init__(self, base_url, username, stato_id, statistiche, rng, pensiero=1., quota_email=0.2,
+                 file_scontrini=()):
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.stato_id = stato_id
+        self.statistiche = statistiche
+        self.rng = rng
+        self.pensiero = pensiero
+        self.quota_email = quota_email
+        self.file_scontrini = file_scontrini
+        self.session = requests.Session()
+
+    def pausa(self):
+        if self.pensiero:
+            time.sleep(self.rng.uniform(0.5, 1.5) * self.pensiero)
+
+    def richiesta(self, passo, metodo, percorso, **kwargs):
+        """Esegue la richiesta senza seguire i redirect; un errore HTTP o di rete interrompe il percorso."""
+        headers = kwargs.pop('headers', {})
+        if metodo == 'POST':
+            headers['X-CSRFToken'] = self.session.cookies.get('csrftoken', '')
+        inizio = time.perf_counter()
+        try:
+            response = self.session.request(metodo, self.base_url + percorso, headers=headers,
+                                            allow_redirects=False, timeout=120, **kwargs)
+        except requests.RequestException as e:
+            self.statistiche.registra(passo, (time.perf_counter() - inizio) * 1000, f'{type(e).__name__}: {e}')
+            raise ErrorePasso(passo)
+        ms = (time.perf_counter() - inizio) * 1000
+        if response.status_code >= 400:
+            self.statistiche.registra(passo, ms, f'HTTP {response.status_code}: {response.text[:200]}')
+            raise ErrorePasso(passo)
+        self.statistiche.registra(passo, ms)
+        return response
+
+    def login(self):
+        self.richiesta('login', 'GET', reverse('shibboleth:login', args=[1]), headers={
+            'Eppn': self.username,
+            'Mail': f'{self.username}@example.org',
+            'Givenname': 'Utente',
+            'Sn': 'Sintetico',
+        })
+
+    def _json(self, passo, percorso, dati, **kwargs):
+        response = self.richiesta(passo, 'POST', percorso, data=dati, **kwargs)
+        return response.json()['id']
+
+    def percorso(self):
+        rng = self.rng
+        self.richiesta('lista_missioni', 'GET', reverse('RimborsiApp:lista_missioni'))
+        self.pausa()
+
+        # Missione nel futuro, dal lunedì al mercoledì, così tutte le date dei moduli cadono in giorni feriali
+        oggi = datetime.date.today()
+        inizio = oggi + datetime.timedelta(days=14 - oggi.weekday() + 7 * rng.randint(0, 8))
+        fine = inizio + datetime.timedelta(days=2)
+        motivazione = f'Prova di carico {uuid.UUID(int=rng.getrandbits(128)).hex[:12]}'
+        self.richiesta('crea_missione_form', 'GET', reverse('RimborsiApp:crea_missione'))
+        self.pausa()
+        self.richiesta('crea_missione', 'POST', reverse('RimborsiApp:crea_missione'), data={
+            'citta_destinazione': 'Bologna', 'stato_destinazione': self.stato_id,
+            'inizio': inizio.isoformat(), 'inizio_ora': '08:30', 'fine': fine.isoformat(), 'fine_ora': '19:00',
+            'fondo': 'FAR 2024', 'motivazione': motivazione, 'struttura_fondi': 'Dipartimento di Ingegneria',
+            'tipo': 'RICERCA', 'anticipo': '0', 'mezzi_previsti': ['TRENO'],
+        })
+        missione_id = Missione.objects.filter(user__username=self.username, motivazione=motivazione) \
+            .values_list('id', flat=True).first()
+        if missione_id is None:
+            # La POST è stata respinta dalla validazione del form: 200 con il form e gli errori
+            self.statistiche.registra('crea_missione', 0., 'missione non creata')
+            raise ErrorePasso('crea_missione')
+
+        self.richiesta('missione', 'GET', reverse('RimborsiApp:missione', args=[missione_id]))
+        self.pausa()
+
+        # Le card salvano a ogni modifica: una creazione seguita da un aggiornamento
+        pasto = {'mission_id': missione_id, 'data': inizio.isoformat(), 'importo1': '12.50', 'valuta1': 'EUR',
+                 'descrizione1': 'Pranzo'}
+        pasto_id = self._json('save_pasto', reverse('RimborsiApp:save_pasto'), pasto)
+        pasto.update({'importo2': '28.00', 'valuta2': 'EUR', 'descrizione2': 'Cena'})
+        self._json('save_pasto_update', reverse('RimborsiApp:save_pasto_update', args=[pasto_id]), pasto)
+        self.pausa()
+        trasporto = {'mission_id': missione_id, 'data': inizio.isoformat(), 'costo': '24.90', 'mezzo': 'TRENO',
+                     'valuta': 'EUR', 'da': 'Modena', 'a': 'Bologna', 'tipo_costo': 'BIGLIETTO', 'km': ''}
+        trasporto_id = self._json('save_trasporto', reverse('RimborsiApp:save_trasporto'), trasporto)
+        trasporto['costo'] = '26.40'
+        self._json('save_trasporto_update', reverse('RimborsiApp:save_trasporto_update', args=[trasporto_id]),
+                   trasporto)
+        self.pausa()
+
+        pernottamento = {'mission_id': missione_id, 'data': inizio.isoformat(), 'importo': '180.00',
+                         'valuta': 'EUR', 'descrizione': 'Hotel'}
+        if self.file_scontrini:
+            percorso_file = rng.choice(self.file_scontrini)
+            with open(percorso_file, 'rb') as f:
+                self._json('save_pernottamento', reverse('RimborsiApp:save_pernottamento'), pernottamento,
+                           files={'img_scontrino': (os.path.basename(percorso_file), f.read())})
+        else:
+            self._json('save_pernottamento', reverse('RimborsiApp:save_pernottamento'), pernottamento)
+        self.pausa()
+
+        self.richiesta('resoconto', 'GET', reverse('RimborsiApp:resoconto', args=[missione_id]))
+        self.pausa()
+        prima = _giorno_feriale(inizio - datetime.timedelta(days=3))
+        dopo = _giorno_feriale(fine + datetime.timedelta(days=2), indietro=False)
+        self.richiesta('genera_pdf', 'POST', reverse('RimborsiApp:genera_pdf', args=[missione_id]), data={
+            'anticipo': (inizio - datetime.timedelta(days=7)).isoformat(), 'parte_1': prima.isoformat(),
+            'kasko': prima.isoformat(), 'dottorandi': prima.isoformat(), 'parte_2': dopo.isoformat(),
+            'atto_notorio': dopo.isoformat(), 'dichiarazione_check_std': 'on',
+        })
+
+        if rng.random() < self.quota_email:
+            self.pausa()
+            self.richiesta('invia_email_autorizzazione', 'POST',
+                           reverse('RimborsiApp:invia_email_autorizzazione', args=[missione_id]),
+                           data={'emails': 'responsabile@example.org',
+                                 'textarea-email': 'Richiesta di autorizzazione alla missione.'})
+        self.statistiche.percorso_completato()
+
+    def esegui(self, fine):
+        """Login e percorsi ripetuti fino all'istante fine (time.monotonic)."""
+        try:
+            self.login()
+            while time.monotonic() < fine:
+                try:
+                    self.percorso()
+                except ErrorePasso:
+                    # Ripartire subito martellerebbe il passo che fallisce
+                    time.sleep(self.pensiero or 1.)
+                self.pausa()
+        except ErrorePasso:
+            pass
+        finally:
+            connection.close()
+
+
+def file_scontrini():
+    cartella = os.path.join(settings.MEDIA_ROOT, CARTELLA_FILE)
+    if not os.path.isdir(cartella):
+        return ()
+    return tuple(os.path.join(cartella, nome) for nome in sorted(os.listdir(cartella)))
+
+
+def stato_destinazione():
+    stati = Stato.objects.order_by('pk')
+    stato = stati.filter(nome__iexact='italia').first() or stati.first()
+    return stato and stato.pk
+
+
+def esegui_prova(base_url, n_utenti, durata, rampa=0., pensiero=1., seed=0, quota_email=0.2):
+    """Avvia n_utenti utenti virtuali, distribuiti su rampa secondi, e restituisce il rapporto dopo durata secondi."""
+    stato_id = stato_destinazione()
+    if stato_id is None:
+        raise ValueError('Nessuno stato nel db: caricare prima le tabelle di riferimento.')
+    scontrini = file_scontrini()
+    statistiche = Statistiche()
+
+    inizio = time.monotonic()
+    fine = inizio + rampa + durata
+    threads = []
+    for i in range(n_utenti):
+        avvio = inizio + (rampa * i / n_utenti if n_utenti else 0)
+        attesa = avvio - time.monotonic()
+        if attesa > 0:
+            time.sleep(attesa)
+        utente = UtenteVirtuale(base_url, f'{PREFISSO_USERNAME}-{seed}-{i}', stato_id, statistiche,
+                                random.Random(f'{seed}-{i}'), pensiero, quota_email, scontrini)
+        thread = threading.Thread(target=utente.esegui, args=(fine,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    dati = statistiche.rapporto(time.monotonic() - inizio)
+    dati.update({'url': base_url, 'utenti': n_utenti, 'rampa_s': rampa, 'pensiero_s': pensiero, 'seed': seed})
+    return dati
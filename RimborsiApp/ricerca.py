@@ -0,0 +1,229 @@
+from collections import Counter, defaultdict
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from RimborsiApp.riferimenti import normalizza_nome
+
+RISULTATI_MAX = 50
+
+# Peso di ogni campo nel punteggio: la destinazione conta più di una parola nella descrizione di uno scontrino
+PESI = {
+    'citta_destinazione': 3.,
+    'fondo': 2.,
+    'motivazione': 1.,
+    'descrizione': 1.,
+}
+
+# Campi di Missione cercati, ognuno con il proprio peso
+CAMPI_MISSIONE = ('citta_destinazione', 'fondo', 'motivazione')
+
+# Indici FULLTEXT usati con MySQL, creati da `manage.py indici_ricerca`. Un indice per colonna di Missione:
+# MATCH deve usare esattamente le colonne di un indice, e serve un MATCH per campo per pesarli diversamente.
+INDICI_FULLTEXT = tuple(
+    ('RimborsiApp.Missione', f'ricerca_missione_{campo}_ft', (campo,)) for campo in CAMPI_MISSIONE
+) + (
+    ('RimborsiApp.Spesa', 'ricerca_spesa_ft', ('descrizione',)),
+    ('RimborsiApp.Pasto', 'ricerca_pasto_ft', ('descrizione',)),
+)
+# Indici delle versioni precedenti, rimossi da `manage.py indici_ricerca`
+INDICI_OBSOLETI = (
+    ('RimborsiApp.Missione', 'ricerca_missione_ft'),
+)
+
+
+def usa_fulltext():
+    """MySQL usa i propri indici FULLTEXT, gli altri db (es. SQLite in sviluppo) l'indice invertito TermineRicerca."""
+    return connection.vendor == 'mysql'
+
+
+def termini(testo):
+    return [t for t in normalizza_nome(testo or '').split() if len(t) > 1]
+
+
+def _model(nome):
+    return apps.get_model(nome)
+
+
+# ------------------------------------------------------------------------------------------------------------------ #
+# MySQL: MATCH ... AGAINST sugli indici FULLTEXT
+
+def _match_sql(model, colonne):
+    tabella = connection.ops.quote_name(model._meta.db_table)
+    campi = ', '.join(f'{tabella}.{connection.ops.quote_name(model._meta.get_field(c).column)}' for c in colonne)
+    return f'MATCH ({campi}) AGAINST (%s IN BOOLEAN MODE)'
+
+
+def _match(model, colonne, testo):
+    return RawSQL(_match_sql(model, colonne), [testo])
+
+
+def _match_pesato(model, campi, testo):
+    """Somma di un MATCH per campo, ognuno moltiplicato per il suo peso in PESI."""
+    sql = ' + '.join(f'{_match_sql(model, (campo,))} * {PESI[campo]!r}' for campo in campi)
+    return RawSQL(f'({sql})', [testo] * len(campi))
+
+
+def _cerca_fulltext(user, parole):
+    # Ricerca per prefisso su ogni parola; InnoDB ignora le parole più corte di innodb_ft_min_token_size (3)
+    testo = ' '.join(f'{p}*' for p in parole if len(p) >= 3)
+    punteggi = defaultdict(float)
+    if not testo:
+        return punteggi
+    Missione, Spesa, Pasto = _model('RimborsiApp.Missione'), _model('RimborsiApp.Spesa'), _model('RimborsiApp.Pasto')
+
+    missioni = Missione.objects.filter(user=user).annotate(punteggio=_match_pesato(Missione, CAMPI_MISSIONE, testo)) \
+        .filter(punteggio__gt=0).values_list('id', 'punteggio')
+    for id, punteggio in missioni:
+        punteggi[id] += punteggio
+
+    # La query parte da Spesa perché il MATCH deve riferirsi alla tabella principale della query
+    spese = Spesa.objects.filter(spesamissione__missione__user=user).annotate(
+        punteggio=_match(Spesa, ('descrizione',), testo)).filter(punteggio__gt=0) \
+        .values_list('spesamissione__missione', 'punteggio')
+    for id, punteggio in spese:
+        punteggi[id] += punteggio * PESI['descrizione']
+
+    pasti = Pasto.objects.filter(pasti__missione__user=user).annotate(
+        punteggio=_match(Pasto, ('descrizione',), testo)).filter(punteggio__gt=0) \
+        .values_list('pasti__missione', 'punteggio')
+    for id, punteggio in pasti:
+        punteggi[id] += punteggio * PESI['descrizione']
+    return punteggi
+
+
+# ------------------------------------------------------------------------------------------------------------------ #
+# Altri db: indice invertito (utente, termine) -> missione mantenuto dai signal
+
+def testi_missione(missione_id):
+    """Coppie (campo, testo) indicizzate per una missione: i suoi campi e le descrizioni delle spese."""
+    Missione, SpesaMissione, Pasto = _model('RimborsiApp.Missione'), _model('RimborsiApp.SpesaMissione'), \
+        _model('RimborsiApp.Pasto')
+    testi = []
+    campi = Missione.objects.filter(id=missione_id).values('citta_destinazione', 'motivazione', 'fondo').first()
+    if campi is None:
+        return testi
+    testi.extend(campi.items())
+    testi.extend(('descrizione', d) for d in SpesaMissione.objects.filter(missione_id=missione_id)
+                 .exclude(spesa__descrizione=None).values_list('spesa__descrizione', flat=True))
+    testi.extend(('descrizione', d) for d in Pasto.objects.filter(pasti__missione_id=missione_id)
+                 .exclude(descrizione=None).values_list('descrizione', flat=True))
+    return testi
+
+
+def indicizza_missione(missione_id):
+    """Ricostruisce le righe dell'indice invertito di una missione."""
+    Missione, TermineRicerca = _model('RimborsiApp.Missione'), _model('RimborsiApp.TermineRicerca')
+    user_id = Missione.objects.filter(id=missione_id).values_list('user_id', flat=True).first()
+    pesi = Counter()
+    for campo, testo in testi_missione(missione_id):
+        for t in termini(testo):
+            pesi[t[:TermineRicerca._meta.get_field('termine').max_length]] += PESI[campo]
+    with transaction.atomic():
+        TermineRicerca.objects.filter(missione_id=missione_id).delete()
+        if user_id is not None:
+            TermineRicerca.objects.bulk_create([TermineRicerca(user_id=user_id, missione_id=missione_id,
+                                                               termine=t, peso=p) for t, p in pesi.items()])
+
+
+def _cerca_indice(user, parole):
+    TermineRicerca = _model('RimborsiApp.TermineRicerca')
+    punteggi = defaultdict(float)
+    trovate = Counter()
+    for p in parole:
+        righe = TermineRicerca.objects.filter(user=user, termine__startswith=p).values_list('missione', 'peso')
+        per_missione = defaultdict(float)
+        for id, peso in righe:
+            per_missione[id] += peso
+        for id, peso in per_missione.items():
+            punteggi[id] += peso
+            trovate[id] += 1
+    # Le missioni che contengono tutte le parole cercate vengono prima
+    return {id: trovate[id] * 1000 + punteggio for id, punteggio in punteggi.items()}
+
+
+def cerca_missioni(user, testo, n=RISULTATI_MAX):
+    """Missioni dell'utente che corrispondono al testo, ordinate per rilevanza e con l'attributo punteggio."""
+    parole = termini(testo)
+    if not parole:
+        return []
+    punteggi = _cerca_fulltext(user, parole) if usa_fulltext() else _cerca_indice(user, parole)
+    migliori = sorted(punteggi, key=lambda id: (-punteggi[id], -id))[:n]
+    if not migliori:
+        return []
+    missioni = _model('RimborsiApp.Missione').objects.filter(user=user).select_related('stato_destinazione') \
+        .in_bulk(migliori)
+    risultati = []
+    for id in migliori:
+        m = missioni.get(id)
+        if m is not None:
+            m.punteggio = punteggi[id]
+            risultati.append(m)
+    return risultati
+
+
+def _reindicizza_dopo_commit(missione_id):
+    if missione_id is not None and not usa_fulltext():
+        transaction.on_commit(lambda: indicizza_missione(missione_id))
+
+
+@receiver(post_save, sender='RimborsiApp.Missione')
+def reindicizza_missione(sender, instance, **kwargs):
+    _reindicizza_dopo_commit(instance.pk)
+
+
+@receiver([post_save, post_delete], sender='RimborsiApp.SpesaMissione')
+def reindicizza_spesa_missione(sender, instance, **kwargs):
+    _reindicizza_dopo_commit(instance.missione_id)
+
+
+@receiver(post_save, sender='RimborsiApp.Spesa')
+def reindicizza_spesa(sender, instance, **kwargs):
+    if usa_fulltext():
+        return
+    SpesaMissione = _model('RimborsiApp.SpesaMissione')
+    for missione_id in SpesaMissione.objects.filter(spesa=instance).values_list('missione_id', flat=True):
+        _reindicizza_dopo_commit(missione_id)
+
+
+@receiver([post_save, post_delete], sender='RimborsiApp.Pasto')
+def reindicizza_pasto(sender, instance, **kwargs):
+    if usa_fulltext():
+        return
+    Pasti = _model('RimborsiApp.Pasti')
+    _reindicizza_dopo_commit(Pasti.objects.filter(id=instance.pasti_id).values_list('missione_id', flat=True).first())
+
+
+def _esiste_indice(cursor, tabella, nome_indice):
+    cursor.execute('SELECT COUNT(*) FROM information_schema.statistics '
+                   'WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s',
+                   [tabella, nome_indice])
+    return bool(cursor.fetchone()[0])
+
+
+def crea_indici_fulltext():
+    """
+    Crea su MySQL gli indici FULLTEXT mancanti e rimuove quelli obsoleti.
+    Restituisce i nomi degli indici creati e quelli rimossi.
+    """
+    creati, rimossi = [], []
+    with connection.cursor() as cursor:
+        for nome_model, nome_indice in INDICI_OBSOLETI:
+            tabella = _model(nome_model)._meta.db_table
+            if _esiste_indice(cursor, tabella, nome_indice):
+                cursor.execute(f'ALTER TABLE {connection.ops.quote_name(tabella)} '
+                               f'DROP INDEX {connection.ops.quote_name(nome_indice)}')
+                rimossi.append(nome_indice)
+        for nome_model, nome_indice, colonne in INDICI_FULLTEXT:
+            model = _model(nome_model)
+            tabella = model._meta.db_table
+            if _esiste_indice(cursor, tabella, nome_indice):
+                continue
+            campi = ', '.join(connection.ops.quote_name(model._meta.get_field(c).column) for c in colonne)
+            cursor.execute(f'ALTER TABLE {connection.ops.quote_name(tabella)} '
+                           f'ADD FULLTEXT INDEX {connection.ops.quote_name(nome_indice)} ({campi})')
+            creati.append(nome_indice)
+    return creati, rimossi
@@ -0,0 +1,259 @@
+import bisect
+import re
+import threading
+import time
+import unicodedata
+import uuid
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+
+# Ogni processo rilegge la versione dalla cache condivisa al più una volta ogni tanti secondi
+VERIFICA_VERSIONE_SECONDI = 5
+
+
+def _nuova_versione():
+    return uuid.uuid4().hex
+
+
+class TabellaRiferimento:
+    """
+    Cache in memoria di una tabella di riferimento (stati, categorie, comuni, province).
+
+    Le righe sono caricate una volta per processo; la versione è tenuta nella cache condivisa di Django
+    (CACHES in settings), così una modifica fatta da un worker (es. dall'admin) fa ricaricare la tabella anche
+    agli altri, entro VERIFICA_VERSIONE_SECONDI. Il worker che fa la modifica la vede subito.
+    Se la chiave di versione sparisce dalla cache ne viene creata una nuova e la tabella viene ricaricata.
+    Le istanze restituite sono condivise tra le richieste e non vanno modificate.
+    """
+
+    def __init__(self, nome, model, select_related=()):
+        self.nome = nome
+        self.model = model
+        self.select_related = select_related
+        self._versione = None
+        self._versione_letta = None  # (versione, time.monotonic() della lettura dalla cache)
+        self._per_pk = None
+        self._lista = None
+        self._lock = threading.Lock()
+
+    @property
+    def chiave(self):
+        return f'riferimenti_versione_{self.nome}'
+
+    def _carica(self):
+        model = apps.get_model(self.model)
+        righe = list(model.objects.select_related(*self.select_related).order_by('pk'))
+        return {r.pk: r for r in righe}, righe
+
+    def _dati(self):
+        versione = self.versione
+        if self._per_pk is None or versione != self._versione:
+            with self._lock:
+                if self._per_pk is None or versione != self._versione:
+                    self._per_pk, self._lista = self._carica()
+                    self._versione = versione
+        return self._per_pk, self._lista
+
+    @property
+    def versione(self):
+        letta = self._versione_letta
+        if letta is not None and time.monotonic() - letta[1] < VERIFICA_VERSIONE_SECONDI:
+            return letta[0]
+        versione = cache.get_or_set(self.chiave, _nuova_versione, None)
+        self._versione_letta = (versione, time.monotonic())
+        return versione
+
+    def tutti(self):
+        return self._dati()[1]
+
+    def get(self, pk):
+        """Restituisce la riga con chiave pk, None se pk è None. Solleva model.DoesNotExist se non esiste."""
+        if pk is None:
+            return None
+        riga = self._dati()[0].get(pk)
+        if riga is None:
+            # Riga creata da un altro processo tra il controllo della versione e il caricamento
+            model = apps.get_model(self.model)
+            riga = model.objects.select_related(*self.select_related).get(pk=pk)
+        return riga
+
+    def cerca(self, valore):
+        """Come get, ma accetta il valore grezzo di un form e restituisce None se non è una chiave valida."""
+        model = apps.get_model(self.model)
+        try:
+            return self.get(model._meta.pk.to_python(valore))
+        except (ValidationError, model.DoesNotExist):
+            return None
+
+    def invalida(self):
+        versione = _nuova_versione()
+        cache.set(self.chiave, versione, None)
+        self._versione_letta = (versione, time.monotonic())
+
+
+CATEGORIE = TabellaRiferimento('categorie', 'RimborsiApp.Categoria')
+STATI = TabellaRiferimento('stati', 'RimborsiApp.Stato', select_related=('categoria',))
+PROVINCE = TabellaRiferimento('province', 'comuni_italiani.Provincia')
+COMUNI = TabellaRiferimento('comuni', 'comuni_italiani.Comune', select_related=('provincia',))
+
+
+STRUTTURE_FONDI = TabellaRiferimento('strutture_fondi', 'RimborsiApp.StrutturaFondi')
+
+
+@receiver([post_save, post_delete], sender='RimborsiApp.Categoria')
+def invalida_categorie(sender, **kwargs):
+    CATEGORIE.invalida()
+    STATI.invalida()
+
+
+@receiver([post_save, post_delete], sender='RimborsiApp.Stato')
+def invalida_stati(sender, **kwargs):
+    STATI.invalida()
+
+
+@receiver([post_save, post_delete], sender='RimborsiApp.StrutturaFondi')
+def invalida_strutture_fondi(sender, **kwargs):
+    STRUTTURE_FONDI.invalida()
+
+
+@receiver([post_save, post_delete], sender='comuni_italiani.Provincia')
+def invalida_province(sender, **kwargs):
+    PROVINCE.invalida()
+    COMUNI.invalida()
+
+
+@receiver([post_save, post_delete], sender='comuni_italiani.Comune')
+def invalida_comuni(sender, **kwargs):
+    COMUNI.invalida()
+
+
+def _imposta_fk(istanza, campo, tabella):
+    """Valorizza la cache della FK dell'istanza con la riga della tabella di riferimento, senza query."""
+    field = istanza._meta.get_field(campo)
+    if not field.is_cached(istanza):
+        field.set_cached_value(istanza, tabella.get(getattr(istanza, field.attname)))
+
+
+def precarica_riferimenti(missione=None, profile=None):
+    """
+    Collega missione e profilo alle tabelle di riferimento in cache, così accessi come
+    missione.stato_destinazione.nome o profile.domicilio.provincia.codice_targa non fanno query.
+    """
+    if missione is not None:
+        _imposta_fk(missione, 'stato_destinazione', STATI)
+        if profile is None:
+            profile = missione.user.profile
+    if profile is not None:
+        _imposta_fk(profile, 'luogo_nascita', COMUNI)
+        for indirizzo in (profile.residenza, profile.domicilio):
+            if indirizzo is not None:
+                _imposta_fk(indirizzo, 'comune', COMUNI)
+                _imposta_fk(indirizzo, 'provincia', PROVINCE)
+
+
+def normalizza_nome(nome):
+    """Minuscolo, senza accenti e con apostrofi/trattini come spazi: 'Forlì' -> 'forli', "Sant'Agata" -> 'sant agata'."""
+    nome = unicodedata.normalize('NFKD', nome)
+    nome = ''.join(c for c in nome if not unicodedata.combining(c)).lower()
+    return ' '.join(re.sub(r"[^\w]+", ' ', nome).split())
+
+
+class IndicePrefissi:
+    """
+    Indice ordinato per la ricerca per prefisso sui nomi di una tabella di riferimento.
+    Un nome è trovato sia dall'inizio ('reggio') sia dall'inizio di una sua parola ('emilia').
+    Viene ricostruito solo quando la tabella viene ricaricata.
+    """
+
+    def __init__(self, tabella):
+        self.tabella = tabella
+        self._lista = None
+        self._nomi = []
+        self._parole = []
+        self._lock = threading.Lock()
+
+    def _costruisci(self, lista):
+        nomi, parole = [], []
+        for riga in lista:
+            chiave = normalizza_nome(str(riga))
+            nomi.append((chiave, riga.pk))
+            inizio = chiave.find(' ') + 1
+            while inizio:
+                parole.append((chiave[inizio:], riga.pk))
+                inizio = chiave.find(' ', inizio) + 1
+        nomi.sort()
+        parole.sort()
+        return nomi, parole
+
+    def _indici(self):
+        lista = self.tabella.tutti()
+        if lista is not self._lista:
+            with self._lock:
+                if lista is not self._lista:
+                    self._nomi, self._parole = self._costruisci(lista)
+                    self._lista = lista
+        return self._nomi, self._parole
+
+    def cerca(self, testo, inizio=0, n=20):
+        """
+        Restituisce le righe che iniziano con testo (prima i nomi, poi le parole interne),
+        saltandone inizio e fermandosi a n, e un booleano che indica se ce ne sono altre.
+        """
+        q = normalizza_nome(testo)
+        trovati = []
+        visti = set()
+        for indice in self._indici():
+            i = bisect.bisect_left(indice, (q,))
+            while i < len(indice) and indice[i][0].startswith(q):
+                pk = indice[i][1]
+                if pk not in visti:
+                    visti.add(pk)
+                    trovati.append(pk)
+                    if len(trovati) > inizio + n:
+                        return [self.tabella.get(pk) for pk in trovati[inizio:inizio + n]], True
+                i += 1
+        return [self.tabella.get(pk) for pk in trovati[inizio:inizio + n]], False
+
+
+class IndiceCampo:
+    """Righe di una tabella di riferimento per valore di un campo; come IndicePrefissi, segue i ricaricamenti."""
+
+    def __init__(self, tabella, campo):
+        self.tabella = tabella
+        self.campo = campo
+        self._lista = None
+        self._per_valore = {}
+        self._lock = threading.Lock()
+
+    def get(self, valore):
+        """Restituisce la riga con quel valore (la prima per pk se più d'una), None se non c'è."""
+        lista = self.tabella.tutti()
+        if lista is not self._lista:
+            with self._lock:
+                if lista is not self._lista:
+                    per_valore = {}
+                    for riga in lista:
+                        per_valore.setdefault(getattr(riga, self.campo), riga)
+                    self._per_valore = per_valore
+                    self._lista = lista
+        return self._per_valore.get(valore)
+
+
+INDICE_COMUNI = IndicePrefissi(COMUNI)
+INDICE_PROVINCE = IndicePrefissi(PROVINCE)
+COMUNI_PER_CATASTALE = IndiceCampo(COMUNI, 'codice_catastale')
+
+
+def struttura_da_testo(testo):
+    """Riconduce il testo libero della struttura fondi a una StrutturaFondi (None se nessuna corrisponde)."""
+    testo = normalizza_nome(testo or '')
+    for struttura in STRUTTURE_FONDI.tutti():
+        parole = (normalizza_nome(p) for p in struttura.parole_chiave.split(','))
+        if any(p and p in testo for p in parole):
+            return struttura
+    return None
@@ -0,0 +1,16 @@
+from django.db.models import Max
+
+
+class Sequenza:
+    """
+    Id da assegnare esplicitamente alle righe di un model, a partire dal massimo presente nel db.
+    Serve con bulk_create, che su MySQL non restituisce le chiavi generate.
+    """
+
+    def __init__(self, model):
+        self.prossimo = (model.objects.aggregate(m=Max('pk'))['m'] or 0) + 1
+
+    def __call__(self):
+        id = self.prossimo
+        self.prossimo += 1
+        return id
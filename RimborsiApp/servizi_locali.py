@@ -0,0 +1,159 @@
+"""
+Sostituti locali dei servizi esterni (tassi di cambio della Banca d'Italia, prezzi dei carburanti del MASE,
+server SMTP) per benchmark e prove di carico: rispondono nello stesso formato, sempre con gli stessi valori e
+con una latenza configurabile, senza uscire dalla rete locale.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import StreamRequestHandler, ThreadingMixIn, TCPServer
+from urllib.parse import parse_qs, urlsplit
+
+from django.test.utils import override_settings
+
+# Unità di valuta per un euro restituite per ogni giorno; le valute non elencate valgono 1
+TASSI = {'USD': 1.1, 'GBP': 0.86, 'CHF': 0.95, 'JPY': 160.0, 'CNY': 7.8, 'SEK': 11.5}
+# Prezzo della benzina in euro per 1000 litri, come nel report settimanale del MASE
+PREZZO_BENZINA = 1850.0
+
+PERCORSO_TASSI = '/tassi/dailyTimeSeries'
+PERCORSO_CARBURANTI = '/carburanti'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    ritardo = 0.
+
+    def do_GET(self):
+        if self.ritardo:
+            time.sleep(self.ritardo)
+        url = urlsplit(self.path)
+        if url.path == PERCORSO_TASSI:
+            valuta = parse_qs(url.query).get('baseCurrencyIsoCode', [''])[0].upper()
+            corpo = {'resultsInfo': {'totalRecords': 1}, 'rates': [{'avgRate': str(TASSI.get(valuta, 1.))}]}
+        elif url.path == PERCORSO_CARBURANTI:
+            corpo = [{'DATA_RILEVAZIONE': '2024-01-01', 'BENZINA': str(PREZZO_BENZINA)}]
+        else:
+            self.send_error(404)
+            return
+        dati = json.dumps(corpo).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(dati)))
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ServiziLocali:
+    """Server HTTP in un thread; `url` è la base a cui puntare TASSI_CAMBIO_URL e PREZZI_CARBURANTE_URL."""
+
+    def __init__(self, host='127.0.0.1', porta=0, ritardo_ms=0):
+        handler = type('Handler', (_Handler,), {'ritardo': ritardo_ms / 1000})
+        self.server = _Server((host, porta), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, porta = self.server.server_address[:2]
+        return f'http://{host}:{porta}'
+
+    @property
+    def impostazioni(self):
+        return {
+            'TASSI_CAMBIO_URL': self.url + PERCORSO_TASSI,
+            'PREZZI_CARBURANTE_URL': self.url + PERCORSO_CARBURANTI,
+        }
+
+    def avvia(self):
+        self.thread.start()
+        return self
+
+    def ferma(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _SmtpHandler(StreamRequestHandler):
+    """Quanto basta del protocollo SMTP per il backend di Django: accetta ogni messaggio e lo scarta."""
+
+    def scrivi(self, *righe):
+        self.wfile.write(''.join(f'{r}\r\n' for r in righe).encode('ascii'))
+
+    def handle(self):
+        self.scrivi('220 localhost SMTP locale')
+        dati = False
+        while True:
+            riga = self.rfile.readline()
+            if not riga:
+                return
+            if dati:
+                if riga.rstrip(b'\r\n') == b'.':
+                    dati = False
+                    self.server.conta_messaggio()
+                    self.scrivi('250 OK')
+                continue
+            comando = riga.decode('latin-1').strip().upper()
+            if comando.startswith('EHLO'):
+                self.scrivi('250-localhost', '250-AUTH PLAIN LOGIN', '250 8BITMIME')
+            elif comando.startswith('HELO'):
+                self.scrivi('250 localhost')
+            elif comando.startswith('AUTH'):
+                self.scrivi('235 OK')
+            elif comando.startswith('DATA'):
+                dati = True
+                self.scrivi('354 Fine con <CRLF>.<CRLF>')
+            elif comando.startswith('QUIT'):
+                self.scrivi('221 Bye')
+                return
+            elif comando.startswith(('MAIL', 'RCPT', 'RSET', 'NOOP')):
+                self.scrivi('250 OK')
+            else:
+                self.scrivi('502 Comando non implementato')
+
+
+class SmtpLocale(ThreadingMixIn, TCPServer):
+    """Server SMTP in un thread che conta i messaggi ricevuti (EMAIL_USE_TLS va disattivato)."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', porta=0):
+        super().__init__((host, porta), _SmtpHandler)
+        self.messaggi = 0
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def conta_messaggio(self):
+        with self._lock:
+            self.messaggi += 1
+
+    @property
+    def impostazioni(self):
+        host, porta = self.server_address[:2]
+        return {'EMAIL_HOST': host, 'EMAIL_PORT': porta, 'EMAIL_USE_TLS': False}
+
+    def avvia(self):
+        self.thread.start()
+        return self
+
+    def ferma(self):
+        self.shutdown()
+        self.server_close()
+
+
+@contextmanager
+def servizi_locali(ritardo_ms=0):
+    """Avvia i servizi locali e punta le impostazioni del processo corrente verso di loro."""
+    servizi = ServiziLocali(ritardo_ms=ritardo_ms).avvia()
+    try:
+        with override_settings(**servizi.impostazioni):
+            yield servizi
+    finally:
+        servizi.ferma()
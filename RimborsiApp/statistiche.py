@@ -0,0 +1,181 @@
+import datetime
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from RimborsiApp.models import TIPO_MISSIONE_CHOICES, Missione, Pasto, SpesaMissione, StatisticaMissioni, \
+    StrutturaFondi, Trasporto
+from RimborsiApp.money import EUR, ZERO, carica_tassi_salvati, money_exchange, to_decimal
+from RimborsiApp.riferimenti import STRUTTURE_FONDI, struttura_da_testo
+
+# Strutture create al primo aggiornamento se la tabella è vuota (quelle cercate dalla vecchia pagina statistiche)
+STRUTTURE_PREDEFINITE = (
+    ('AIRI', 'airi'),
+    ('Softech-ICT', 'softech'),
+)
+
+
+def assegna_strutture():
+    """
+    Ricalcola Missione.struttura per tutte le missioni, una UPDATE per ogni testo distinto di struttura_fondi.
+    Serve per le missioni esistenti e quando cambiano le parole chiave delle strutture.
+    """
+    for testo in Missione.objects.order_by().values_list('struttura_fondi', flat=True).distinct():
+        struttura = struttura_da_testo(testo)
+        Missione.objects.filter(struttura_fondi=testo).update(struttura=struttura)
+
+
+CATEGORIE_SPESA = ('scontrino', 'pernottamento', 'convegno', 'altrespese', 'trasporto')
+_TIPO_SPESA_CATEGORIA = {
+    'PASTO': 'scontrino',
+    'PERNOTTAMENTO': 'pernottamento',
+    'CONVEGNO': 'convegno',
+    'ALTRO': 'altrespese',
+}
+
+
+def totali_euro(missioni_ids=None):
+    """
+    Totali in euro per missione e categoria ({missione_id: {categoria: Decimal}}), sommati dal db per valuta
+    e giorno come in resoconto_data. Con missioni_ids limita il calcolo a quelle missioni.
+    I tassi di cambio già usati sono letti da TassoCambio con una query: il servizio esterno serve solo per
+    i giorni e le valute mai convertiti prima.
+    """
+    totali = defaultdict(lambda: dict.fromkeys(CATEGORIE_SPESA, ZERO))
+    if missioni_ids is None:
+        carica_tassi_salvati()
+
+    def aggiungi(missione_id, categoria, valuta, data, totale):
+        totale = to_decimal(totale)
+        if valuta and valuta != EUR:
+            totale = money_exchange(data, valuta, totale)
+        totali[missione_id][categoria] += totale
+
+    spese = SpesaMissione.objects.all()
+    pasti = Pasto.objects.filter(importo__isnull=False)
+    trasporti = Trasporto.objects.all()
+    if missioni_ids is not None:
+        spese = spese.filter(missione__in=missioni_ids)
+        pasti = pasti.filter(pasti__missione__in=missioni_ids)
+        trasporti = trasporti.filter(missione__in=missioni_ids)
+
+    spese = spese.values('missione', 'tipo', 'spesa__valuta', 'spesa__data') \
+        .annotate(totale=Sum('spesa__importo')).order_by()
+    for e in spese.iterator():
+        aggiungi(e['missione'], _TIPO_SPESA_CATEGORIA.get(e['tipo'], 'altrespese'), e['spesa__valuta'],
+                 e['spesa__data'], e['totale'])
+
+    pasti = pasti.values('pasti__missione', 'valuta', 'pasti__data').annotate(totale=Sum('importo')).order_by()
+    for e in pasti.iterator():
+        aggiungi(e['pasti__missione'], 'scontrino', e['valuta'], e['pasti__data'], e['totale'])
+
+    trasporti = trasporti.values('missione', 'valuta', 'data').annotate(totale=Sum('costo')).order_by()
+    for e in trasporti.iterator():
+        aggiungi(e['missione'], 'trasporto', e['valuta'], e['data'], e['totale'])
+
+    return totali
+
+
+def aggiorna_statistiche():
+    """Ricostruisce per intero StatisticaMissioni. Restituisce il numero di righe scritte."""
+    if not StrutturaFondi.objects.exists():
+        StrutturaFondi.objects.bulk_create([StrutturaFondi(nome=n, parole_chiave=p) for n, p in STRUTTURE_PREDEFINITE])
+        # bulk_create non invia post_save: senza questo i worker continuerebbero a vedere la tabella vuota
+        STRUTTURE_FONDI.invalida()
+    assegna_strutture()
+
+    totali = totali_euro()
+    km = dict(Trasporto.objects.filter(mezzo='AUTO').values('missione').annotate(km=Sum('km'))
+              .order_by().values_list('missione', 'km'))
+
+    righe = {}
+    missioni = Missione.objects.values('id', 'struttura', 'fondo', 'tipo', 'inizio', 'fine', 'stato_destinazione')
+    for m in missioni.iterator():
+        chiave = (m['struttura'], m['fondo'], m['tipo'], m['inizio'].replace(day=1), m['stato_destinazione'])
+        riga = righe.get(chiave)
+        if riga is None:
+            riga = righe[chiave] = {'n_missioni': 0, 'giorni': 0, 'km': 0., 'totale_euro': ZERO}
+        riga['n_missioni'] += 1
+        riga['giorni'] += (m['fine'] - m['inizio']).days + 1
+        riga['km'] += km.get(m['id']) or 0.
+        if m['id'] in totali:
+            riga['totale_euro'] += sum(totali[m['id']].values())
+
+    aggiornato = timezone.now()
+    with transaction.atomic():
+        StatisticaMissioni.objects.all().delete()
+        # Righe per INSERT scelte da Django (bulk_batch_size): SQLite ne accetta al più 500
+        StatisticaMissioni.objects.bulk_create([
+            StatisticaMissioni(struttura_id=struttura, fondo=fondo, tipo=tipo, mese=mese,
+                               stato_destinazione_id=stato, aggiornato=aggiornato, **valori)
+            for (struttura, fondo, tipo, mese, stato), valori in righe.items()
+        ])
+    return len(righe)
+
+
+AGGREGATI = {
+    'n_missioni': Sum('n_missioni'),
+    'giorni': Sum('giorni'),
+    'km': Sum('km'),
+    'totale_euro': Sum('totale_euro'),
+}
+
+CAMPI_DETTAGLIO = ('id', 'user__first_name', 'user__last_name', 'citta_destinazione', 'stato_destinazione__nome',
+                   'inizio', 'fine', 'fondo', 'struttura__nome', 'tipo', 'motivazione')
+
+
+def filtra_statistiche(filtri):
+    """
+    Applica i filtri (cleaned_data di FiltroStatisticheForm) sia alla tabella dei fatti sia alle missioni.
+    I riepiloghi vengono dalla tabella dei fatti, ferma all'ultimo aggiorna_statistiche; il dettaglio legge le
+    missioni attuali. I due coincidono subito dopo l'aggiornamento notturno, poi il dettaglio include anche le
+    missioni inserite o modificate nel frattempo (la pagina lo dice accanto alla data di aggiornamento).
+    """
+    fatti = StatisticaMissioni.objects.filter(struttura__isnull=False)
+    missioni = Missione.objects.filter(struttura__isnull=False)
+
+    if filtri.get('dal'):
+        dal = filtri['dal'].replace(day=1)
+        fatti = fatti.filter(mese__gte=dal)
+        missioni = missioni.filter(inizio__gte=dal)
+    if filtri.get('al'):
+        # Primo giorno del mese successivo
+        al = (filtri['al'].replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        fatti = fatti.filter(mese__lt=al)
+        missioni = missioni.filter(inizio__lt=al)
+    if filtri.get('struttura'):
+        fatti = fatti.filter(struttura=filtri['struttura'])
+        missioni = missioni.filter(struttura=filtri['struttura'])
+    if filtri.get('fondo'):
+        fatti = fatti.filter(fondo__icontains=filtri['fondo'])
+        missioni = missioni.filter(fondo__icontains=filtri['fondo'])
+    if filtri.get('tipo'):
+        fatti = fatti.filter(tipo=filtri['tipo'])
+        missioni = missioni.filter(tipo=filtri['tipo'])
+    if filtri.get('categoria'):
+        fatti = fatti.filter(stato_destinazione__categoria=filtri['categoria'])
+        missioni = missioni.filter(stato_destinazione__categoria=filtri['categoria'])
+    return fatti, missioni
+
+
+def riepiloghi(fatti):
+    """Totali e raggruppamenti per struttura/tipologia e per mese, calcolati dal db sulla tabella dei fatti."""
+    totali = fatti.aggregate(**AGGREGATI)
+    for k, v in totali.items():
+        totali[k] = v or 0
+
+    tipi_missione = dict(TIPO_MISSIONE_CHOICES)
+    per_struttura = list(fatti.values('struttura__nome', 'tipo').annotate(**AGGREGATI)
+                         .order_by('struttura__nome', 'tipo'))
+    for riga in per_struttura:
+        riga['tipo'] = tipi_missione.get(riga['tipo'], '-')
+    per_mese = list(fatti.values('mese', 'struttura__nome').annotate(**AGGREGATI).order_by('-mese', 'struttura__nome'))
+    return totali, per_struttura, per_mese
+
+
+def dettaglio(missioni):
+    """Elenco delle missioni, con i km in auto calcolati dal db solo per le righe richieste."""
+    return missioni.order_by('-inizio', '-id').values(*CAMPI_DETTAGLIO) \
+        .annotate(km=Sum('trasporto__km', filter=Q(trasporto__mezzo='AUTO')))
@@ -1,8 +1,10 @@
 from django import template
 
+from RimborsiApp.gruppi import ha_gruppo
+
 register = template.Library()
 
 
 @register.filter(name='has_group')
 def has_group(user, group_name):
-    return user.groups.filter(name=group_name).exists()
+    return ha_gruppo(user, group_name)
@@ -1,3 +1,404 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from smtplib import SMTPException
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from RimborsiApp import compila_pdf, gruppi, money, posta
+from RimborsiApp.apps import controlla_tabelle_cache
+from RimborsiApp.dati_sintetici import GeneratoreDati
+from RimborsiApp.librerie import docx
+from RimborsiApp.migrazioni import migra_json, migra_pernottamenti, _spese
+from RimborsiApp.models import CheckpointMigrazione, EmailInUscita, Missione, ModuliMissione, Spesa, SpesaMissione, \
+    Stato, StrutturaFondi, TassoCambio, Trasporto
+from RimborsiApp.riferimenti import STRUTTURE_FONDI, VERIFICA_VERSIONE_SECONDI
+from RimborsiApp.statistiche import aggiorna_statistiche
+from RimborsiApp.money import EUR, Money, parse_importo, to_decimal
+
+
+class ToDecimalTest(SimpleTestCase):
+    def test_arrotonda_al_centesimo(self):
+        self.assertEqual(to_decimal('12.345'), Decimal('12.35'))
+        self.assertEqual(to_decimal('12.344'), Decimal('12.34'))
+        # ROUND_HALF_UP, non l'arrotondamento bancario
+        self.assertEqual(to_decimal('0.125'), Decimal('0.13'))
+
+    def test_float_senza_errori_di_rappresentazione(self):
+        self.assertEqual(to_decimal(0.1), Decimal('0.10'))
+        self.assertEqual(to_decimal(0.1 + 0.2), Decimal('0.30'))
+        self.assertEqual(to_decimal(2.675), Decimal('2.68'))
+
+    def test_tipi_accettati(self):
+        self.assertEqual(to_decimal(3), Decimal('3.00'))
+        self.assertEqual(to_decimal(Decimal('1.5')), Decimal('1.50'))
+        self.assertEqual(to_decimal(' 7,5 '), Decimal('7.50'))
+        self.assertEqual(to_decimal(None), Decimal('0.00'))
+        self.assertEqual(to_decimal(''), Decimal('0.00'))
+
+    def test_valori_non_validi(self):
+        for valore in ('abc', '12,50 €', 'NaN', 'Infinity', float('inf')):
+            with self.subTest(valore=valore):
+                with self.assertRaises(ValueError):
+                    to_decimal(valore)
+
+
+class ParseImportoTest(SimpleTestCase):
+    def test_vuoto_e_none(self):
+        self.assertIsNone(parse_importo(None))
+        self.assertIsNone(parse_importo(''))
+        self.assertIsNone(parse_importo('   '))
+
+    def test_zero_non_e_vuoto(self):
+        self.assertEqual(parse_importo('0'), Decimal('0.00'))
+        self.assertEqual(parse_importo(0), Decimal('0.00'))
+
+    def test_importo(self):
+        self.assertEqual(parse_importo('10,456'), Decimal('10.46'))
+        with self.assertRaises(ValueError):
+            parse_importo('dieci')
+
+
+class MoneyTest(SimpleTestCase):
+    def test_somma_esatta(self):
+        totale = sum([Money(0.1), Money(0.2), Money('0.30')])
+        self.assertEqual(totale, Money('0.60'))
+        self.assertEqual(totale.importo, Decimal('0.60'))
+
+    def test_valute_diverse(self):
+        with self.assertRaises(ValueError):
+            Money(1, 'USD') + Money(1, EUR)
+        self.assertNotEqual(Money(1, 'USD'), Money(1, EUR))
+
+    def test_operazioni(self):
+        self.assertEqual(Money(5) - Money('1.25'), Money('3.75'))
+        self.assertEqual(-Money(2), Money(-2))
+        self.assertFalse(Money(0))
+        self.assertTrue(Money('0.01'))
+        self.assertEqual(Money(None, None), Money(0, EUR))
+        self.assertEqual(str(Money('3.5', 'USD')), '3.50 USD')
+        self.assertEqual(len({Money(1), Money('1.00')}), 1)
+
+    def test_in_euro_non_converte_gli_euro(self):
+        m = Money(10)
+        self.assertIs(m.in_euro(datetime.date(2020, 1, 1)), m)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class VersioniGruppiTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        gruppi._versioni_lette.clear()
+        self.addCleanup(gruppi._versioni_lette.clear)
+
+    def test_entro_l_intervallo_non_legge_la_cache(self):
+        versioni = gruppi._versioni(1)
+        with mock.patch('RimborsiApp.gruppi.cache', wraps=cache) as condivisa:
+            self.assertEqual(gruppi._versioni(1), versioni)
+        condivisa.get_many.assert_not_called()
+
+    def test_invalidazione_da_un_altro_worker(self):
+        versioni = gruppi._versioni(1)
+        cache.set('gruppi_versione_1', 'altro worker', None)
+        self.assertEqual(gruppi._versioni(1), versioni)
+        dopo = time.monotonic() + VERIFICA_VERSIONE_SECONDI + 1
+        with mock.patch('RimborsiApp.gruppi.time.monotonic', return_value=dopo):
+            self.assertEqual(gruppi._versioni(1), [versioni[0], 'altro worker'])
+
+    def test_invalidazione_locale_immediata(self):
+        globale, utente = gruppi._versioni(1)
+        gruppi.invalida_gruppi_utente(1)
+        self.assertEqual(gruppi._versioni(1)[0], globale)
+        self.assertNotEqual(gruppi._versioni(1)[1], utente)
+        gruppi.invalida_gruppi_utente()
+        self.assertNotEqual(gruppi._versioni(2)[0], globale)
+
+
+class TabelleCacheCheckTest(TestCase):
+    def test_tabella_mancante(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                                   'LOCATION': 'cache_inesistente'}}):
+            avvisi = controlla_tabelle_cache(None)
+        self.assertEqual([a.id for a in avvisi], ['RimborsiApp.W001'])
+
+    def test_cache_non_su_db(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual(controlla_tabelle_cache(None), [])
+
+
+class TassoCambioTest(TestCase):
+    def setUp(self):
+        money._tassi_di_cambio.clear()
+
+    def tearDown(self):
+        money._tassi_di_cambio.clear()
+
+    def test_tasso_salvato_non_usa_la_rete(self):
+        data = datetime.date(2020, 3, 2)
+        TassoCambio.objects.create(data=data, valuta='USD', tasso=Decimal('1.1000'))
+        with mock.patch('RimborsiApp.money._scarica_tasso') as scarica:
+            self.assertEqual(Money(11, 'USD').in_euro(data), Money(10))
+        scarica.assert_not_called()
+
+    def test_tasso_scaricato_viene_salvato(self):
+        data = datetime.date(2020, 3, 2)
+        with mock.patch('RimborsiApp.money._scarica_tasso', return_value=Decimal('2')) as scarica:
+            self.assertEqual(money.money_exchange(data, 'USD', 5), Decimal('2.50'))
+            money._tassi_di_cambio.clear()
+            self.assertEqual(money.money_exchange(data, 'USD', 5), Decimal('2.50'))
+        scarica.assert_called_once_with(data, 'USD')
+        self.assertEqual(TassoCambio.objects.get(data=data, valuta='USD').tasso, Decimal('2'))
+
+
+def crea_missione(user, **campi):
+    valori = dict(citta_destinazione='Roma', inizio=datetime.date(2019, 5, 6), inizio_ora=datetime.time(8),
+                  fine=datetime.date(2019, 5, 7), fine_ora=datetime.time(20), fondo='Fondo',
+                  motivazione='Convegno', struttura_fondi='')
+    valori.update(campi)
+    return Missione.objects.create(user=user, **valori)
+
+
+def pernottamento(data, importo, **voce):
+    return dict(data=data, s1=importo, v1='EUR', d1='Hotel', **voce)
+
+
+class AggiornaStatisticheTest(TestCase):
+    def test_strutture_predefinite_visibili_subito(self):
+        # Le righe create spariscono col rollback del test, la copia in memoria no
+        self.addCleanup(STRUTTURE_FONDI.invalida)
+        user = User.objects.create_user('mario.rossi', password='x')
+        # Tabella già letta (vuota) prima del primo aggiornamento, come in un worker avviato da tempo
+        self.assertEqual(STRUTTURE_FONDI.tutti(), [])
+        aggiorna_statistiche()
+        self.assertEqual(StrutturaFondi.objects.count(), 2)
+
+        missione = crea_missione(user, struttura_fondi='Progetto AIRI 2019')
+        self.assertEqual(missione.struttura.nome, 'AIRI')
+
+
+class StatisticheExportTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('mario.rossi', password='x')
+        user.groups.add(Group.objects.create(name='AIRI'))
+        self.client = Client()
+        self.client.force_login(user)
+        self.url = reverse('RimborsiApp:statistiche_export', args=('missioni', 'csv'))
+
+    def test_senza_filtri(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+    def test_filtro_non_valido(self):
+        response = self.client.get(self.url, {'dal': '2019-13'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('dal', response.json()['errors'])
+
+
+class MigraJsonTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('mario.rossi', password='x')
+
+    def test_rieseguire_non_duplica(self):
+        m = crea_missione(self.user, pernottamento=json.dumps([
+            pernottamento('2019-05-06', '80,50'),
+            pernottamento('2019-05-07', '90', DELETE=True),
+        ]))
+
+        totali = migra_pernottamenti()
+        self.assertEqual(totali['missioni'], 1)
+        self.assertEqual(totali['righe'], 1)
+        spesa = SpesaMissione.objects.get(missione=m, tipo='PERNOTTAMENTO').spesa
+        self.assertEqual(spesa.importo, Decimal('80.50'))
+        self.assertTrue(CheckpointMigrazione.objects.get(nome='pernottamenti').completata)
+
+        # Dal checkpoint non c'è nulla da rifare; anche ripartendo da zero la missione è già migrata
+        self.assertEqual(migra_pernottamenti()['righe'], 0)
+        totali = migra_pernottamenti(ricomincia=True)
+        self.assertEqual(totali['righe'], 0)
+        self.assertEqual(totali['missioni_saltate'], 1)
+        self.assertEqual(SpesaMissione.objects.filter(missione=m).count(), 1)
+        self.assertEqual(Spesa.objects.count(), 1)
+
+    def test_dati_illeggibili_non_fermano_la_migrazione(self):
+        crea_missione(self.user, pernottamento='{non json')
+        crea_missione(self.user, pernottamento=json.dumps({'data': '2019-05-06'}))
+        crea_missione(self.user, pernottamento=json.dumps([
+            'testo', pernottamento('06/05/2019', '10'), pernottamento('2019-05-06', '12,50 €'),
+            pernottamento('2019-05-06', '12'),
+        ]))
+
+        totali = migra_pernottamenti()
+        self.assertEqual(totali['json_non_validi'], 2)
+        self.assertEqual(totali['voci_non_valide'], 1)
+        self.assertEqual(totali['voci_senza_data'], 1)
+        self.assertEqual(totali['importi_non_validi'], 1)
+        self.assertEqual(totali['righe'], 1)
+
+    def test_ripresa_dal_checkpoint(self):
+        missioni = [crea_missione(self.user, pernottamento=json.dumps([pernottamento('2019-05-06', i + 1)]))
+                    for i in range(3)]
+        converti = _spese('PERNOTTAMENTO')
+        chiamate = []
+
+        def interrotta(righe, totali):
+            # Il secondo blocco fallisce: la sua transazione viene annullata, il checkpoint resta al primo
+            chiamate.append([id for id, _ in righe])
+            if len(chiamate) == 2:
+                raise RuntimeError('interruzione')
+            return converti(righe, totali)
+
+        with self.assertRaises(RuntimeError):
+            migra_json('pernottamenti', 'pernottamento', interrotta, blocco=1)
+        checkpoint = CheckpointMigrazione.objects.get(nome='pernottamenti')
+        self.assertEqual(checkpoint.ultimo_id, missioni[0].id)
+        self.assertFalse(checkpoint.completata)
+        self.assertEqual(SpesaMissione.objects.count(), 1)
+
+        totali = migra_json('pernottamenti', 'pernottamento', converti, blocco=1)
+        self.assertEqual(totali['missioni'], 2)
+        self.assertEqual(totali['righe'], 2)
+        self.assertEqual(sorted(SpesaMissione.objects.values_list('missione_id', flat=True)),
+                         [m.id for m in missioni])
+        self.assertTrue(CheckpointMigrazione.objects.get(nome='pernottamenti').completata)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', EMAIL_CODA_THREAD=False,
+                   EMAIL_HOST_USER='missioni@example.com')
+class InviaInCodaTest(TestCase):
+    def accoda(self):
+        return posta.accoda_email('Oggetto', 'Testo', ['mario.rossi@example.com'])
+
+    def scaduta(self, email):
+        EmailInUscita.objects.filter(id=email.id).update(prossimo_tentativo=timezone.now())
+
+    def test_invio(self):
+        email = self.accoda()
+        self.assertEqual(posta.invia_in_coda(), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual(email.stato, 'INVIATA')
+        self.assertEqual(email.tentativi, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['mario.rossi@example.com'])
+        # Già inviata: non viene ripresa
+        self.assertEqual(posta.invia_in_coda(), (0, 0))
+
+    def test_destinatari_vuoti(self):
+        with self.assertRaises(ValueError):
+            posta.accoda_email('Oggetto', 'Testo', [])
+        self.assertFalse(EmailInUscita.objects.exists())
+
+    def test_attesa_esponenziale(self):
+        email = self.accoda()
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=SMTPException('non raggiungibile')):
+            for tentativo in range(1, posta.MAX_TENTATIVI):
+                prima = timezone.now()
+                self.assertEqual(posta.invia_in_coda(), (0, 1))
+                email.refresh_from_db()
+                self.assertEqual(email.stato, 'IN_CODA')
+                self.assertEqual(email.tentativi, tentativo)
+                self.assertIn('non raggiungibile', email.ultimo_errore)
+                attesa = datetime.timedelta(seconds=posta.ATTESA_BASE * 2 ** (tentativo - 1))
+                self.assertGreaterEqual(email.prossimo_tentativo, prima + attesa)
+                self.assertLessEqual(email.prossimo_tentativo, timezone.now() + attesa)
+                # Prima della scadenza non viene ritentata
+                self.assertEqual(posta.invia_in_coda(), (0, 0))
+                self.scaduta(email)
+
+            self.assertEqual(posta.invia_in_coda(), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual(email.stato, 'ERRORE')
+            self.assertEqual(email.tentativi, posta.MAX_TENTATIVI)
+            self.scaduta(email)
+            self.assertEqual(posta.invia_in_coda(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_ritento_riuscito(self):
+        email = self.accoda()
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=SMTPException('timeout')):
+            posta.invia_in_coda()
+        self.scaduta(email)
+        self.assertEqual(posta.invia_in_coda(), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual(email.stato, 'INVIATA')
+        self.assertEqual(email.tentativi, 2)
+        self.assertEqual(email.ultimo_errore, '')
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_connessione_non_disponibile_rimanda_tutti(self):
+        prima, seconda = self.accoda(), self.accoda()
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('rifiutata')):
+            self.assertEqual(posta.invia_in_coda(), (0, 2))
+        for email in (prima, seconda):
+            email.refresh_from_db()
+            self.assertEqual(email.stato, 'IN_CODA')
+            self.assertEqual(email.tentativi, 1)
+
+
+class CompilaParte2Test(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.media, 'moduli'))
+        self.addCleanup(shutil.rmtree, self.media)
+        money._tassi_di_cambio.clear()
+        self.addCleanup(money._tassi_di_cambio.clear)
+
+        self.user = User.objects.create_user('mario.rossi', password='x', first_name='Mario', last_name='Rossi')
+        self.missione = crea_missione(self.user, stato_destinazione=Stato.objects.create(nome='Italia'))
+        ModuliMissione.objects.create(missione=self.missione, anticipo=self.missione.inizio,
+                                      parte_1=self.missione.inizio, parte_2=self.missione.fine,
+                                      kasko=self.missione.inizio, atto_notorio=self.missione.fine)
+        Trasporto.objects.create(missione=self.missione, data=self.missione.inizio, da='Modena', a='Roma',
+                                 mezzo='TRENO', costo=Decimal('45.90'), valuta='EUR')
+        spesa = Spesa.objects.create(data=self.missione.inizio, importo=Decimal('22'), valuta='USD',
+                                     descrizione='Taxi')
+        SpesaMissione.objects.create(missione=self.missione, spesa=spesa, tipo='ALTRO')
+        TassoCambio.objects.create(data=self.missione.inizio, valuta='USD', tasso=Decimal('1.1'))
+
+    def test_tabelle_trasporti_e_spese(self):
+        request = RequestFactory().post('/')
+        request.user = self.user
+        # compila_pdf legge i percorsi da Rimborsi.settings, lo storage dei moduli da django.conf.settings
+        statici = os.path.join(os.path.dirname(compila_pdf.__file__), 'static')
+        with override_settings(MEDIA_ROOT=self.media), \
+                mock.patch.multiple(compila_pdf.settings, STATIC_ROOT=statici, MEDIA_ROOT=self.media):
+            compila_pdf.compila_parte_2(request, self.missione.id, None, None)
+
+        moduli = ModuliMissione.objects.get(missione=self.missione)
+        document = docx.Document(os.path.join(self.media, moduli.parte_2_file.name))
+        trasporti, altre_spese = document.tables[0], document.tables[4]
+        self.assertEqual(trasporti.cell(1, 5).text, '45.90 EUR')
+        self.assertEqual(altre_spese.cell(1, 1).text, 'Taxi')
+        self.assertEqual(altre_spese.cell(1, 2).text, '22.00 USD (20.00 EUR)')
+
+
+class GeneraDatiSinteticiTest(TestCase):
+    def setUp(self):
+        for nome in ('Italia', 'Francia', 'Stati Uniti'):
+            Stato.objects.create(nome=nome)
+
+    def test_blocco_grande(self):
+        # Un solo blocco con più di 500 voci pasti: su SQLite un unico INSERT fallirebbe
+        totali = GeneratoreDati(seed=1, fino_al=datetime.date(2024, 1, 1), blocco=200).genera(2, 100)
+        self.assertEqual(totali['Missioni'], 200)
+        self.assertGreater(totali['Voci pasti'], 500)
+        self.assertEqual(Missione.objects.count(), 200)
+
+    def test_blocco_non_valido(self):
+        with self.assertRaises(CommandError):
+            call_command('genera_dati_sintetici', blocco=0, senza_file=True)
+        with self.assertRaises(ValueError):
+            GeneratoreDati(blocco=0)
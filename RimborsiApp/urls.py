@@ -12,12 +12,16 @@ urlpatterns = [
     path('firma_shared/', views.firma_shared, name='firma_shared'),
     path('firma/', views.firma, name='firma'),
     path('profile/', views.profile, name='profile'),
+    path('autocomplete/comune/', views.comune_autocomplete, name='comune_autocomplete'),
+    path('autocomplete/provincia/', views.provincia_autocomplete, name='provincia_autocomplete'),
     path('foreign_profile/', views.foreign_profile, name='foreign_profile'),
     path('italian_profile/', views.italian_profile, name='italian_profile'),
     path('automobili/', views.automobili, name='automobili'),
     path('regolamento/', views.regolamento, name='regolamento'),
     path('crea_missione/', views.crea_missione, name='crea_missione'),
     path('lista_missioni/', views.lista_missioni, name='lista_missioni'),
+    path('lista_missioni/concluse/', views.lista_missioni_concluse, name='lista_missioni_concluse'),
+    path('cerca/', views.cerca, name='cerca'),
     path('collaboratori/', views.collaboratori, name='collaboratori'),
     path('missione/<int:id>', views.missione, name='missione'),
     path('clona_missione/<int:id>', views.clona_missione, name='clona_missione'),
@@ -60,17 +64,19 @@ urlpatterns = [
     path('download/<int:id>/<str:field>', utils.download, name='download'),
 
     path('statistiche', views.statistiche, name='statistiche'),
+    path('statistiche/api/', views.statistiche_api, name='statistiche_api'),
+    path('statistiche/export/<slug:tabella>.<slug:formato>', views.statistiche_export, name='statistiche_export'),
 
     path('maintenance/', views.maintenance, name='maintenance'),
+    path('metrics', views.metrics_view, name='metrics'),
 
     path('media/users/<int:id1>/<int:id2>/<str:field1>/<str:field2>', utils.secure_media),
     path('spese_image_preview/<int:id>', utils.spesa_image_preview, name='spese_image_preview'),
 
     path('trasporti_image_preview/<int:id>', utils.trasporto_image_preview, name='trasporti_image_preview'),
-    path('pasto_image_preview/<int:id>/<str:img_field_name>/', utils.pasto_image_preview, name='pasto_image_preview'),
+    path('pasto_image_preview/<int:id>/', utils.pasto_image_preview, name='pasto_image_preview'),
     path('firma_image_preview/<int:id>/', utils.firma_image_preview, name='firma_image_preview'),
     path('rotate_image/', utils.firma_image_preview, name='firma_image_preview'),
-    path('statistiche', views.statistiche, name='statistiche'),
 
 ]
 
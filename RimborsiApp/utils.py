@@ -2,17 +2,8 @@ from wsgiref.util import FileWrapper
 import os
 import mimetypes
 import re
-import requests
-import sys
-import json
 
-from Rimborsi import settings
-
-sys.path.append('/home/administrator/missioni-unimore')
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Rimborsi.settings")
-import django
-django.setup()
-from bs4 import BeautifulSoup
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponseForbidden, Http404, FileResponse, JsonResponse
 from django.db.models import Q
@@ -21,139 +12,16 @@ from django.shortcuts import get_object_or_404, render_to_response, HttpResponse
 from sendfile import sendfile
 from RimborsiApp.models import ModuliMissione, Missione
 from django.utils.encoding import smart_str
-from datetime import datetime as dt                 #avoiding conflicts
 from django.core.files.storage import default_storage
 from django.utils.http import http_date
 
 from RimborsiApp.models import Spesa, SpesaMissione, Pasti, Trasporto
 
-from RimborsiApp.models import Spesa, SpesaMissione, Pasti, Trasporto, Firma
-from PIL import Image
+from RimborsiApp.models import Spesa, SpesaMissione, Pasti, Pasto, Trasporto, Firma
+from RimborsiApp.librerie import requests
 import io
 import os
 
-def migra_pernottamenti():
-    missioni = Missione.objects.all()
-
-    for missione in missioni:
-        if missione.pernottamento:
-            pernottamenti = json.loads(missione.pernottamento)
-            for pernottamento in pernottamenti:
-                if not pernottamento.get("DELETE", False):
-                    data = dt.strptime(pernottamento["data"], '%Y-%m-%d').date()
-                    importo = float(pernottamento["s1"])
-                    valuta = pernottamento.get("v1", "EUR")
-                    descrizione = pernottamento.get("d1", "")
-
-                    spesa = Spesa.objects.create(
-                        data=data,
-                        importo=importo,
-                        valuta=valuta,
-                        descrizione=descrizione
-                    )
-
-                    SpesaMissione.objects.create(
-                        missione=missione,
-                        spesa=spesa,
-                        tipo="PERNOTTAMENTO"
-                    )
-
-
-def migra_altre_spese():
-    missioni = Missione.objects.all()
-
-    for missione in missioni:
-        if missione.altrespese:
-            altre_spese = json.loads(missione.altrespese)
-            for altrespese in altre_spese:
-                if not altrespese.get("DELETE", False):
-                    data = dt.strptime(altrespese["data"], '%Y-%m-%d').date()
-                    importo = float(altrespese["s1"])
-                    valuta = altrespese.get("v1", "EUR")
-                    descrizione = altrespese.get("d1", "")
-
-                    spesa = Spesa.objects.create(
-                        data=data,
-                        importo=importo,
-                        valuta=valuta,
-                        descrizione=descrizione
-                    )
-
-                    SpesaMissione.objects.create(
-                        missione=missione,
-                        spesa=spesa,
-                        tipo="ALTRO"
-                    )
-
-
-def migra_convegni():
-    missioni = Missione.objects.all()
-
-    for missione in missioni:
-        if missione.convegno:
-            convegni = json.loads(missione.convegno)
-            for convegno in convegni:
-                if not convegno.get("DELETE", False):
-                    data = dt.strptime(convegno["data"], '%Y-%m-%d').date()
-                    importo = float(convegno["s1"])
-                    valuta = convegno.get("v1", "EUR")
-                    descrizione = convegno.get("d1", "")
-
-                    spesa = Spesa.objects.create(
-                        data=data,
-                        importo=importo,
-                        valuta=valuta,
-                        descrizione=descrizione
-                    )
-
-                    SpesaMissione.objects.create(
-                        missione=missione,
-                        spesa=spesa,
-                        tipo="CONVEGNO"
-                    )
-                else:
-                    print("Non doveva succedere!")
-
-
-def migra_pasti():
-    missioni = Missione.objects.all()
-
-    for missione in missioni:
-        if missione.scontrino:
-            pasti = json.loads(missione.scontrino)
-            for pasto in pasti:
-                if not pasto.get("DELETE", False):
-                    try:
-                        data = dt.strptime(pasto["data"], '%Y-%m-%d').date()
-                    except KeyError:
-                        print("Missing date in: ", pasto, "di ", pasti)
-                        continue
-                    importo1 = float(pasto["s1"]) if pasto.get("s1") is not None else None
-                    valuta1 = pasto.get("v1", "EUR")
-                    descrizione1 = pasto.get("d1", "")
-
-                    importo2 = float(pasto["s2"]) if pasto.get("s2") is not None else None
-                    valuta2 = pasto.get("v2", "EUR")
-                    descrizione2 = pasto.get("d2", "")
-
-                    importo3 = float(pasto["s3"]) if pasto.get("s3") is not None else None
-                    valuta3 = pasto.get("v3", "EUR")
-                    descrizione3 = pasto.get("d3", "")
-
-                    Pasti.objects.create(
-                        missione=missione,
-                        data=data,
-                        importo1=importo1,
-                        valuta1=valuta1,
-                        descrizione1=descrizione1,
-                        importo2=importo2,
-                        valuta2=valuta2,
-                        descrizione2=descrizione2,
-                        importo3=importo3,
-                        valuta3=valuta3,
-                        descrizione3=descrizione3
-                    )
-
 
 # def get_prezzo_carburante():
 #     # Set the URL you want to webscrape from
@@ -171,7 +39,7 @@ def migra_pasti():
 #     return prezzo
 
 def get_prezzo_carburante():
-    url = 'https://sisen.mase.gov.it/dgsaie/api/v1/weekly-prices/report/export?format=JSON&lang=it'
+    url = settings.PREZZI_CARBURANTE_URL
     response = requests.get(url)
     rilevazioni = response.json()
     last = rilevazioni[-1]
@@ -199,24 +67,21 @@ def download(request, id, field):
 
 
 @login_required
-def pasto_image_preview(request, id, img_field_name):
-    pasto = get_object_or_404(Pasti, id=id)
-    img_field_short_name = img_field_name.split('-')[-1]
-    #if pasto.missione.user != request.user:
+def pasto_image_preview(request, id):
+    pasto = get_object_or_404(Pasto.objects.select_related('pasti__missione'), id=id)
+    #if pasto.pasti.missione.user != request.user:
     #    return HttpResponseForbidden('Sorry, you cannot access this file')
 
     img_url = None
-    if hasattr(pasto, img_field_short_name):
-        img_field = getattr(pasto, img_field_short_name)
-        if img_field and img_field.url:
-            img_url = img_field.url
+    if pasto.img_scontrino and pasto.img_scontrino.url:
+        img_url = pasto.img_scontrino.url
 
     if not img_url:
         return HttpResponseForbidden('Image not found or not available.')
 
     img_name = img_url.split('/')[-1]
     # Costruire il percorso per secure_media e richiamare la funzione
-    return secure_media(request, pasto.missione.user.id, pasto.missione.id, 'PASTO', img_name)
+    return secure_media(request, pasto.pasti.missione.user_id, pasto.pasti.missione.id, 'PASTO', img_name)
 
 
 @login_required
@@ -343,10 +208,3 @@ def serve_signature(request, id):
         raise Http404("File not found")
 
     return FileResponse(open(file_path, 'rb'), content_type='application/octet-stream')
-
-
-if __name__ == "__main__":
-    # migra_pernottamenti()
-    # migra_convegni()
-    # migra_altre_spese()
-    migra_pasti()
\ No newline at end of file
@@ -1,19 +1,35 @@
 import decimal
+import hashlib
+import hmac
 import json
 import datetime
 
+from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models import Sum
-from django.http import Http404, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseServerError, JsonResponse
+from django.db.models import Max, Q, Sum
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, \
+    HttpResponseServerError, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render, reverse, get_object_or_404
-from django.core.mail import send_mail
-from django.views.decorators.http import require_POST
+from django.template.loader import render_to_string
+from django.core.paginator import Paginator
+from django.core.validators import validate_email
+from django.utils.cache import patch_cache_control
+from django.utils.html import escape
+from django.views.decorators.http import etag, require_POST
 
 from .forms import *
+from .gruppi import ha_gruppo
 from .models import *
+from . import metrics
+from .money import EUR, ZERO, money_exchange, parse_importo, to_decimal
+from .posta import accoda_email, prepara_allegato
+from .ricerca import cerca_missioni
+from .riferimenti import COMUNI, INDICE_COMUNI, INDICE_PROVINCE, PROVINCE
+from .export import ESPORTAZIONI, FORMATI
+from .statistiche import dettaglio, filtra_statistiche, riepiloghi
 from .utils import *
 from Rimborsi import settings
 
@@ -22,6 +38,59 @@ def maintenance(request):
     return render(request, 'Rimborsi/maintenance.html')
 
 
+AUTOCOMPLETE_PER_PAGINA = 20
+
+
+def _etag_autocomplete(tabella):
+    """ETag per versione della tabella e query: il browser riusa le risposte finché i dati non cambiano."""
+    def calcola(request):
+        chiave = f'{tabella.versione}?{request.META.get("QUERY_STRING", "")}'
+        return hashlib.md5(chiave.encode()).hexdigest()
+    return calcola
+
+
+def _autocomplete_riferimento(request, indice):
+    """Risposta nel formato atteso da django-autocomplete-light (select2)."""
+    try:
+        pagina = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        pagina = 1
+    righe, altre = indice.cerca(request.GET.get('q', ''), inizio=(pagina - 1) * AUTOCOMPLETE_PER_PAGINA,
+                                n=AUTOCOMPLETE_PER_PAGINA)
+    response = JsonResponse({
+        'results': [{'id': str(r.pk), 'text': escape(str(r)), 'selected_text': str(r)} for r in righe],
+        'pagination': {'more': altre},
+    })
+    patch_cache_control(response, private=True, max_age=3600)
+    return response
+
+
+@login_required
+@etag(_etag_autocomplete(COMUNI))
+def comune_autocomplete(request):
+    return _autocomplete_riferimento(request, INDICE_COMUNI)
+
+
+@login_required
+@etag(_etag_autocomplete(PROVINCE))
+def provincia_autocomplete(request):
+    return _autocomplete_riferimento(request, INDICE_PROVINCE)
+
+
+def metrics_view(request):
+    """
+    Metriche in formato Prometheus, solo con "Authorization: Bearer <METRICS_TOKEN>" (secrets.json).
+    Ogni richiesta arriva a un solo worker e restituisce le metriche di quel processo (etichetta pid).
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token:
+        raise Http404
+    autorizzazione = request.META.get('HTTP_AUTHORIZATION', '')
+    if not hmac.compare_digest(autorizzazione.encode(), f'Bearer {token}'.encode()):
+        return HttpResponseForbidden('Accesso non consentito.')
+    return HttpResponse(metrics.esporta(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def home(request):
     # if request.user.is_authenticated:
     #     missioni_passate = Missione.objects.filter(user=request.user).order_by('-inizio')
@@ -30,13 +99,57 @@ def home(request):
     return render(request, 'Rimborsi/index.html')
 
 
+MISSIONI_PER_PAGINA = 20
+
+# Solo i campi mostrati nella lista, con il nome dello stato già in join (niente fetch per riga)
+CAMPI_LISTA_MISSIONI = ('id', 'inizio', 'citta_destinazione', 'stato_destinazione__nome')
+
+
+def pagina_missioni(user, conclusa, dopo=None, n=MISSIONI_PER_PAGINA):
+    """
+    Keyset pagination sulle missioni dell'utente ordinate per (inizio, id) decrescenti.
+
+    :param dopo: cursore (inizio, id) dell'ultima missione della pagina precedente, None per la prima pagina
+    :return: lista di dict con CAMPI_LISTA_MISSIONI e cursore della pagina successiva (None se è l'ultima)
+    """
+    missioni = Missione.objects.filter(user=user, missione_conclusa=conclusa)
+    if dopo is not None:
+        inizio, id = dopo
+        missioni = missioni.filter(Q(inizio__lt=inizio) | Q(inizio=inizio, id__lt=id))
+    righe = list(missioni.order_by('-inizio', '-id').values(*CAMPI_LISTA_MISSIONI)[:n + 1])
+
+    prossima = None
+    if len(righe) > n:
+        righe = righe[:n]
+        prossima = (righe[-1]['inizio'], righe[-1]['id'])
+    return righe, prossima
+
+
 @login_required
 def lista_missioni(request):
-    missioni = Missione.objects.filter(user=request.user).order_by('-inizio', '-id')
-    missioni_attive = missioni.filter(missione_conclusa=False)
-    missioni_concluse = missioni.filter(missione_conclusa=True)
+    missioni_attive = Missione.objects.filter(user=request.user, missione_conclusa=False) \
+        .order_by('-inizio', '-id').values(*CAMPI_LISTA_MISSIONI)
+    missioni_concluse, prossima_pagina = pagina_missioni(request.user, conclusa=True)
     return render(request, 'Rimborsi/lista_missioni.html', {'missioni_attive': missioni_attive,
-                                                            'missioni_concluse': missioni_concluse})
+                                                            'missioni_concluse': missioni_concluse,
+                                                            'prossima_pagina': prossima_pagina})
+
+
+@login_required
+def lista_missioni_concluse(request):
+    """Feed JSON per l'infinite scroll delle missioni concluse: ?inizio=YYYY-MM-DD&id=N è il cursore."""
+    try:
+        dopo = (datetime.datetime.strptime(request.GET['inizio'], '%Y-%m-%d').date(), int(request.GET['id']))
+    except (KeyError, ValueError):
+        return JsonResponse({'success': False, 'error': 'Cursore non valido'}, status=400)
+
+    missioni_concluse, prossima_pagina = pagina_missioni(request.user, conclusa=True, dopo=dopo)
+    html = render_to_string('Rimborsi/lista_missioni_concluse_righe.html',
+                            {'missioni_concluse': missioni_concluse}, request=request)
+    prossima = None
+    if prossima_pagina is not None:
+        prossima = {'inizio': prossima_pagina[0], 'id': prossima_pagina[1]}
+    return JsonResponse({'success': True, 'missioni': missioni_concluse, 'html': html, 'next': prossima})
 
 
 ###########################
@@ -69,52 +182,8 @@ def lista_missioni(request):
 # END: Old Version
 ###########################
 
-def money_exchange(data, valuta, cifra):
-    """
-    :param data: Data a partire da cui si richiedono le quotazioni.
-        Viene interpretata relativamente al fuso orario dell’Europa
-        Centrale nel seguente formato: "yyyy-MM-dd".
-        Se il parametro non viene specificato, o è specificato in un
-        formato errato, il servizio restituirà un messaggio con il formato
-        richiesto.
-    :param valuta: Codice ISO (case insensitive) della valuta per cui si richiede la quotazione
-    :param cifra: Quantità da convertire
-    :return: Quantità convertita nella valuta desiderata
-    """
-
-    def get_tasso_di_cambio(data, valuta):
-
-        if data >= data.today():
-            data = data.today() - datetime.timedelta(days=1)
-
-        url = 'https://tassidicambio.bancaditalia.it/terzevalute-wf-web/rest/v1.0/dailyTimeSeries'
-        valid_data = data
-        if data.weekday() >= 5:
-            valid_data = data - datetime.timedelta(days=data.weekday() - 4)
-        params = {
-            'startDate': valid_data,
-            'endDate': valid_data,
-            'baseCurrencyIsoCode': valuta,
-            'currencyIsoCode': 'EUR'
-        }
-        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
-        response = requests.get(url, params=params, headers=headers)
-        content = json.loads(response.content)
-
-        if content['resultsInfo']['totalRecords'] != 0:
-            return float(content['rates'][0]['avgRate'])
-        else:
-            # If the day has no valid exchange we are going to get the first valid exchange of previous days
-            return get_tasso_di_cambio(data - datetime.timedelta(days=1), valuta)
-
-
-    tasso_cambio = get_tasso_di_cambio(data, valuta)
-    cifra_convertita = cifra / tasso_cambio
-    return cifra_convertita
-
-
 def resoconto_data(missione):
-    eur = 'EUR'
+    eur = EUR
 
     db_dict = {
         # 'scontrino': [('s1', 'v1'), ('s2', 'v2'), ('s3', 'v3')],
@@ -124,15 +193,15 @@ def resoconto_data(missione):
     }
 
     totali_base = {
-        'scontrino': 0.,
-        'pernottamento': 0.,
-        'convegno': 0.,
-        'altrespese': 0.,
-        'trasporto': 0,
-
-        'totale': 0.,
-        'totale_indennita': 0.,
-        'totale_indennita_anticipo': 0.,
+        'scontrino': ZERO,
+        'pernottamento': ZERO,
+        'convegno': ZERO,
+        'altrespese': ZERO,
+        'trasporto': ZERO,
+
+        'totale': ZERO,
+        'totale_indennita': ZERO,
+        'totale_indennita_anticipo': ZERO,
     }
     tipo_to_key = {
         'PERNOTTAMENTO': 'pernottamento',
@@ -146,30 +215,9 @@ def resoconto_data(missione):
 
     totali[eur] = totali_base.copy()
 
-    # # Sommo le spese per questa missione
-    # for k, sub_dict in db_dict.items():
-    #     tmp = load_json(missione, k)
-    #     for entry in tmp:
-    #         for s, v in sub_dict:
-    #             if entry.get(v) is None:
-    #                 entry[v] = eur  # Questo serve per gestire le entry del db inserite prima di aggiungere la valuta
-    #
-    #             if totali.get(entry[v]) is None:
-    #                 totali[entry[v]] = totali_base.copy()
-    #                 if entry[v] != eur:
-    #                     totali_convert[entry[v]] = totali_base.copy()
-    #
-    #             totali[entry[v]][k] += float(entry[s] or 0.)
-    #             if entry[v] != eur:
-    #                 totali_convert[entry[v]][k] += money_exchange(entry['data'], entry[v], float(entry[s] or 0.))
-
-    def add_spesa(spesa, tipo):
-        key = tipo_to_key.get(tipo)
-        if not key:
-            raise KeyError(f"Tipo di spesa non valido: {tipo}")
-
-        valuta = spesa.valuta or eur
-        costo = float(spesa.importo or 0.)
+    def add_totale(key, valuta, data, costo):
+        valuta = valuta or eur
+        costo = to_decimal(costo)
 
         if totali.get(valuta) is None:
             totali[valuta] = totali_base.copy()
@@ -178,46 +226,30 @@ def resoconto_data(missione):
 
         totali[valuta][key] += costo
         if valuta != eur:
-            totali_convert[valuta][key] += money_exchange(spesa.data, valuta, costo)
-
-    def add_pasti(pasti_set):
-        for entry in pasti_set:
-            for i in range(1, 4):  # ciclo 3 volte (un ciclo per ogni importo)
-                importo = getattr(entry, f'importo{i}')
-                valuta = getattr(entry, f'valuta{i}') or eur
-                costo = float(importo or 0.)
-
-                if totali.get(valuta) is None:
-                    totali[valuta] = totali_base.copy()
-                    if valuta != eur:
-                        totali_convert[valuta] = totali_base.copy()
-
-                totali[valuta]['scontrino'] += costo
-                if valuta != eur:
-                    totali_convert[valuta]['scontrino'] += money_exchange(entry.data, valuta, costo)
+            totali_convert[valuta][key] += money_exchange(data, valuta, costo)
 
+    # Tutte le somme sono fatte dal db, raggruppate per valuta e giorno (il giorno serve per il cambio).
     # Aggiungo le spese associate alla missione tramite SpesaMissione
-    for spesa_missione in SpesaMissione.objects.filter(missione=missione):
-        add_spesa(spesa_missione.spesa, spesa_missione.tipo)
+    spese = SpesaMissione.objects.filter(missione=missione) \
+        .values('tipo', 'spesa__valuta', 'spesa__data').annotate(totale=Sum('spesa__importo')).order_by()
+    for entry in spese:
+        key = tipo_to_key.get(entry['tipo'])
+        if not key:
+            raise KeyError(f"Tipo di spesa non valido: {entry['tipo']}")
+        add_totale(key, entry['spesa__valuta'], entry['spesa__data'], entry['totale'])
 
     # Aggiungi le spese dei pasti
-    add_pasti(missione.pasti_set.all())
+    pasti = Pasto.objects.filter(pasti__missione=missione, importo__isnull=False) \
+        .values('valuta', 'pasti__data').annotate(totale=Sum('importo')).order_by()
+    for entry in pasti:
+        add_totale('scontrino', entry['valuta'], entry['pasti__data'], entry['totale'])
+
+    # Aggiungo il trasporto, convertendo anche quelli non in euro
+    trasporti = missione.trasporto_set.values('valuta', 'data').annotate(totale=Sum('costo')).order_by()
+    for entry in trasporti:
+        add_totale('trasporto', entry['valuta'], entry['data'], entry['totale'])
 
-    # Aggiungo il trasporto
     for v in totali.keys():
-        if v == eur:
-            totali[v]['trasporto'] = float(missione.trasporto_set.filter(valuta=v).aggregate(Sum('costo'))['costo__sum'] or 0.)
-        else:
-            # Per le spese non in euro devo fare anche la conversione
-            trasporti_v = missione.trasporto_set.filter(valuta=v)  # Trasporti pagati con valuta v
-            totali[v]['trasporto'] = 0
-            totali_convert[v]['trasporto'] = 0
-            for t in trasporti_v:
-                totali[v]['trasporto'] += float(t.costo)
-                totali_convert[v]['trasporto'] += money_exchange(t.data, v, float(t.costo))
-        # Vecchia versione che non convertiva i trasporti non in euro.
-        # totali[v]['trasporto'] = float(
-        #     missione.trasporto_set.filter(valuta=v).aggregate(Sum('costo'))['costo__sum'] or 0.)
         totali[v]['totale'] = sum(totali[v].values())
 
     for v in totali_convert.keys():
@@ -227,13 +259,15 @@ def resoconto_data(missione):
     km = float(missione.trasporto_set.filter(mezzo='AUTO').aggregate(Sum('km'))['km__sum'] or 0.)
     try:
         prezzo = get_prezzo_carburante()
-        indennita = float(prezzo / 5 * km)
+        # Prezzo al litro e km non arrotondati: si arrotonda al centesimo solo il risultato
+        indennita = to_decimal(decimal.Decimal(str(prezzo)) / 5 * decimal.Decimal(str(km)))
     except:
         prezzo = None
-        indennita = 0
+        indennita = ZERO
 
+    anticipo = missione.anticipo or ZERO
     totali[eur]['totale_indennita'] = totali[eur]['totale'] + indennita
-    totali[eur]['totale_indennita_anticipo'] = totali[eur]['totale_indennita'] - missione.anticipo
+    totali[eur]['totale_indennita_anticipo'] = totali[eur]['totale_indennita'] - anticipo
 
     totali_convert[eur] = totali[eur].copy()
     grandtotal = totali_base.copy()
@@ -241,7 +275,7 @@ def resoconto_data(missione):
         for k, v in cur_total.items():
             grandtotal[k] += v
     grandtotal['totale_indennita'] = grandtotal['totale'] + indennita
-    grandtotal['totale_indennita_anticipo'] = grandtotal['totale_indennita'] - missione.anticipo
+    grandtotal['totale_indennita_anticipo'] = grandtotal['totale_indennita'] - anticipo
     totali['parziale'] = grandtotal
 
     if prezzo:
@@ -250,6 +284,13 @@ def resoconto_data(missione):
         return km, None, totali
 
 
+@login_required
+def cerca(request):
+    testo = request.GET.get('q', '').strip()
+    risultati = cerca_missioni(request.user, testo) if testo else []
+    return render(request, 'Rimborsi/cerca.html', {'q': testo, 'risultati': risultati})
+
+
 @login_required
 def resoconto(request, id):
     if request.method == 'GET':
@@ -285,7 +326,7 @@ def resoconto(request, id):
                                                            'km': km,
                                                            'indennita': indennita,
                                                            'totali': totali,
-                                                           'anticipo': -missione.anticipo,
+                                                           'anticipo': -(missione.anticipo or ZERO),
                                                             # Firme
                                                            'firme_form': firme_form,
                                                            })
@@ -461,9 +502,14 @@ def clona_missione(request, id):
             t.save()
 
         for p in pasti:
+            voci = list(p.voci.all())
             p.id = None
             p.missione = missione
             p.save()
+            for v in voci:
+                v.id = None
+                v.pasti = p
+            Pasto.objects.bulk_create(voci)
 
         for p in pernottamenti:
             p.id = None
@@ -602,7 +648,7 @@ def missione(request, id):
         # for k, _ in db_dict.items():
         #     db_dict[k] = load_json(missione, k)
 
-        pasti_qs = Pasti.objects.filter(missione=missione).order_by('data')
+        pasti_qs = Pasti.objects.filter(missione=missione).order_by('data').prefetch_related('voci')
         giorni = (missione.fine - missione.inizio).days
         all_dates = [missione.inizio + datetime.timedelta(n) for n in range(giorni + 1)]
         existing_pasti_dates = {pasto.data for pasto in pasti_qs}
@@ -992,49 +1038,131 @@ def regolamento(request):
         return render(request, 'Rimborsi/regolamento.html')
 
 
+# Moduli che si possono allegare alla richiesta di autorizzazione
+MODULI_AUTORIZZAZIONE = {
+    'parte_1_file': 'Missione Parte I',
+    'dottorandi_file': 'Autorizzazione Dottorando',
+}
+
+
 @login_required
 def invia_email_autorizzazione(request, id):
     if request.method == 'GET':
         return redirect('home')
     elif request.method == 'POST':
         data = request.POST
-        emails = data.get('emails')
+        emails = (data.get('emails') or '').split()
         text = data.get('textarea-email')
 
-        emails = emails.split(' ')
-        send_mail(
-            'Autorizzazione missione',
-            text,
-            f'Sistema Gestione Missioni <{settings.EMAIL_HOST_USER}>',
-            emails,
-            fail_silently=False,
-        )
+        missione = get_object_or_404(Missione, pk=id, user=request.user)
+        # Controllati qui: un messaggio senza destinatari risulterebbe "inviato" senza arrivare a nessuno,
+        # uno con un indirizzo sbagliato verrebbe ritentato per mezz'ora prima di finire in errore
+        if not emails:
+            messages.error(request, 'Richiesta non inviata: inserire almeno un destinatario.')
+            return redirect('RimborsiApp:resoconto', id)
+        non_validi = []
+        for email in emails:
+            try:
+                validate_email(email)
+            except ValidationError:
+                non_validi.append(email)
+        if non_validi:
+            messages.error(request, f'Richiesta non inviata, indirizzi non validi: {", ".join(non_validi)}.')
+            return redirect('RimborsiApp:resoconto', id)
+
+        # I moduli già generati sono allegati direttamente dallo storage, senza ricompilarli
+        moduli_missione = ModuliMissione.objects.filter(missione=missione).first()
+        allegati = []
+        for campo in data.getlist('allegati'):
+            if campo not in MODULI_AUTORIZZAZIONE or not moduli_missione or not getattr(moduli_missione, campo):
+                continue
+            try:
+                allegati.append(prepara_allegato(getattr(moduli_missione, campo)))
+            except OSError:
+                # Il campo indica un file che non c'è più sul disco: si invia senza, avvisando
+                messages.warning(request, f'Il modulo {MODULI_AUTORIZZAZIONE[campo]} non è stato trovato e non '
+                                          f'è stato allegato: rigenerarlo con "Compila PDF" e inviarlo a parte.')
+        # Inviata in background dalla coda (posta.py): un SMTP lento non blocca la richiesta
+        accoda_email('Autorizzazione missione', text, emails, missione=missione, user=request.user,
+                     allegati=allegati)
+        messages.success(request, 'Richiesta di autorizzazione in invio a: ' + ', '.join(emails) + '.')
         return redirect('RimborsiApp:resoconto', id)
 
 
+STATISTICHE_PER_PAGINA = 50
+
+
+def _statistiche_data(request):
+    """Filtri, riepiloghi e pagina di dettaglio condivisi da pagina HTML e API JSON delle statistiche."""
+    form = FiltroStatisticheForm(request.GET or None)
+    filtri = form.cleaned_data if form.is_valid() else {}
+    # Legge i riepiloghi dalla tabella dei fatti aggiornata ogni notte (manage.py aggiorna_statistiche)
+    fatti, missioni = filtra_statistiche(filtri)
+    totali, per_struttura, per_mese = riepiloghi(fatti)
+    pagina = Paginator(dettaglio(missioni), STATISTICHE_PER_PAGINA).get_page(request.GET.get('pagina'))
+    return {
+        'form': form,
+        'totali': totali,
+        'per_struttura': per_struttura,
+        'per_mese': per_mese,
+        'pagina': pagina,
+        'aggiornato': StatisticaMissioni.objects.aggregate(Max('aggiornato'))['aggiornato__max'],
+    }
+
+
 @login_required
 def statistiche(request):
-    if not request.user.groups.filter(name='AIRI').exists():
+    if not ha_gruppo(request.user, 'AIRI'):
         return HttpResponseForbidden('Accesso non consentito.')
 
-    from django.db.models import Q
+    context = _statistiche_data(request)
+    # Querystring dei filtri senza il numero di pagina, per i link della paginazione
+    filtri = request.GET.copy()
+    filtri.pop('pagina', None)
+    context['filtri_qs'] = filtri.urlencode()
+    return render(request, 'Rimborsi/statistiche.html', context)
 
-    strutture = ['softech', 'airi']
-    condizioni = Q()
-    for s in strutture:
-        condizioni |= Q(struttura_fondi__icontains=s)
 
-    missioni = Missione.objects.filter(condizioni)
-    missioni_ricerca = missioni.filter(tipo=TIPO_MISSIONE_CHOICES[0][0]).order_by('-inizio')
-    missioni_progetto = missioni.filter(tipo=TIPO_MISSIONE_CHOICES[1][0]).order_by('-inizio')
+@login_required
+def statistiche_api(request):
+    if not ha_gruppo(request.user, 'AIRI'):
+        return JsonResponse({'success': False, 'error': 'Accesso non consentito.'}, status=403)
+
+    context = _statistiche_data(request)
+    if context['form'].errors:
+        return JsonResponse({'success': False, 'errors': context['form'].errors}, status=400)
+    pagina = context['pagina']
+    return JsonResponse({
+        'success': True,
+        'aggiornato': context['aggiornato'],
+        'totali': context['totali'],
+        'per_struttura': context['per_struttura'],
+        'per_mese': context['per_mese'],
+        'missioni': list(pagina),
+        'pagina': pagina.number,
+        'pagine': pagina.paginator.num_pages,
+        'n_missioni': pagina.paginator.count,
+    })
+
 
-    fields = ['user__first_name', 'user__last_name', 'citta_destinazione', 'inizio', 'fine', 'motivazione', 'fondo']
-    missioni_ricerca = missioni_ricerca.values(*fields)
-    missioni_progetto = missioni_progetto.values(*fields)
+@login_required
+def statistiche_export(request, tabella, formato):
+    """Esporta missioni o voci di spesa (con gli stessi filtri della pagina statistiche) in CSV o XLSX."""
+    if not ha_gruppo(request.user, 'AIRI'):
+        return HttpResponseForbidden('Accesso non consentito.')
+    if tabella not in ESPORTAZIONI or formato not in FORMATI:
+        raise Http404
 
-    return render(request, 'Rimborsi/statistiche.html', {
-        'missioni_ricerca': missioni_ricerca,
-        'missioni_progetto': missioni_progetto})
+    form = FiltroStatisticheForm(request.GET or None)
+    # Senza parametri si esporta tutto; un filtro non valido non deve diventare un export completo
+    if form.is_bound and not form.is_valid():
+        return JsonResponse({'success': False, 'errors': form.errors}, status=400)
+    _, missioni = filtra_statistiche(form.cleaned_data if form.is_bound else {})
+
+    stream, content_type = FORMATI[formato]
+    response = StreamingHttpResponse(stream(ESPORTAZIONI[tabella](missioni)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{tabella}_{datetime.date.today():%Y%m%d}.{formato}"'
+    return response
 
 
 @login_required
@@ -1155,24 +1283,20 @@ def save_pasto(request, item_id=None):
         else:
             return JsonResponse({'success': False, 'error': 'Date is required'}, status=400)
             
-        for i in range(1, 4):
-            importo_str = request.POST.get(f'importo{i}')
-            if importo_str and importo_str.strip():
-                try:
-                    setattr(pasto, f'importo{i}', float(importo_str.strip()))
-                except (ValueError, TypeError):
-                    setattr(pasto, f'importo{i}', None)
-            else:
-                setattr(pasto, f'importo{i}', None)
-            
-            setattr(pasto, f'valuta{i}', request.POST.get(f'valuta{i}') or 'EUR')
-            setattr(pasto, f'descrizione{i}', request.POST.get(f'descrizione{i}') or '')
-            
-            img_field_name = f'img_scontrino{i}'
-            if img_field_name in request.FILES:
-                setattr(pasto, img_field_name, request.FILES[img_field_name])
-        
         pasto.save()
+
+        for tipo, _ in TIPO_PASTO_CHOICES:
+            importo_str = request.POST.get(f'importo{tipo}')
+            try:
+                importo = parse_importo(importo_str)
+            except (ValueError, TypeError):
+                importo = None
+
+            pasto.aggiorna_voce(tipo,
+                                importo,
+                                request.POST.get(f'valuta{tipo}'),
+                                request.POST.get(f'descrizione{tipo}'),
+                                request.FILES.get(f'img_scontrino{tipo}'))
         
         return JsonResponse({'success': True, 'id': getattr(pasto, 'id', None)})
         
@@ -1237,7 +1361,7 @@ def save_pernottamento(request, item_id=None):
         importo_str = request.POST.get('importo')
         if importo_str and importo_str.strip():
             try:
-                spesa.importo = float(importo_str.strip())
+                spesa.importo = parse_importo(importo_str)
             except (ValueError, TypeError):
                 return JsonResponse({'success': False, 'error': f'Invalid amount format: {importo_str}'}, status=400)
         else:
@@ -1320,7 +1444,7 @@ def save_trasporto(request, item_id=None):
         costo_str = request.POST.get('costo')
         if costo_str and costo_str.strip():
             try:
-                trasporto.costo = float(costo_str.strip())
+                trasporto.costo = parse_importo(costo_str)
             except (ValueError, TypeError):
                 return JsonResponse({'success': False, 'error': f'Invalid cost format: {costo_str}'}, status=400)
         else:
@@ -1409,7 +1533,7 @@ def save_convegno(request, item_id=None):
         importo_str = request.POST.get('importo')
         if importo_str and importo_str.strip():
             try:
-                spesa.importo = float(importo_str.strip())
+                spesa.importo = parse_importo(importo_str)
             except (ValueError, TypeError):
                 return JsonResponse({'success': False, 'error': f'Invalid amount format: {importo_str}'}, status=400)
         else:
@@ -1495,7 +1619,7 @@ def save_altrespesa(request, item_id=None):
         importo_str = request.POST.get('importo')
         if importo_str and importo_str.strip():
             try:
-                spesa.importo = float(importo_str.strip())
+                spesa.importo = parse_importo(importo_str)
             except (ValueError, TypeError):
                 return JsonResponse({'success': False, 'error': f'Invalid amount format: {importo_str}'}, status=400)
         else:
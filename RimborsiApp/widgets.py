@@ -1,3 +1,4 @@
+from dal import autocomplete
 from django import forms
 import os
 from django.conf import settings
@@ -12,4 +13,17 @@ class PastiCustomClearableFileInput(forms.ClearableFileInput):
 
 
 class FirmeCustomClearableFileInput(forms.ClearableFileInput):
-    template_name = 'django/forms/widgets/custom_clearable_file_input3.html'
\ No newline at end of file
+    template_name = 'django/forms/widgets/custom_clearable_file_input3.html'
+
+
+class RiferimentoSelect2(autocomplete.ModelSelect2):
+    """
+    ModelSelect2 per un RiferimentoChoiceField: le opzioni selezionate da mostrare sono prese
+    dalla tabella di riferimento in cache invece che con una query filtrata sul queryset.
+    """
+    def filter_choices_to_render(self, selected_choices):
+        tabella = getattr(getattr(self.choices, 'field', None), 'tabella', None)
+        if tabella is None:
+            return super().filter_choices_to_render(selected_choices)
+        righe = (tabella.cerca(c) for c in selected_choices if c)
+        self.choices = [(r.pk, str(r)) for r in righe if r is not None]
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+# Attributi che Shibboleth passa nell'environment della richiesta (vedi shibboleth_login)
+ATTRIBUTI = ('eppn', 'mail', 'givenName', 'sn', 'unimorecodicefiscale')
+
+
+class AttributiDaHeaderMiddleware:
+    """
+    Solo per prove di carico su un'istanza locale, senza Shibboleth davanti: copia gli header
+    Eppn, Mail, Givenname, Sn e Unimorecodicefiscale negli attributi letti da shibboleth_login.
+    Attivo solo con SHIBBOLETH_ATTRIBUTI_DA_HEADER e DEBUG insieme (cioè con runserver), da non abilitare mai in
+    produzione: chiunque potrebbe autenticarsi come un altro utente. Richiedere anche DEBUG evita che una
+    variabile d'ambiente rimasta per sbaglio sul server di produzione basti ad attivarlo.
+    """
+    def __init__(self, get_response):
+        if not (settings.DEBUG and getattr(settings, 'SHIBBOLETH_ATTRIBUTI_DA_HEADER', False)):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        for attributo in ATTRIBUTI:
+            header = 'HTTP_' + attributo.upper()
+            if header in request.META:
+                request.META[attributo] = request.META[header]
+        return self.get_response(request)
@@ -1,62 +1,90 @@
 from django.contrib.auth.models import User
 from django.contrib.auth import login, authenticate, logout
+from django.contrib.auth.hashers import make_password
 from django.http import HttpRequest, HttpResponse
 from django.shortcuts import HttpResponseRedirect, resolve_url, render
 from django.conf import settings
 from codicefiscale import codicefiscale
-from comuni_italiani.models import *
 
-import datetime
-import json
+from RimborsiApp.riferimenti import COMUNI_PER_CATASTALE
 
 def get_success_url(request):
     url = request.POST.get('next', request.GET.get('next', ''))
     return url or resolve_url(settings.LOGIN_REDIRECT_URL)
 
 
+def _attributi_user(meta):
+    """Campi dell'utente forniti da Shibboleth."""
+    attributi = {}
+    if 'mail' in meta:
+        attributi['email'] = meta['mail']
+    if 'givenName' in meta:
+        attributi['first_name'] = str(meta['givenName']).capitalize()
+    if 'sn' in meta:
+        attributi['last_name'] = str(meta['sn']).capitalize()
+    return attributi
+
+
+def _completa_user(user, meta):
+    """Valorizza i campi vuoti dell'utente con gli attributi di Shibboleth; restituisce i campi modificati."""
+    modificati = []
+    for campo, valore in _attributi_user(meta).items():
+        if getattr(user, campo) == '':
+            setattr(user, campo, valore)
+            modificati.append(campo)
+    return modificati
+
+
+def _completa_profilo(profile, codice_fiscale):
+    """Valorizza cf, data e luogo di nascita e sesso mancanti; restituisce i campi modificati."""
+    modificati = []
+    if profile.cf == '':
+        profile.cf = codice_fiscale
+        modificati.append('cf')
+    if profile.data_nascita is not None and profile.luogo_nascita_id is not None and profile.sesso is not None:
+        return modificati
+
+    try:
+        cf = codicefiscale.decode(codice_fiscale)
+    except Exception:
+        return modificati
+    if profile.data_nascita is None:
+        profile.data_nascita = cf['birthdate']
+        modificati.append('data_nascita')
+    if profile.luogo_nascita_id is None and cf.get('birthplace'):
+        # Dalla cache dei comuni invece di una query per codice catastale a ogni login
+        comune = COMUNI_PER_CATASTALE.get(cf['birthplace']['code'])
+        if comune is not None:
+            profile.luogo_nascita_id = comune.pk
+            modificati.append('luogo_nascita')
+    if profile.sesso is None:
+        profile.sesso = cf['sex']
+        modificati.append('sesso')
+    return modificati
+
+
 def shibboleth_login(request, flag):
     meta = request.META
 
-    user, created = User.objects.get_or_create(username=meta["eppn"])
-    if created:
-        user.set_unusable_password()
-
-    if user.email == '' and "mail" in meta:
-        user.email = meta["mail"]
-    if user.first_name == '' and "givenName" in meta:
-        user.first_name = str(meta["givenName"]).capitalize()
-    if user.last_name == '' and "sn" in meta:
-        user.last_name = str(meta["sn"]).capitalize()
-
-    user.save()
-
-    if flag:
-        if 'unimorecodicefiscale' in meta:
-            if user.profile.cf == '':
-                user.profile.cf = meta['unimorecodicefiscale']
-
-            cf = ''
-            try:
-                cf = codicefiscale.decode(meta['unimorecodicefiscale'])
-                if user.profile.data_nascita is None and cf != '':
-                    user.profile.data_nascita = cf['birthdate']
-                if user.profile.luogo_nascita is None and cf != '':
-                    #luogo_nascita = cf['birthplace']['name'].lower().capitalize()
-                    #luogo_nascita = luogo_nascita.replace('(soppresso)', '').strip()
-                    luogo_nascita_code = cf['birthplace']['code']
-                    user.profile.luogo_nascita = Comune.objects.filter(codice_catastale=luogo_nascita_code)[0]
-                if user.profile.sesso is None and cf != '':
-                    user.profile.sesso = cf['sex']
-            except:
-                pass
-        if user.profile.qualifica is None:
-            pass
-        user.save()
+    # Utente e profilo con una sola query; nel caso comune (utente già registrato e dati invariati) non si scrive
+    user = User.objects.select_related('profile').filter(username=meta["eppn"]).first()
+    if user is None:
+        # get_or_create per il primo login concorrente; il profilo lo crea il receiver create_user_profile
+        user, _ = User.objects.get_or_create(username=meta["eppn"],
+                                             defaults={'password': make_password(None), **_attributi_user(meta)})
+    else:
+        modificati = _completa_user(user, meta)
+        if modificati:
+            user.save(update_fields=modificati)
+
+    if flag and 'unimorecodicefiscale' in meta:
+        modificati = _completa_profilo(user.profile, meta['unimorecodicefiscale'])
+        if modificati:
+            user.profile.save(update_fields=modificati)
 
     user.backend = 'django.contrib.auth.backends.ModelBackend'
     login(request, user)
 
-    request.GET.urlencode()
     return HttpResponseRedirect(get_success_url(request))
 
 